@@ -0,0 +1,114 @@
+"""
+Measure the bytes sent and the CPU time of a delta transfer with
+different block sizes.
+
+Usage:
+    python benchmarks/block_size.py [file_size_in_kb] [number_of_changes]
+
+The basis file is random data and the new version has
+`number_of_changes` small edits spread over it, half of them changing
+bytes in place and half inserting bytes (which shifts the rest of the
+file). The bytes are the packed MSG_INIT_ACCEPT checksums and
+MSG_BLOCK_DATA messages, the CPU time includes computing the checksums
+and the delta and applying it. The 'adaptive' row uses the block size
+chosen by `choose_block_size` for the file.
+"""
+import os
+import sys
+import time
+import msgpack
+import pyrsync2
+
+from io import BytesIO
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+from syncall.block_size import choose_block_size
+
+
+def create_files(file_size, num_changes):
+    basis = bytearray(os.urandom(file_size))
+    new = bytearray(basis)
+
+    # From the end so the offsets of the next changes are still valid
+    for i in reversed(range(num_changes)):
+        offset = (i * 2 + 1) * file_size // (num_changes * 2)
+
+        if i % 2 == 0:
+            new[offset:offset + 100] = os.urandom(100)
+        else:
+            new[offset:offset] = os.urandom(100)
+
+    return bytes(basis), bytes(new)
+
+
+def transfer(basis, new, block_size):
+    start = time.process_time()
+
+    checksums = list(pyrsync2.blockchecksums(
+        BytesIO(basis),
+        blocksize=block_size
+    ))
+    sent_bytes = len(msgpack.packb({
+        'type': 1,
+        'block_size': block_size,
+        'checksums': checksums
+    }))
+
+    basis_file = BytesIO(basis)
+    result = BytesIO()
+
+    for block in pyrsync2.rsyncdelta(
+        BytesIO(new),
+        checksums,
+        blocksize=block_size,
+        max_buffer=block_size
+    ):
+        sent_bytes += len(msgpack.packb({
+            'type': 3,
+            'binary_data': block
+        }))
+
+        pyrsync2.patchstream_block(
+            basis_file,
+            result,
+            block,
+            blocksize=block_size
+        )
+
+    elapsed = time.process_time() - start
+
+    assert result.getvalue() == new
+
+    return (len(checksums), sent_bytes, elapsed)
+
+
+def main():
+    file_size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 2 ** 21
+    num_changes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    basis, new = create_files(file_size, num_changes)
+
+    print("{} KB file, {} changes".format(file_size // 1024, num_changes))
+    print("{:<18} {:>10} {:>12} {:>10}".format(
+        'block size', 'checksums', 'bytes', 'CPU (s)'
+    ))
+
+    block_sizes = [
+        ('{}'.format(2 ** power), 2 ** power) for power in range(10, 18)
+    ]
+    adaptive = choose_block_size(file_size)
+    block_sizes.append(('adaptive ({})'.format(adaptive), adaptive))
+
+    for name, block_size in block_sizes:
+        num_checksums, sent_bytes, elapsed = transfer(basis, new, block_size)
+
+        print("{:<18} {:>10} {:>12} {:>10.3f}".format(
+            name, num_checksums, sent_bytes, elapsed
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Compare the data exchanged by rsync deltas and content-defined chunking
+transfers.
+
+Usage:
+    python benchmarks/chunking.py [file_size_in_mb] [block_size]
+
+For a random file and a few kinds of changes to it, the bytes sent by
+each side are counted:
+    - rsync: the receiver sends the block checksums of its file and the
+      sender sends the data which doesn't match any block;
+    - chunks: the sender sends the chunk list and the receiver asks for
+      the chunks it doesn't have, which are sent.
+The lists are counted as msgpack encoded, like they're sent.
+"""
+import os
+import random
+import sys
+import time
+
+from io import BytesIO
+
+import msgpack
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+from syncall.chunking import chunk_file
+from syncall.delta import create_delta_engine
+
+
+def change(data, kind, generator):
+    middle = len(data) // 2
+
+    if kind == 'insertion':
+        return data[:middle] + b'inserted' + data[middle:]
+    elif kind == 'deletion':
+        return data[:middle] + data[middle + 100:]
+    elif kind == 'scattered':
+        data = bytearray(data)
+        for i in range(20):
+            offset = generator.randrange(len(data))
+            data[offset:offset] = generator.randbytes(10)
+
+        return bytes(data)
+    elif kind == 'prepended':
+        return generator.randbytes(1000) + data
+
+
+def rsync_bytes(engine, basis, new, block_size):
+    checksums = engine.blockchecksums(BytesIO(basis), block_size)
+
+    sent = 0
+    for block in engine.rsyncdelta(BytesIO(new), checksums, block_size,
+                                   block_size):
+        sent += len(msgpack.packb(block))
+
+    return len(msgpack.packb(checksums)), sent
+
+
+def chunk_bytes(basis, new):
+    local_chunks = set(chunk_file(BytesIO(basis)))
+    chunks = chunk_file(BytesIO(new))
+
+    missing = [
+        index for index, chunk in enumerate(chunks)
+        if chunk not in local_chunks
+    ]
+
+    sent = len(msgpack.packb([list(chunk) for chunk in chunks])) + \
+        sum(chunks[index][1] for index in missing)
+
+    return len(msgpack.packb(missing)), sent
+
+
+def main():
+    file_size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 2 ** 23
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+
+    generator = random.Random(1)
+    engine = create_delta_engine()
+    basis = generator.randbytes(file_size)
+
+    print("{} MB file, {} byte blocks".format(
+        file_size // 2 ** 20, block_size
+    ))
+    print("{:<10} {:<7} {:>14} {:>14} {:>10}".format(
+        'change', 'mode', 'receiver (B)', 'sender (B)', 'time (s)'
+    ))
+
+    for kind in ('insertion', 'deletion', 'scattered', 'prepended'):
+        new = change(basis, kind, generator)
+
+        for mode, function in (
+            ('rsync', lambda: rsync_bytes(engine, basis, new, block_size)),
+            ('chunks', lambda: chunk_bytes(basis, new))
+        ):
+            start = time.perf_counter()
+            received, sent = function()
+            elapsed = time.perf_counter() - start
+
+            print("{:<10} {:<7} {:>14} {:>14} {:>10.3f}".format(
+                kind, mode, received, sent, elapsed
+            ))
+
+
+if __name__ == '__main__':
+    main()
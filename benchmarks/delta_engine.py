@@ -0,0 +1,83 @@
+"""
+Measure the throughput of the delta engines.
+
+Usage:
+    python benchmarks/delta_engine.py [file_size_in_mb] [block_size]
+
+For each engine the block checksums of a random file are computed and
+deltas are made of:
+    - the file with a few bytes inserted near its start, which shifts
+      every following block;
+    - an unrelated file of the same size, where no block matches and
+      every offset has to be checked.
+The 'numpy' engine reads the file in segments of SEGMENT_SIZE bytes.
+"""
+import os
+import sys
+import tempfile
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+from syncall.delta import DELTA_ENGINES
+
+
+def write_file(data):
+    file = tempfile.NamedTemporaryFile()
+    file.write(data)
+    file.flush()
+
+    return file
+
+
+def measure(function):
+    start = time.perf_counter()
+    result = function()
+
+    return (result, time.perf_counter() - start)
+
+
+def main():
+    file_size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 2 ** 22
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+
+    basis = os.urandom(file_size)
+
+    basis_file = write_file(basis)
+    shifted_file = write_file(basis[:1000] + b'changed' + basis[1000:])
+    unrelated_file = write_file(os.urandom(file_size))
+
+    print("{} MB file, {} byte blocks".format(
+        file_size // 2 ** 20, block_size
+    ))
+    print("{:<8} {:>16} {:>16} {:>16}".format(
+        'engine', 'checksums MB/s', 'shifted MB/s', 'unrelated MB/s'
+    ))
+
+    for name, engine_class in sorted(DELTA_ENGINES.items()):
+        engine = engine_class()
+        speeds = []
+
+        with open(basis_file.name, 'rb') as file:
+            checksums, elapsed = measure(
+                lambda: engine.blockchecksums(file, block_size)
+            )
+        speeds.append(file_size / 2 ** 20 / elapsed)
+
+        for delta_file in (shifted_file, unrelated_file):
+            with open(delta_file.name, 'rb') as file:
+                delta, elapsed = measure(lambda: list(engine.rsyncdelta(
+                    file,
+                    checksums,
+                    block_size,
+                    block_size
+                )))
+            speeds.append(file_size / 2 ** 20 / elapsed)
+
+        print("{:<8} {:>16.1f} {:>16.1f} {:>16.1f}".format(name, *speeds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Measure the aggregate delta throughput of concurrent transfers with the
+deltas computed on the transfer threads and on worker processes.
+
+Usage:
+    python benchmarks/delta_workers.py [transfers] [file_size_in_mb]
+                                       [workers]
+
+Each transfer thread makes the delta of its own file (a random file
+with a few bytes inserted near its start) against the checksums of the
+original and reads the literal data, like `FileTransfer.run`. With
+worker processes (`Directory`'s `delta_workers` option) the threads only
+wait for the workers and read the literal data.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+from syncall.delta import DELTA_ENGINES, create_delta_engine
+
+BLOCK_SIZE = 4096
+
+
+def create_files(num_transfers, file_size):
+    files = []
+    engine = create_delta_engine()
+
+    for i in range(num_transfers):
+        basis = os.urandom(file_size)
+
+        file = tempfile.NamedTemporaryFile()
+        file.write(basis[:1000] + b'changed' + basis[1000:])
+        file.flush()
+
+        with tempfile.TemporaryFile() as basis_file:
+            basis_file.write(basis)
+            basis_file.flush()
+
+            checksums = engine.blockchecksums(basis_file, BLOCK_SIZE)
+
+        files.append((file, checksums))
+
+    return files
+
+
+def transfer(engine, file_path, checksums):
+    with open(file_path, 'rb') as file:
+        for block in engine.rsyncdelta(file, checksums, BLOCK_SIZE,
+                                       BLOCK_SIZE):
+            pass
+
+
+def measure(engine, files):
+    threads = [
+        threading.Thread(target=transfer, args=(engine, file.name, checksums))
+        for file, checksums in files
+    ]
+
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start
+
+
+def main():
+    num_transfers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    file_size = int(sys.argv[2]) * 2 ** 20 if len(sys.argv) > 2 else 2 ** 21
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count() or 1
+
+    files = create_files(num_transfers, file_size)
+    total_size = num_transfers * file_size / 2 ** 20
+
+    print("{} transfers of {} MB, {} workers, {} CPUs".format(
+        num_transfers, file_size // 2 ** 20, workers, os.cpu_count()
+    ))
+    print("{:<8} {:<10} {:>10} {:>10}".format(
+        'engine', 'mode', 'time (s)', 'MB/s'
+    ))
+
+    for name in sorted(DELTA_ENGINES):
+        for mode, engine_workers in (('threads', 0), ('processes', workers)):
+            engine = create_delta_engine(name, engine_workers)
+
+            if engine_workers > 0:
+                # Start the workers before measuring
+                measure(engine, files[:1])
+
+            elapsed = measure(engine, files)
+
+            if engine_workers > 0:
+                engine.shutdown()
+
+            print("{:<8} {:<10} {:>10.3f} {:>10.1f}".format(
+                name, mode, elapsed, total_size / elapsed
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Compare `bintools.hash_file` with the previous 8 KiB read loop.
+
+Usage:
+    python benchmarks/hash_file.py [large_file_size_in_MiB]
+
+Small (4 KiB, hashed 2000 times), medium (16 MiB, hashed 5 times) and
+large (2 GiB by default) files are hashed with MD5 and BLAKE2b.
+
+The legacy loop always hashes from the page cache after the first pass.
+The new path drops files over 1 MiB from the page cache after hashing,
+which is the point of it during a rescan. So its repeated medium-file
+runs read from storage again, and it can look slower there.
+"""
+import os
+import sys
+import tempfile
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+import bintools
+
+
+def legacy_hash_file(file_path, algorithm='md5'):
+    """ The hash_file implementation before the zero-copy path """
+    hash = bintools.new_hash(algorithm)
+
+    with open(file_path, 'rb') as file:
+        while True:
+            data = file.read(8192)
+
+            if not data:
+                break
+
+            hash.update(data)
+
+    return hash.digest()
+
+
+def create_file(path, size):
+    block = os.urandom(1024 * 1024)
+
+    with open(path, 'wb') as file:
+        while size > 0:
+            file.write(block[:size])
+            size -= len(block)
+
+
+def measure(hash_function, path, algorithm, repeat):
+    start = time.perf_counter()
+
+    for i in range(repeat):
+        hash_function(path, algorithm)
+
+    return time.perf_counter() - start
+
+
+def main():
+    large_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    files = (
+        ('small (4 KiB)', 4 * 1024, 2000),
+        ('medium (16 MiB)', 16 * 1024 * 1024, 5),
+        ('large ({} MiB)'.format(large_size), large_size * 1024 * 1024, 1)
+    )
+
+    print("{:<18} {:<8} {:>12} {:>12} {:>8}".format(
+        'file', 'hash', 'legacy MB/s', 'new MB/s', 'speedup'
+    ))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, size, repeat in files:
+            path = os.path.join(temp_dir, 'file')
+            create_file(path, size)
+
+            for algorithm in ('md5', 'blake2b'):
+                assert legacy_hash_file(path, algorithm) == \
+                    bintools.hash_file(path, algorithm)
+
+                legacy = measure(legacy_hash_file, path, algorithm, repeat)
+                new = measure(bintools.hash_file, path, algorithm, repeat)
+                total_mb = size * repeat / 1e6
+
+                print("{:<18} {:<8} {:>12.1f} {:>12.1f} {:>7.2f}x".format(
+                    name,
+                    algorithm,
+                    total_mb / legacy,
+                    total_mb / new,
+                    legacy / new
+                ))
+
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Compare the regex ignore check with the compiled `.syncallignore` rules
+on a tree where most files are ignored.
+
+Usage:
+    python benchmarks/ignore.py [number_of_ignored_files]
+
+The tree has 1000 files that are synced and (by default) 50000 files in
+ignored `node_modules` and `build` directories:
+    - the legacy scan walks the whole tree and runs `re.search` with
+      the ignore patterns against every absolute path;
+    - the new scan matches relative paths with the compiled rules and
+      doesn't descend into ignored directories.
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+from syncall import scanner
+from syncall.ignore import IgnoreRules
+
+IGNORE_RULES = ['node_modules/', 'build/', '*.tmp']
+LEGACY_PATTERNS = r'\.syncall_.*|/node_modules/|/build/|\.tmp$'
+
+
+def create_files(top, num_files, files_per_dir=100):
+    for i in range(num_files):
+        dir_path = os.path.join(top, 'dir{}'.format(i // files_per_dir))
+        os.makedirs(dir_path, exist_ok=True)
+
+        with open(os.path.join(dir_path, 'file{}'.format(i)), 'w') as file:
+            file.write('content of file {}'.format(i))
+
+
+def create_tree(top, num_ignored):
+    create_files(os.path.join(top, 'src'), 1000)
+    create_files(os.path.join(top, 'node_modules'), num_ignored // 2)
+    create_files(os.path.join(top, 'src', 'build'), num_ignored // 2)
+
+
+def legacy_scan(top):
+    """ The walk and ignore check used before the ignore rules """
+    files = []
+
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+
+            if re.search(LEGACY_PATTERNS, file_path) is None:
+                files.append(file_path)
+
+    return files
+
+
+def rules_scan(top):
+    rules = IgnoreRules.load(os.path.join(top, '.syncallignore'))
+
+    return [
+        file_path for relative_path, file_path, stat
+        in scanner.scan_tree(top, rules.matches)
+    ]
+
+
+def measure(scan, top):
+    start = time.perf_counter()
+    files = scan(top)
+
+    return (time.perf_counter() - start, len(files))
+
+
+def main():
+    num_ignored = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    with tempfile.TemporaryDirectory() as top:
+        create_tree(top, num_ignored)
+
+        with open(os.path.join(top, '.syncallignore'), 'w') as ignore_file:
+            ignore_file.write('\n'.join(IGNORE_RULES))
+
+        print("1000 synced + {} ignored files".format(num_ignored))
+        print("{:<16} {:>10} {:>8}".format('scan', 'time (s)', 'files'))
+
+        for name, scan in (('legacy regex', legacy_scan),
+                           ('ignore rules', rules_scan)):
+            elapsed, num_files = measure(scan, top)
+            print("{:<16} {:>10.3f} {:>8}".format(name, elapsed, num_files))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Compare loading a whole msgpack index with opening a mapped snapshot.
+
+Usage:
+    python benchmarks/index_load.py [number_of_files ...]
+
+For each index size the time to load the index and look up one entry
+is measured for:
+    - the msgpack index map decoded with `bintools.decode_object`
+      (the format before the mapped snapshot);
+    - `JournalIndexStore`, which maps the snapshot and decodes only
+      the looked up entry.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import msgpack
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+import bintools
+
+from syncall.index_store import JournalIndexStore
+
+
+def create_index(num_files):
+    return {
+        'dir{}/file{}'.format(i // 100, i): {
+            'last_update': 1400000000 + i,
+            'last_update_location': 'local-uuid',
+            'hash': os.urandom(32),
+            'hash_algorithm': 'blake2b',
+            'sync_log': {'local-uuid': 1400000000 + i, 'remote-uuid': 0},
+            'size': i,
+            'inode': i,
+            'mtime_ns': i * 1000
+        }
+        for i in range(num_files)
+    }
+
+
+def legacy_load(path, file_name):
+    with open(path, 'rb') as index_file:
+        index = msgpack.unpackb(index_file.read())
+
+    index = bintools.decode_object(index, except_keys=('hash',))
+
+    return index[file_name]
+
+
+def mapped_load(path, file_name):
+    store = JournalIndexStore(path, threading.Lock())
+    store.load()
+
+    return store[file_name]
+
+
+def measure(load, path, file_name):
+    start = time.perf_counter()
+    load(path, file_name)
+
+    return time.perf_counter() - start
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000, 1000000]
+
+    print("{:>10} {:>12} {:>12}".format('files', 'msgpack (s)', 'mapped (s)'))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for num_files in sizes:
+            index = create_index(num_files)
+            file_name = 'dir0/file0'
+
+            legacy_path = os.path.join(temp_dir, 'legacy_index')
+            with open(legacy_path, 'wb') as index_file:
+                index_file.write(msgpack.packb(index))
+
+            mapped_path = os.path.join(temp_dir, 'mapped_index')
+            store = JournalIndexStore(mapped_path, threading.Lock())
+            store.load()
+
+            for name, file_data in index.items():
+                store[name] = file_data
+
+            store.save()
+            del index, store
+
+            print("{:>10} {:>12.4f} {:>12.4f}".format(
+                num_files,
+                measure(legacy_load, legacy_path, file_name),
+                measure(mapped_load, mapped_path, file_name)
+            ))
+
+
+if __name__ == '__main__':
+    main()
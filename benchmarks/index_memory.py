@@ -0,0 +1,103 @@
+"""
+Measure the memory used by an in-memory index with dict entries and
+with compact `IndexEntry` entries.
+
+Usage:
+    python benchmarks/index_memory.py [number_of_files] [number_of_peers]
+
+Entries are decoded from msgpack one by one, like the entries of a
+remote's index received over the network, so the dict entries have
+their own copies of the peer UUID strings. The memory is measured with
+tracemalloc and includes the file names.
+"""
+import os
+import sys
+import time
+import tracemalloc
+import msgpack
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+import bintools
+
+from syncall.index_entry import IndexEntry
+
+
+def packed_entries(num_files, peers):
+    for i in range(num_files):
+        timestamp = 1400000000.5 + i
+
+        yield ('dir{}/sub{}/file{}'.format(i // 10000, i // 100 % 100, i),
+               msgpack.packb({
+                   'last_update': timestamp,
+                   'last_update_location': peers[i % len(peers)],
+                   'hash': os.urandom(16),
+                   'hash_algorithm': 'md5',
+                   'sync_log': {uuid: timestamp for uuid in peers},
+                   'size': 1000 + i,
+                   'inode': 5000000 + i,
+                   'mtime_ns': int(timestamp * 10 ** 9)
+               }))
+
+
+def build_dicts(num_files, peers):
+    return {
+        file_name: bintools.decode_object(
+            msgpack.unpackb(data),
+            except_keys=('hash',)
+        )
+        for file_name, data in packed_entries(num_files, peers)
+    }
+
+
+def build_entries(num_files, peers):
+    return {
+        file_name: IndexEntry(bintools.decode_object(
+            msgpack.unpackb(data),
+            except_keys=('hash',)
+        ))
+        for file_name, data in packed_entries(num_files, peers)
+    }
+
+
+def measure(build, num_files, peers):
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    index = build(num_files, peers)
+
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del index
+
+    return (elapsed, size)
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_peers = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    peers = [
+        '{:08x}-0000-4000-8000-{:012x}'.format(i, i)
+        for i in range(num_peers)
+    ]
+
+    print("{} files, {} peers".format(num_files, num_peers))
+    print("{:<12} {:>10} {:>12} {:>12}".format(
+        'entries', 'time (s)', 'memory (MB)', 'bytes/file'
+    ))
+
+    for name, build in (('dict', build_dicts), ('IndexEntry', build_entries)):
+        elapsed, size = measure(build, num_files, peers)
+
+        print("{:<12} {:>10.3f} {:>12.1f} {:>12.0f}".format(
+            name, elapsed, size / 2 ** 20, size / num_files
+        ))
+
+
+if __name__ == '__main__':
+    main()
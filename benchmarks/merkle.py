@@ -0,0 +1,162 @@
+"""
+Measure the index exchange traffic between two peers whose indexes
+differ in a few files.
+
+Usage:
+    python benchmarks/merkle.py [number_of_files] [number_of_changed_files]
+
+Two `RemoteStore`s are connected through in-memory messangers and the
+bytes sent by both are counted for:
+    - the full index exchange (MSG_INDEX, used with peers without the
+      'merkle' capability);
+    - the Merkle tree exchange, which walks down only the directories
+      whose hashes differ.
+The files are spread over two directory levels with 100 entries each.
+"""
+import collections
+import os
+import sys
+import tempfile
+import time
+import msgpack
+
+from unittest.mock import Mock
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+import bintools
+import syncall
+
+from events import Event
+from syncall.index_entry import msgpack_default
+
+
+class PairedMessanger:
+    def __init__(self, my_uuid, remote_uuid):
+        self.address = ('127.0.0.1', 0)
+        self.my_uuid = my_uuid
+        self.remote_uuid = remote_uuid
+
+        self.disconnected = Event()
+        self.packet_received = Event()
+
+        self.remote = None
+        self.queue = collections.deque()
+        self.sent_bytes = 0
+        self.sent_packets = 0
+
+    def start_receiving(self):
+        pass
+
+    def send(self, data):
+        packet = msgpack.packb(data, default=msgpack_default)
+
+        self.sent_bytes += len(packet)
+        self.sent_packets += 1
+        self.remote.queue.append(bintools.decode_object(
+            msgpack.unpackb(packet),
+            except_keys=('hash', 'binary_data', 'checksums')
+        ))
+
+
+def create_index(num_files):
+    return {
+        'dir{}/sub{}/file{}'.format(i // 10000, i // 100 % 100, i): {
+            'last_update': 1400000000 + i,
+            'last_update_location': 'uuid1',
+            'hash': os.urandom(16),
+            'hash_algorithm': 'md5',
+            'sync_log': {'uuid1': 1400000000 + i, 'uuid2': 1400000000 + i}
+        }
+        for i in range(num_files)
+    }
+
+
+def create_remote(temp_dir, uuid, remote_uuid, index):
+    directory = syncall.Directory(uuid, temp_dir, load_index=False)
+    directory.transfer_manager = Mock()
+
+    for file_name, file_data in index.items():
+        directory._index[file_name] = file_data
+
+    return syncall.RemoteStore(
+        PairedMessanger(uuid, remote_uuid),
+        directory
+    )
+
+
+def exchange(index1, index2, capabilities):
+    with tempfile.TemporaryDirectory() as temp_dir1, \
+            tempfile.TemporaryDirectory() as temp_dir2:
+        remote1 = create_remote(temp_dir1, 'uuid1', 'uuid2', index1)
+        remote2 = create_remote(temp_dir2, 'uuid2', 'uuid1', index2)
+        messangers = (remote1.messanger, remote2.messanger)
+
+        remote1.messanger.remote = remote2.messanger
+        remote2.messanger.remote = remote1.messanger
+
+        # Build the Merkle trees before measuring
+        remote1.directory.get_merkle_root()
+        remote2.directory.get_merkle_root()
+
+        start = time.perf_counter()
+
+        for remote in (remote1, remote2):
+            remote._packet_received({
+                'type': syncall.remote_store.MSG_HELLO,
+                'hash_algorithms': ['md5'],
+                'capabilities': capabilities
+            })
+
+        while any(messanger.queue for messanger in messangers):
+            for messanger in messangers:
+                while messanger.queue:
+                    messanger.packet_received.notify(
+                        messanger.queue.popleft()
+                    )
+
+        elapsed = time.perf_counter() - start
+
+        assert remote1.remote_index == index2
+        assert remote2.remote_index == index1
+
+        return (
+            elapsed,
+            sum(messanger.sent_bytes for messanger in messangers),
+            sum(messanger.sent_packets for messanger in messangers)
+        )
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_changed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    index1 = create_index(num_files)
+    index2 = dict(index1)
+
+    for i in range(num_changed):
+        file_name = 'dir0/sub0/file{}'.format(i)
+        index2[file_name] = dict(
+            index2[file_name],
+            last_update=1500000000,
+            last_update_location='uuid2',
+            hash=os.urandom(16)
+        )
+
+    print("{} files, {} changed".format(num_files, num_changed))
+    print("{:<12} {:>10} {:>14} {:>9}".format(
+        'exchange', 'time (s)', 'bytes', 'packets'
+    ))
+
+    for name, capabilities in (('full index', []), ('merkle', ['merkle'])):
+        elapsed, sent_bytes, packets = exchange(index1, index2, capabilities)
+
+        print("{:<12} {:>10.3f} {:>14} {:>9}".format(
+            name, elapsed, sent_bytes, packets
+        ))
+
+
+if __name__ == '__main__':
+    main()
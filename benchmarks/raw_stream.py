@@ -0,0 +1,111 @@
+"""
+Measure the throughput of sending a new file (one the receiver has no
+basis for) as MSG_BLOCK_DATA messages and as a raw stream.
+
+Usage:
+    python benchmarks/raw_stream.py [file_size_in_mb] [block_size]
+
+Two `Messanger`s are connected through a local socket pair. The block
+messages are the literal blocks of `block_size` bytes sent when the
+receiver returns no checksums, the raw stream is a single MSG_RAW_DATA
+followed by the file contents sent with `os.sendfile`. The receiver
+writes the data to a temporary file in both cases.
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+import syncall
+
+from syncall.transfers import FileTransfer
+
+
+def create_messangers(output_file):
+    sender_socket, receiver_socket = socket.socketpair()
+
+    sender = syncall.Messanger(sender_socket, ('local', 0), 'a', 'b')
+    receiver = syncall.Messanger(receiver_socket, ('local', 0), 'b', 'a')
+    done = threading.Event()
+
+    def packet_received(data):
+        if data['type'] == FileTransfer.MSG_BLOCK_DATA:
+            output_file.write(data['binary_data'])
+        elif data['type'] == FileTransfer.MSG_RAW_DATA:
+            receiver.receive_raw(output_file, data['size'])
+        elif data['type'] == FileTransfer.MSG_DONE:
+            done.set()
+
+    receiver.packet_received += packet_received
+    receiver.start_receiving()
+
+    return sender, receiver, done
+
+
+def send_blocks(sender, file, file_size, block_size):
+    for block in iter(lambda: file.read(block_size), b''):
+        sender.send({
+            'type': FileTransfer.MSG_BLOCK_DATA,
+            'binary_data': block
+        })
+
+
+def send_raw(sender, file, file_size, block_size):
+    sender.send({
+        'type': FileTransfer.MSG_RAW_DATA,
+        'size': file_size
+    })
+    sender.send_file(file, file_size)
+
+
+def measure(send, path, file_size, block_size):
+    with tempfile.TemporaryFile() as output_file, open(path, 'rb') as file:
+        sender, receiver, done = create_messangers(output_file)
+
+        start = time.perf_counter()
+
+        send(sender, file, file_size, block_size)
+        sender.send({'type': FileTransfer.MSG_DONE})
+        done.wait()
+
+        elapsed = time.perf_counter() - start
+
+        sender.disconnect()
+        receiver.join()
+        sender.socket.close()
+
+        assert output_file.tell() == file_size
+
+    return elapsed
+
+
+def main():
+    file_size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 2 ** 28
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+
+    with tempfile.NamedTemporaryFile() as file:
+        for _ in range(file_size // 2 ** 20):
+            file.write(os.urandom(2 ** 20))
+        file.flush()
+
+        print("{} MB file, {} byte blocks".format(
+            file_size // 2 ** 20, block_size
+        ))
+        print("{:<14} {:>10} {:>10}".format('mode', 'time (s)', 'MB/s'))
+
+        for name, send in (('blocks', send_blocks), ('raw stream', send_raw)):
+            elapsed = measure(send, file.name, file_size, block_size)
+
+            print("{:<14} {:>10.3f} {:>10.1f}".format(
+                name, elapsed, file_size / 2 ** 20 / elapsed
+            ))
+
+
+if __name__ == '__main__':
+    main()
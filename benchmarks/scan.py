@@ -0,0 +1,133 @@
+"""
+Compare the legacy os.walk + getmtime index scan with the scandir scanner.
+
+Usage:
+    python benchmarks/scan.py [number_of_files]
+
+Two rescans are measured on a tree where every file has been touched
+(mtime changed, content unchanged) since it was indexed:
+    - the legacy scan stats each file twice and hashes all touched files
+      again on every rescan, because a matching hash never moves
+      `last_update` forward;
+    - the scandir scanner takes the stat from the DirEntry and hashes the
+      touched files once, after which their fingerprint matches.
+
+stat calls are counted by wrapping `os.stat`; the scandir scanner makes
+exactly one (cached) DirEntry.stat() call per file instead.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from unittest.mock import patch
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, '..'))
+sys.path.append(os.path.join(CURRENT_DIR, '..', 'libs'))
+
+import bintools
+import syncall
+
+
+def create_tree(top, num_files, files_per_dir=100):
+    for i in range(num_files):
+        dir_path = os.path.join(top, 'dir{}'.format(i // files_per_dir))
+        os.makedirs(dir_path, exist_ok=True)
+
+        with open(os.path.join(dir_path, 'file{}'.format(i)), 'w') as file:
+            file.write('content of file {}'.format(i))
+
+
+def touch_tree(top):
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def legacy_scan(top, index):
+    """ The scanning loop used before the scandir scanner """
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            file_data = index.setdefault(file_path, dict())
+
+            if not file_data:
+                file_data['last_update'] = int(os.path.getmtime(file_path))
+                file_data['hash'] = bintools.hash_file(file_path)
+
+            elif int(os.path.getmtime(file_path)) > file_data['last_update']:
+                file_hash = bintools.hash_file(file_path)
+
+                if file_data['hash'] != file_hash:
+                    file_data['last_update'] = int(
+                        os.path.getmtime(file_path)
+                    )
+                    file_data['hash'] = file_hash
+
+
+class Counter:
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.func(*args, **kwargs)
+
+
+def measure(scan, num_files):
+    stat = Counter(os.stat)
+    hash_file = Counter(bintools.hash_file)
+
+    with patch('os.stat', stat), patch('bintools.hash_file', hash_file):
+        start = time.perf_counter()
+        scan()
+        elapsed = time.perf_counter() - start
+
+    return (
+        elapsed,
+        stat.calls / num_files,
+        hash_file.calls / num_files
+    )
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    with tempfile.TemporaryDirectory() as top:
+        create_tree(top, num_files)
+
+        legacy_index = dict()
+        legacy_scan(top, legacy_index)
+
+        directory = syncall.Directory('uuid', top, load_index=False)
+        directory.update_index(save_index=False)
+
+        touch_tree(top)
+
+        print("{} files, all touched since indexing".format(num_files))
+        print("{:<22} {:>10} {:>12} {:>12}".format(
+            'scan', 'time (s)', 'stat/file', 'hashes/file'
+        ))
+
+        for rescan in (1, 2):
+            results = (
+                ('legacy os.walk', lambda: legacy_scan(top, legacy_index)),
+                ('scandir scanner', lambda: directory.update_index(
+                    save_index=False
+                ))
+            )
+
+            for name, scan in results:
+                elapsed, stats, hashes = measure(scan, num_files)
+
+                print("{:<22} {:>10.3f} {:>12.2f} {:>12.2f}".format(
+                    '{} #{}'.format(name, rescan), elapsed, stats, hashes
+                ))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 import hashlib
+import os
+import threading
 
 
 def decode_object(obj, encoding='utf-8', except_keys=tuple()):
@@ -32,16 +34,124 @@ def decode_object(obj, encoding='utf-8', except_keys=tuple()):
         return obj
 
 
-def hash_file(file_path):
-    hash = hashlib.md5()
+# Supported content hash algorithms, in order of preference. The order is
+# the same for all peers, see `negotiate_hash_algorithm`.
+HASH_ALGORITHMS = {
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+    'md5': hashlib.md5
+}
 
-    with open(file_path, 'rb') as file:
-        while True:
-            data = file.read(8192)
 
-            if not data:
-                break
+def new_hash(algorithm='md5'):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError("Unsupported hash algorithm {}".format(algorithm))
 
-            hash.update(data)
+    return HASH_ALGORITHMS[algorithm]()
 
-    return hash.digest()
+
+def negotiate_hash_algorithm(local_algorithms, remote_algorithms):
+    """
+    Return the first algorithm of HASH_ALGORITHMS which is in both
+    `local_algorithms` and `remote_algorithms`, or None if there's no
+    such one. Both peers get the same one whatever their own preferences.
+    """
+    for algorithm in HASH_ALGORITHMS:
+        if algorithm in local_algorithms and algorithm in remote_algorithms:
+            return algorithm
+
+    return None
+
+
+# Chunk sizes for reading files with `hash_file`
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# Files smaller than this are read with a single read call, so they are
+# hashed without readahead/page cache advice (it would only add syscalls)
+FADVISE_THRESHOLD = MAX_CHUNK_SIZE
+
+_buffers = threading.local()
+
+
+def get_chunk_size(file_size):
+    """
+    Return the read size for hashing a file of the given size:
+    the file size rounded up to a power of two, between
+    MIN_CHUNK_SIZE and MAX_CHUNK_SIZE.
+    """
+    chunk_size = 1 << max(file_size - 1, 0).bit_length()
+
+    return min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, chunk_size))
+
+
+def _get_buffer():
+    """
+    Return a buffer of MAX_CHUNK_SIZE bytes which is reused
+    by all `hash_file` calls on the current thread.
+    """
+    buffer = getattr(_buffers, 'buffer', None)
+
+    if buffer is None:
+        buffer = _buffers.buffer = memoryview(bytearray(MAX_CHUNK_SIZE))
+
+    return buffer
+
+
+def _fadvise(fd, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+def _hash_read(hashes, file, chunk_size):
+    buffer = _get_buffer()[:chunk_size]
+
+    while True:
+        length = file.readinto(buffer)
+
+        if not length:
+            break
+
+        for hash in hashes:
+            hash.update(buffer[:length])
+
+
+def hash_file(file_path, algorithm='md5'):
+    """
+    Return the digest of the file's content.
+    """
+    return hash_file_algorithms(file_path, [algorithm])[algorithm]
+
+
+def hash_file_algorithms(file_path, algorithms):
+    """
+    Return {<algorithm>: <digest>} of the file's content in each of
+    `algorithms`, reading the file once.
+
+    Reads into a reused buffer with a chunk size based on the file size.
+    Files bigger than a single read are read with sequential readahead
+    advice and dropped from the page cache afterwards so hashing a whole
+    directory doesn't evict other cached data.
+
+    Files aren't memory mapped as they can be truncated while they're
+    hashed, and accessing a mapping beyond the end of the file kills the
+    process with SIGBUS.
+    """
+    hashes = {algorithm: new_hash(algorithm) for algorithm in algorithms}
+
+    with open(file_path, 'rb', buffering=0) as file:
+        fd = file.fileno()
+        size = os.fstat(fd).st_size
+        advise = size >= FADVISE_THRESHOLD
+
+        if advise:
+            _fadvise(fd, 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+
+        _hash_read(hashes.values(), file, get_chunk_size(size))
+
+        if advise:
+            _fadvise(fd, 0, 0, getattr(os, 'POSIX_FADV_DONTNEED', 0))
+
+    return {algorithm: hash.digest() for algorithm, hash in hashes.items()}
@@ -0,0 +1,147 @@
+"""
+Minimal ctypes binding to the Linux inotify API.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+
+READ_BUFFER_SIZE = 64 * 1024
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    libc.inotify_init1.argtypes = (ctypes.c_int,)
+    libc.inotify_init1.restype = ctypes.c_int
+    libc.inotify_add_watch.argtypes = (
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32
+    )
+    libc.inotify_add_watch.restype = ctypes.c_int
+    libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+    libc.inotify_rm_watch.restype = ctypes.c_int
+
+    return libc
+
+_libc = _load_libc()
+
+
+def is_supported():
+    return _libc is not None
+
+
+def parse_events(data):
+    """
+    Generator of (wd, mask, cookie, name) tuples for
+    the raw event data read from an inotify file descriptor.
+    """
+    offset = 0
+
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+
+        yield (wd, mask, cookie, os.fsdecode(name))
+
+
+class Inotify:
+    """ A non-blocking inotify instance. """
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+
+        self.fd = _libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails if the watch was already removed by the kernel (IN_IGNORED)
+        return _libc.inotify_rm_watch(self.fd, wd) == 0
+
+    def read_events(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for events and return a list of
+        (wd, mask, cookie, name) tuples. Return an empty list on timeout.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+
+        if not readable:
+            return []
+
+        data = b''
+        while True:
+            try:
+                chunk = os.read(self.fd, READ_BUFFER_SIZE)
+            except BlockingIOError:
+                break
+
+            if not chunk:
+                break
+
+            data += chunk
+
+        return list(parse_events(data))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,5 +1,7 @@
 import unittest
+import hashlib
 import os
+import tempfile
 
 import bintools
 
@@ -13,6 +15,87 @@ class BintoolsTests(unittest.TestCase):
 
         self.assertEqual(file_hash, file_hash_known)
 
+    def test_hash_file_blake2b(self):
+        file_hash = bintools.hash_file(
+            self.TEST_DIR + '/to_be_hashed',
+            'blake2b'
+        )
+        file_hash_known = bytes.fromhex(
+            'e2fdfdeaaa674bec0cc60b13c99fa4bc'
+            'd044e17612716dbadbbde30ff41c4c36'
+        )
+
+        self.assertEqual(file_hash, file_hash_known)
+
+    def test_get_chunk_size(self):
+        self.assertEqual(bintools.get_chunk_size(0), bintools.MIN_CHUNK_SIZE)
+        self.assertEqual(
+            bintools.get_chunk_size(1000),
+            bintools.MIN_CHUNK_SIZE
+        )
+        self.assertEqual(bintools.get_chunk_size(300 * 1024), 512 * 1024)
+        self.assertEqual(
+            bintools.get_chunk_size(10 ** 10),
+            bintools.MAX_CHUNK_SIZE
+        )
+
+    def test_hash_file_sizes(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for size in (0, 1, 70000, 3 * bintools.MAX_CHUNK_SIZE + 5):
+                path = os.path.join(temp_dir, str(size))
+                data = os.urandom(size)
+
+                with open(path, 'wb') as file:
+                    file.write(data)
+
+                self.assertEqual(
+                    bintools.hash_file(path),
+                    hashlib.md5(data).digest()
+                )
+
+    def test_hash_file_algorithms(self):
+        with open(self.TEST_DIR + '/to_be_hashed', 'rb') as file:
+            data = file.read()
+
+        self.assertEqual(
+            bintools.hash_file_algorithms(
+                self.TEST_DIR + '/to_be_hashed',
+                ['md5', 'blake2b']
+            ),
+            {
+                'md5': hashlib.md5(data).digest(),
+                'blake2b': hashlib.blake2b(data, digest_size=32).digest()
+            }
+        )
+
+    def test_hash_file_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            bintools.hash_file(self.TEST_DIR + '/to_be_hashed', 'unknown')
+
+    def test_negotiate_hash_algorithm(self):
+        self.assertEqual(
+            bintools.negotiate_hash_algorithm(
+                ['blake2b', 'md5'],
+                ['md5', 'blake2b']
+            ),
+            'blake2b'
+        )
+        self.assertEqual(
+            bintools.negotiate_hash_algorithm(['md5', 'blake2b'], ['md5']),
+            'md5'
+        )
+        # The same on both sides whatever their preferences
+        self.assertEqual(
+            bintools.negotiate_hash_algorithm(
+                ['md5', 'blake2b'],
+                ['blake2b', 'md5']
+            ),
+            'blake2b'
+        )
+        self.assertIsNone(
+            bintools.negotiate_hash_algorithm(['blake2b'], ['sha1'])
+        )
+
     def test_decode_object(self):
         obj = {
             "key_one".encode('utf-8'): [
@@ -0,0 +1,53 @@
+import unittest
+import os
+import tempfile
+
+import inotify
+
+
+@unittest.skipUnless(inotify.is_supported(), "inotify is not supported")
+class InotifyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.inotify = inotify.Inotify()
+
+    def tearDown(self):
+        self.inotify.close()
+        self.temp_dir.cleanup()
+
+    def test_parse_events(self):
+        data = inotify.EVENT_HEADER.pack(1, inotify.IN_CREATE, 0, 8) + \
+            b'file\0\0\0\0' + \
+            inotify.EVENT_HEADER.pack(2, inotify.IN_DELETE_SELF, 0, 0)
+
+        self.assertEqual(list(inotify.parse_events(data)), [
+            (1, inotify.IN_CREATE, 0, 'file'),
+            (2, inotify.IN_DELETE_SELF, 0, '')
+        ])
+
+    def test_read_timeout(self):
+        self.inotify.add_watch(self.temp_dir.name, inotify.IN_CREATE)
+
+        self.assertEqual(self.inotify.read_events(0), [])
+
+    def test_events(self):
+        wd = self.inotify.add_watch(
+            self.temp_dir.name,
+            inotify.IN_CREATE | inotify.IN_CLOSE_WRITE
+        )
+
+        with open(os.path.join(self.temp_dir.name, 'file'), 'w') as file:
+            file.write('test')
+
+        events = self.inotify.read_events(1)
+
+        self.assertIn((wd, inotify.IN_CREATE, 0, 'file'), events)
+        self.assertIn((wd, inotify.IN_CLOSE_WRITE, 0, 'file'), events)
+
+    def test_add_watch_error(self):
+        with self.assertRaises(OSError):
+            self.inotify.add_watch(
+                os.path.join(self.temp_dir.name, 'missing'),
+                inotify.IN_CREATE
+            )
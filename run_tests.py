@@ -16,6 +16,7 @@ if __name__ == '__main__':
     from tests.pathext import *
     from tests.events import *
     from tests.bintools import *
+    from tests.inotify import *
 
     from syncall_tests import *
 
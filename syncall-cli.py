@@ -7,12 +7,9 @@ CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(CURRENT_DIR + '/libs')
 
 import syncall
+import inotify
 
 
-# Setup logging
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-
 logging.CONSOLE = LEVEL_CONSOLE_LOG = 15
 logging.addLevelName(LEVEL_CONSOLE_LOG, "CONSOLE")
 
@@ -30,14 +27,6 @@ class ConsoleFormatter(logging.Formatter):
 
         return super().format(record)
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-
-formatter = ConsoleFormatter()
-console_handler.setFormatter(formatter)
-
-logger.addHandler(console_handler)
-
 
 # Add custom logging for console
 def log_console(self, message, *args, **kws):
@@ -45,82 +34,117 @@ def log_console(self, message, *args, **kws):
         self._log(LEVEL_CONSOLE_LOG, message, args, **kws)
 logging.Logger.console = log_console
 
-# End logging config
-
-CONFIG_DIR = os.environ['HOME'] + '/.syncall'
-SHARE_DIR = CONFIG_DIR + '/shared/'
-
-os.makedirs(CONFIG_DIR, exist_ok=True)
-os.makedirs(SHARE_DIR, exist_ok=True)
-
-uuid = syncall.get_uuid(CONFIG_DIR + '/.uuid')
-
-share_dir_obj = syncall.Directory(uuid, SHARE_DIR,
-                                  create_temp_dir=True)
-share_dir_obj.update_index()
-
-network_discovery = syncall.NetworkDiscovery(
-    syncall.DEFAULT_PORT,
-    syncall.VERSION,
-    uuid
-)
-network_discovery.start_listening()
-
-connection_listener = syncall.ConnectionListener(
-    uuid,
-    syncall.DEFAULT_PORT
-)
-transfer_listener = syncall.ConnectionListener(
-    uuid,
-    syncall.DEFAULT_TRANSFER_PORT
-)
-
-store_manager = syncall.RemoteStoreManager(
-    network_discovery,
-    connection_listener,
-    transfer_listener,
-    share_dir_obj,
-    uuid
-)
-
-connection_listener.start()
-transfer_listener.start()
-
-
-def shutdown():
-    """ Stop the listener threads and remote connections on shutdown """
-    network_discovery.shutdown()
-    connection_listener.shutdown()
-    transfer_listener.shutdown()
-    store_manager.shutdown()
-    share_dir_obj.clear_temp_dir()
-
-
-try:
-    while True:
-        cmd = input()
-
-        if cmd.lower() in ('exit', 'quit', 'x', 'q'):
-            break
-        elif len(cmd) == 0:
-            continue
-        elif cmd.lower() == 'scan':
-            network_discovery.request()
-        elif cmd.lower() == 'index':
-            share_dir_obj.update_index(force=True)
-
-            print(share_dir_obj._index)
-            print(
-                "Total number of files: {}"
-                .format(len(share_dir_obj._index))
-            )
-        elif cmd.lower() == 'showindex':
-            print(share_dir_obj._index)
-            print(
-                "Total number of files: {}"
-                .format(len(share_dir_obj._index))
-            )
-        else:
-            print("Unknown command '" + cmd + "'")
-finally:
-    shutdown()
+
+def setup_logging():
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.DEBUG)
+
+    formatter = ConsoleFormatter()
+    console_handler.setFormatter(formatter)
+
+    logger.addHandler(console_handler)
+
+
+def main():
+    """
+    Run the daemon. Only called when the script is run directly, as the
+    delta worker processes (started with 'spawn') import it again.
+    """
+    setup_logging()
+
+    CONFIG_DIR = os.environ['HOME'] + '/.syncall'
+    SHARE_DIR = CONFIG_DIR + '/shared/'
+
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    os.makedirs(SHARE_DIR, exist_ok=True)
+
+    uuid = syncall.get_uuid(CONFIG_DIR + '/.uuid')
+
+    share_dir_obj = syncall.Directory(uuid, SHARE_DIR,
+                                      create_temp_dir=True,
+                                      hash_workers=os.cpu_count() or 1,
+                                      hash_algorithm='blake2b',
+                                      warm_checksum_cache=True,
+                                      delta_workers=os.cpu_count() or 1)
+    share_dir_obj.update_index()
+
+    if inotify.is_supported():
+        watcher = syncall.DirectoryWatcher(share_dir_obj)
+        watcher.start()
+    else:
+        watcher = None
+
+    network_discovery = syncall.NetworkDiscovery(
+        syncall.DEFAULT_PORT,
+        syncall.VERSION,
+        uuid
+    )
+    network_discovery.start_listening()
+
+    connection_listener = syncall.ConnectionListener(
+        uuid,
+        syncall.DEFAULT_PORT
+    )
+    transfer_listener = syncall.ConnectionListener(
+        uuid,
+        syncall.DEFAULT_TRANSFER_PORT
+    )
+
+    store_manager = syncall.RemoteStoreManager(
+        network_discovery,
+        connection_listener,
+        transfer_listener,
+        share_dir_obj,
+        uuid
+    )
+
+    connection_listener.start()
+    transfer_listener.start()
+
+    def shutdown():
+        """ Stop the listener threads and remote connections on shutdown """
+        if watcher is not None:
+            watcher.shutdown()
+
+        network_discovery.shutdown()
+        connection_listener.shutdown()
+        transfer_listener.shutdown()
+        store_manager.shutdown()
+        share_dir_obj.delta_engine.shutdown()
+        share_dir_obj.clear_temp_dir()
+
+    try:
+        while True:
+            cmd = input()
+
+            if cmd.lower() in ('exit', 'quit', 'x', 'q'):
+                break
+            elif len(cmd) == 0:
+                continue
+            elif cmd.lower() == 'scan':
+                network_discovery.request()
+            elif cmd.lower() == 'index':
+                share_dir_obj.update_index(force=True)
+
+                print(share_dir_obj._index)
+                print(
+                    "Total number of files: {}"
+                    .format(len(share_dir_obj._index))
+                )
+            elif cmd.lower() == 'showindex':
+                print(share_dir_obj._index)
+                print(
+                    "Total number of files: {}"
+                    .format(len(share_dir_obj._index))
+                )
+            else:
+                print("Unknown command '" + cmd + "'")
+    finally:
+        shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,3 +10,4 @@ from syncall.remote_store_manager import RemoteStoreManager
 from syncall.transfers import TransferManager
 from syncall.commons import generate_uuid, get_uuid
 from syncall.index import Directory, IndexDiff
+from syncall.watcher import DirectoryWatcher
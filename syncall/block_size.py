@@ -0,0 +1,84 @@
+import math
+import threading
+
+from collections import OrderedDict
+
+
+# Limits of the negotiated block size. Smaller blocks find more matches
+# but need more checksums, bigger ones make the checksum list shorter.
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 128 * 1024
+
+# Files smaller than this are sent whole, a delta can't save anything
+# worth the checksums
+MIN_DELTA_SIZE = 4096
+
+# Block size of the transfers which look the blocks up in all the local
+# files (dedup mode), the block index has the files' blocks of this size
+# (see `ChecksumCache.warm`)
+DEDUP_BLOCK_SIZE = 32 * 1024
+
+# Part of the data which has to be sent as literal bytes above which
+# the last delta of a file is considered ineffective
+INEFFECTIVE_DELTA_RATIO = 0.5
+
+# Factor by which the block size is increased for files whose last delta
+# was ineffective
+INEFFECTIVE_DELTA_FACTOR = 4
+
+
+def choose_block_size(file_size, literal_ratio=None):
+    """
+    Return the block size for the delta transfer of a file of
+    `file_size` bytes.
+
+    Like rsync, it's the square root of the file size (rounded up to a
+    power of two and limited to MIN_BLOCK_SIZE..MAX_BLOCK_SIZE), so the
+    number of checksums grows with the square root of the file size too.
+    If the last delta of the file sent mostly literal data
+    (`literal_ratio`) the block size is increased, as small blocks
+    didn't help.
+    """
+    block_size = math.isqrt(max(file_size, 1))
+
+    if literal_ratio is not None and literal_ratio > INEFFECTIVE_DELTA_RATIO:
+        block_size *= INEFFECTIVE_DELTA_FACTOR
+
+    block_size = 1 << (block_size - 1).bit_length()
+
+    return max(MIN_BLOCK_SIZE, min(block_size, MAX_BLOCK_SIZE))
+
+
+def is_valid_block_size(block_size):
+    return isinstance(block_size, int) and \
+        MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE
+
+
+class DeltaHistory:
+    """
+    Literal data ratio of the last delta sent for each file, used to
+    adapt the block size of the next transfer of the file.
+
+    Only the last `max_size` files are remembered.
+    """
+
+    def __init__(self, max_size=10000):
+        self.lock = threading.Lock()
+        self.max_size = max_size
+
+        self.ratios = OrderedDict()
+
+    def get(self, file_name):
+        with self.lock:
+            return self.ratios.get(file_name)
+
+    def add(self, file_name, literal_ratio):
+        with self.lock:
+            self.ratios.pop(file_name, None)
+            self.ratios[file_name] = literal_ratio
+
+            while len(self.ratios) > self.max_size:
+                self.ratios.popitem(last=False)
+
+    def get_block_size(self, file_name, file_size):
+        return choose_block_size(file_size, self.get(file_name))
@@ -0,0 +1,279 @@
+import logging
+import os
+import sqlite3
+import threading
+import msgpack
+
+from syncall.block_size import choose_block_size, DEDUP_BLOCK_SIZE, \
+    MIN_DELTA_SIZE
+from syncall.delta import PythonDeltaEngine
+
+
+class ChecksumCache:
+    """
+    Persistent cache of the rsync block checksums of basis files, so
+    they aren't computed again for every transfer of the same file.
+
+    Entries are keyed by (file name, block size) and are only used while
+    the file's content hash in the index and its size, inode and
+    modification time on disk are the ones they were computed with.
+    `invalidate` removes the entries of changed files.
+
+    The strong hashes of the cached blocks are also indexed, so blocks
+    can be found in any of the cached files with `find_block`. Found
+    blocks may be stale and should be verified when read.
+
+    The entries are kept in an SQLite database (`path`), which is
+    opened on first use. If it can't be used the checksums are computed
+    every time (by `delta_engine`).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS checksums (
+            name TEXT NOT NULL,
+            block_size INTEGER NOT NULL,
+            hash BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            checksums BLOB NOT NULL,
+            PRIMARY KEY (name, block_size)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS blocks (
+            strong BLOB NOT NULL,
+            length INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            block_size INTEGER NOT NULL,
+            offset INTEGER NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS blocks_strong ON blocks (strong);
+        CREATE INDEX IF NOT EXISTS blocks_name ON blocks (name);
+    """
+
+    # Smallest file warmed by `warm`, checksums of smaller files are
+    # cheap to compute when needed
+    WARM_MIN_SIZE = 1024 * 1024
+
+    def __init__(self, path, delta_engine=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+
+        if delta_engine is None:
+            delta_engine = PythonDeltaEngine()
+        self.delta_engine = delta_engine
+        self.lock = threading.Lock()
+
+        self._connection = None
+        self._disabled = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def __get_connection(self, create=True):
+        # Reads and deletes don't need to create the database
+        if self._connection is None and not create and \
+                not os.path.isfile(self.path):
+            return None
+
+        if self._connection is None and not self._disabled:
+            try:
+                self._connection = sqlite3.connect(
+                    self.path,
+                    check_same_thread=False,
+                    isolation_level=None
+                )
+                self._connection.execute('PRAGMA journal_mode = WAL')
+                self._connection.execute('PRAGMA synchronous = NORMAL')
+                self._connection.executescript(self.SCHEMA)
+            except sqlite3.Error as ex:
+                self.logger.error(
+                    "Can't open the checksum cache {}: {}"
+                    .format(self.path, ex)
+                )
+                self._connection = None
+                self._disabled = True
+
+        return self._connection
+
+    def close(self):
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def __get(self, file_name, block_size, file_hash, stat):
+        with self.lock:
+            connection = self.__get_connection(create=False)
+            if connection is None:
+                return None
+
+            row = connection.execute(
+                'SELECT checksums FROM checksums WHERE name = ? AND '
+                'block_size = ? AND hash = ? AND size = ? AND inode = ? '
+                'AND mtime_ns = ?',
+                (file_name, block_size, file_hash, stat.st_size,
+                 stat.st_ino, stat.st_mtime_ns)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return [tuple(checksum) for checksum in msgpack.unpackb(row[0])]
+
+    def __put(self, file_name, block_size, file_hash, stat, checksums):
+        blocks = [
+            (strong, min(block_size, stat.st_size - offset), file_name,
+             block_size, offset)
+            for offset, (weak, strong) in zip(
+                range(0, stat.st_size, block_size),
+                checksums
+            )
+        ]
+
+        with self.lock:
+            connection = self.__get_connection()
+            if connection is None:
+                return
+
+            with connection:
+                connection.execute('BEGIN')
+                connection.execute(
+                    'INSERT OR REPLACE INTO checksums (name, block_size, '
+                    'hash, size, inode, mtime_ns, checksums) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (file_name, block_size, file_hash, stat.st_size,
+                     stat.st_ino, stat.st_mtime_ns, msgpack.packb(checksums))
+                )
+                connection.execute(
+                    'DELETE FROM blocks WHERE name = ? AND block_size = ?',
+                    (file_name, block_size)
+                )
+                connection.executemany(
+                    'INSERT INTO blocks (strong, length, name, block_size, '
+                    'offset) VALUES (?, ?, ?, ?, ?)',
+                    blocks
+                )
+
+    def get_checksums(self, file_name, file_path, file_hash, block_size):
+        """
+        Return the list of (weak, strong) block checksums of a file
+        (as `pyrsync2.blockchecksums`) whose content hash in the index is
+        `file_hash`. They are computed only if they aren't cached.
+        """
+        stat = os.stat(file_path)
+
+        checksums = self.__get(file_name, block_size, file_hash, stat)
+        if checksums is not None:
+            self.hits += 1
+            return checksums
+
+        self.misses += 1
+
+        with open(file_path, 'rb') as file:
+            checksums = self.delta_engine.blockchecksums(file, block_size)
+
+        # Not cached if the file was changed while being read
+        new_stat = os.stat(file_path)
+        if (new_stat.st_size, new_stat.st_ino, new_stat.st_mtime_ns) == \
+                (stat.st_size, stat.st_ino, stat.st_mtime_ns):
+            self.__put(file_name, block_size, file_hash, stat, checksums)
+
+        return checksums
+
+    def invalidate(self, file_names):
+        """
+        Remove the cached checksums of the files in `file_names`.
+        """
+        with self.lock:
+            connection = self.__get_connection(create=False)
+            if connection is None:
+                return
+
+            with connection:
+                connection.execute('BEGIN')
+                for file_name in file_names:
+                    connection.execute(
+                        'DELETE FROM checksums WHERE name = ?',
+                        (file_name,)
+                    )
+                    connection.execute(
+                        'DELETE FROM blocks WHERE name = ?',
+                        (file_name,)
+                    )
+
+    def has_blocks(self, block_size=None):
+        """
+        Return True if any blocks (of `block_size` if it's given) are
+        cached.
+        """
+        with self.lock:
+            connection = self.__get_connection(create=False)
+            if connection is None:
+                return False
+
+            if block_size is None:
+                return connection.execute(
+                    'SELECT 1 FROM blocks LIMIT 1'
+                ).fetchone() is not None
+
+            return connection.execute(
+                'SELECT 1 FROM blocks WHERE block_size = ? LIMIT 1',
+                (block_size,)
+            ).fetchone() is not None
+
+    def find_block(self, strong, length):
+        """
+        Return the locations of the blocks of `length` bytes with the
+        strong hash `strong` in the cached files as a list of
+        (<file name>, <offset>) tuples.
+        """
+        with self.lock:
+            connection = self.__get_connection(create=False)
+            if connection is None:
+                return []
+
+            return connection.execute(
+                'SELECT DISTINCT name, offset FROM blocks '
+                'WHERE strong = ? AND length = ?',
+                (strong, length)
+            ).fetchall()
+
+    def warm(self, directory, index_items, block_size=None):
+        """
+        Compute the checksums of the files in `index_items`
+        ((file_name, file_data) tuples) which aren't cached yet: for the
+        files of at least `WARM_MIN_SIZE` bytes as transfer bases (with
+        the block size a transfer of the file would use without a
+        `block_size`), and for all files which aren't sent whole in
+        blocks of DEDUP_BLOCK_SIZE, so dedup transfers find their blocks
+        (`find_block`) even if they were never a basis.
+        """
+        for file_name, file_data in index_items:
+            size = file_data.get('size', 0)
+
+            if file_data.get('deleted') or 'hash' not in file_data or \
+                    size < MIN_DELTA_SIZE:
+                continue
+
+            block_sizes = [DEDUP_BLOCK_SIZE]
+
+            if size >= self.WARM_MIN_SIZE:
+                basis_block_size = block_size or choose_block_size(size)
+
+                if basis_block_size != DEDUP_BLOCK_SIZE:
+                    block_sizes.append(basis_block_size)
+
+            try:
+                for warm_block_size in block_sizes:
+                    self.get_checksums(
+                        file_name,
+                        directory.get_file_path(file_name),
+                        file_data['hash'],
+                        warm_block_size
+                    )
+            except OSError:
+                # Removed or not readable, it's computed when needed
+                pass
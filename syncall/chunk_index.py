@@ -0,0 +1,208 @@
+import logging
+import os
+import sqlite3
+import threading
+
+from syncall.chunking import chunk_file
+
+
+class ChunkIndex:
+    """
+    Persistent index of the content-defined chunks of the files of a
+    share, used by chunked transfers to find the chunks of a file which
+    are already available locally (in any file).
+
+    Like `ChecksumCache` the chunks of a file are only used while its
+    content hash in the index and its size, inode and modification time
+    on disk are the ones they were computed with, and `invalidate`
+    removes the chunks of changed files. Chunks found with `find_chunk`
+    may still be stale and should be verified when read.
+
+    The index is kept in an SQLite database (`path`), which is opened on
+    first use. If it can't be used the chunks are computed every time.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY,
+            hash BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS chunks (
+            name TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            id BLOB NOT NULL,
+            length INTEGER NOT NULL,
+            PRIMARY KEY (name, offset)
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS chunks_id ON chunks (id);
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.lock = threading.Lock()
+
+        self._connection = None
+        self._disabled = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def __get_connection(self, create=True):
+        # Reads and deletes don't need to create the database
+        if self._connection is None and not create and \
+                not os.path.isfile(self.path):
+            return None
+
+        if self._connection is None and not self._disabled:
+            try:
+                self._connection = sqlite3.connect(
+                    self.path,
+                    check_same_thread=False,
+                    isolation_level=None
+                )
+                self._connection.execute('PRAGMA journal_mode = WAL')
+                self._connection.execute('PRAGMA synchronous = NORMAL')
+                self._connection.executescript(self.SCHEMA)
+            except sqlite3.Error as ex:
+                self.logger.error(
+                    "Can't open the chunk index {}: {}"
+                    .format(self.path, ex)
+                )
+                self._connection = None
+                self._disabled = True
+
+        return self._connection
+
+    def close(self):
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def __get(self, file_name, file_hash, stat):
+        with self.lock:
+            connection = self.__get_connection(create=False)
+            if connection is None:
+                return None
+
+            row = connection.execute(
+                'SELECT 1 FROM files WHERE name = ? AND hash = ? AND '
+                'size = ? AND inode = ? AND mtime_ns = ?',
+                (file_name, file_hash, stat.st_size, stat.st_ino,
+                 stat.st_mtime_ns)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            return [
+                (bytes(chunk_id), length)
+                for chunk_id, length in connection.execute(
+                    'SELECT id, length FROM chunks WHERE name = ? '
+                    'ORDER BY offset',
+                    (file_name,)
+                )
+            ]
+
+    def __put(self, file_name, file_hash, stat, chunks):
+        rows = []
+        offset = 0
+
+        for chunk_id, length in chunks:
+            rows.append((file_name, offset, chunk_id, length))
+            offset += length
+
+        with self.lock:
+            connection = self.__get_connection()
+            if connection is None:
+                return
+
+            with connection:
+                connection.execute('BEGIN')
+                self.__delete(connection, (file_name,))
+
+                connection.execute(
+                    'INSERT INTO files (name, hash, size, inode, mtime_ns) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (file_name, file_hash, stat.st_size, stat.st_ino,
+                     stat.st_mtime_ns)
+                )
+                connection.executemany(
+                    'INSERT INTO chunks (name, offset, id, length) '
+                    'VALUES (?, ?, ?, ?)',
+                    rows
+                )
+
+    @staticmethod
+    def __delete(connection, file_names):
+        for file_name in file_names:
+            connection.execute(
+                'DELETE FROM files WHERE name = ?',
+                (file_name,)
+            )
+            connection.execute(
+                'DELETE FROM chunks WHERE name = ?',
+                (file_name,)
+            )
+
+    def get_chunks(self, file_name, file_path, file_hash):
+        """
+        Return the list of (<chunk id>, <length>) chunks of a file (as
+        `chunking.chunk_file`) whose content hash in the index is
+        `file_hash`. They are computed and indexed only if they aren't
+        indexed yet.
+        """
+        stat = os.stat(file_path)
+
+        chunks = self.__get(file_name, file_hash, stat)
+        if chunks is not None:
+            self.hits += 1
+            return chunks
+
+        self.misses += 1
+
+        with open(file_path, 'rb') as file:
+            chunks = chunk_file(file)
+
+        # Not indexed if the file was changed while being read
+        new_stat = os.stat(file_path)
+        if (new_stat.st_size, new_stat.st_ino, new_stat.st_mtime_ns) == \
+                (stat.st_size, stat.st_ino, stat.st_mtime_ns):
+            self.__put(file_name, file_hash, stat, chunks)
+
+        return chunks
+
+    def find_chunk(self, chunk_id):
+        """
+        Return the locations of the chunk `chunk_id` in the indexed files
+        as a list of (<file name>, <offset>, <length>) tuples.
+        """
+        with self.lock:
+            connection = self.__get_connection(create=False)
+            if connection is None:
+                return []
+
+            return connection.execute(
+                'SELECT name, offset, length FROM chunks WHERE id = ?',
+                (chunk_id,)
+            ).fetchall()
+
+    def invalidate(self, file_names):
+        """
+        Remove the chunks of the files in `file_names`.
+        """
+        with self.lock:
+            connection = self.__get_connection(create=False)
+            if connection is None:
+                return
+
+            with connection:
+                connection.execute('BEGIN')
+                self.__delete(connection, file_names)
@@ -0,0 +1,198 @@
+import hashlib
+
+from syncall.delta import FileBuffer, numpy
+
+
+# Content-defined chunking in the style of FastCDC: a chunk ends after
+# a byte where the gear hash of the last 32 bytes has all the bits of a
+# mask cleared. Chunks shorter than AVERAGE_CHUNK_SIZE use a mask with
+# more bits than longer ones (normalized chunking), so chunk sizes stay
+# close to the average. Both sides of a transfer must chunk the same
+# way, so these must not be changed.
+MIN_CHUNK_SIZE = 16 * 1024
+AVERAGE_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+
+# The highest bits of the hash depend on all 32 bytes
+MASK_HARD = 0xFFFFC000
+MASK_EASY = 0xFFFC0000
+
+HASH_MASK = 0xFFFFFFFF
+
+# Random 32 bit value for each byte value
+GEAR = tuple(
+    int.from_bytes(hashlib.md5(bytes([value])).digest()[:4], 'little')
+    for value in range(256)
+)
+
+# Bytes of the file hashed at once by NumPy
+SEGMENT_SIZE = 1024 * 1024
+
+
+def chunk_id(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def window_hash(data, end):
+    """
+    Gear hash of the 32 bytes of `data` before `end`.
+    """
+    value = 0
+
+    for byte in data[max(0, end - 32):end]:
+        value = ((value << 1) + GEAR[byte]) & HASH_MASK
+
+    return value
+
+
+def find_cut_python(data, start, hard_end, end):
+    """
+    Return the end of the chunk starting at `start`, checking the hash
+    after each byte from MIN_CHUNK_SIZE on.
+    """
+    position = start + MIN_CHUNK_SIZE
+    value = window_hash(data, position)
+
+    while True:
+        if position <= hard_end:
+            if value & MASK_HARD == 0:
+                return position
+        elif value & MASK_EASY == 0:
+            return position
+
+        if position >= end:
+            return end
+
+        value = ((value << 1) + GEAR[data[position]]) & HASH_MASK
+        position += 1
+
+
+def gear_hashes(data, start, count):
+    """
+    Return the gear hashes after each of the `count` bytes of `data`
+    from `start` as a NumPy array.
+
+    The hash after byte i is the sum of GEAR[data[i - k]] << k for k up
+    to 31, which is computed by doubling the summed window five times.
+    """
+    offset = max(0, start - 31)
+
+    hashes = numpy.array(GEAR, dtype=numpy.uint32)[numpy.frombuffer(
+        data,
+        dtype=numpy.uint8,
+        count=start + count - offset,
+        offset=offset
+    )]
+
+    shift = 1
+    while shift < 32:
+        hashes[shift:] += hashes[:-shift] << numpy.uint32(shift)
+        shift *= 2
+
+    return hashes[start - offset:]
+
+
+def cut_candidates(data):
+    """
+    Return the positions (chunk ends) after which the hash has the bits
+    of MASK_EASY and of MASK_HARD cleared, as two sorted arrays.
+    """
+    easy = []
+    hard = []
+
+    for start in range(0, len(data), SEGMENT_SIZE):
+        hashes = gear_hashes(
+            data,
+            start,
+            min(SEGMENT_SIZE, len(data) - start)
+        )
+
+        positions = numpy.flatnonzero(hashes & numpy.uint32(MASK_EASY) == 0)
+        easy.append(positions + start + 1)
+        hard.append(positions[
+            hashes[positions] & numpy.uint32(MASK_HARD) == 0
+        ] + start + 1)
+
+    if not easy:
+        return numpy.array([], dtype=numpy.int64), \
+            numpy.array([], dtype=numpy.int64)
+
+    return numpy.concatenate(easy), numpy.concatenate(hard)
+
+
+def first_candidate(candidates, start, end):
+    index = numpy.searchsorted(candidates, start)
+
+    if index < len(candidates) and candidates[index] <= end:
+        return int(candidates[index])
+
+    return None
+
+
+def chunk_ends(data):
+    """
+    Return the end offsets of the chunks of `data`.
+    """
+    size = len(data)
+    ends = []
+    start = 0
+
+    if numpy is not None:
+        easy, hard = cut_candidates(data)
+
+    while start < size:
+        if size - start <= MIN_CHUNK_SIZE:
+            end = size
+        else:
+            # Last chunk end which uses the hard mask and the maximum
+            hard_end = start + AVERAGE_CHUNK_SIZE - 1
+            max_end = min(start + MAX_CHUNK_SIZE, size)
+
+            if numpy is None:
+                end = find_cut_python(data, start, hard_end, max_end)
+            else:
+                end = first_candidate(
+                    hard,
+                    start + MIN_CHUNK_SIZE,
+                    hard_end
+                )
+
+                if end is None:
+                    end = first_candidate(easy, hard_end + 1, max_end)
+
+                if end is None:
+                    end = max_end
+
+        ends.append(end)
+        start = end
+
+    return ends
+
+
+def chunk_file(file):
+    """
+    Return the chunks of `file` as a list of (<chunk id>, <length>)
+    tuples.
+    """
+    chunks = []
+    buffer = FileBuffer(file)
+
+    while True:
+        buffer.fill(buffer.start + SEGMENT_SIZE + MAX_CHUNK_SIZE)
+        data = bytes(buffer.data)
+        start = 0
+
+        for end in chunk_ends(data):
+            # A chunk depends only on the MAX_CHUNK_SIZE bytes from its
+            # start, the ones cut by the end of the data are chunked again
+            # with the next segment
+            if not buffer.eof and start + MAX_CHUNK_SIZE > len(data):
+                break
+
+            chunks.append((chunk_id(data[start:end]), end - start))
+            start = end
+
+        if buffer.eof:
+            return chunks
+
+        buffer.discard(buffer.start + start)
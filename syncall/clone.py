@@ -0,0 +1,70 @@
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ioctl request of Linux reflinks (_IOW(0x94, 9, int)), which make the
+# destination share the source's data on copy-on-write file systems
+FICLONE = 0x40049409
+
+
+def reflink(source, destination):
+    if fcntl is None:
+        raise OSError("Reflinks are not supported")
+
+    fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+
+def copy_range(source, destination):
+    """
+    Copy `source` to `destination` with `copy_file_range`, which copies
+    in the kernel (or on the server of a network file system).
+    """
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError("copy_file_range is not supported")
+
+    remaining = os.fstat(source.fileno()).st_size
+
+    while remaining > 0:
+        copied = os.copy_file_range(
+            source.fileno(),
+            destination.fileno(),
+            remaining
+        )
+
+        if copied == 0:
+            raise OSError("The source file was truncated")
+
+        remaining -= copied
+
+
+def clone_file(source_path, destination_path):
+    """
+    Copy the file `source_path` to `destination_path` as a reflink if the
+    file system supports it, falling back to `copy_file_range` and to a
+    regular copy. Return the method used: 'reflink', 'copy_file_range'
+    or 'copy'.
+    """
+    with open(source_path, 'rb') as source, \
+            open(destination_path, 'wb') as destination:
+        try:
+            reflink(source, destination)
+            return 'reflink'
+        except OSError:
+            pass
+
+        try:
+            copy_range(source, destination)
+            return 'copy_file_range'
+        except OSError:
+            # Start over, part of the file may have been copied
+            source.seek(0)
+            destination.seek(0)
+            destination.truncate()
+
+        shutil.copyfileobj(source, destination)
+        return 'copy'
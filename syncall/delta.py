@@ -0,0 +1,546 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+import pyrsync2
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PythonDeltaEngine:
+    """
+    Block checksums and deltas computed by pyrsync2, one byte at a time.
+    """
+
+    def blockchecksums(self, file, block_size):
+        return list(pyrsync2.blockchecksums(file, blocksize=block_size))
+
+    def rsyncdelta(self, file, remote_checksums, block_size, max_buffer):
+        return pyrsync2.rsyncdelta(
+            file,
+            remote_checksums,
+            blocksize=block_size,
+            max_buffer=max_buffer
+        )
+
+
+class FileBuffer:
+    """
+    The part of a file from offset `start` which was read into `data`,
+    for reading a file sequentially in segments.
+
+    Files are read instead of memory mapped as they can be changed while
+    they're read: accessing a mapping beyond the end of a truncated file
+    kills the process with SIGBUS. A file which is changed just gives
+    data that doesn't match any version of it, like a read would.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.data = bytearray()
+        self.start = 0
+        self.eof = False
+
+    @property
+    def end(self):
+        return self.start + len(self.data)
+
+    def fill(self, end):
+        """
+        Read the file up to offset `end` or its end (`eof`).
+        """
+        while self.end < end and not self.eof:
+            data = self.file.read(end - self.end)
+
+            if data:
+                self.data += data
+            else:
+                self.eof = True
+
+    def discard(self, start):
+        """
+        Drop the data before offset `start`.
+        """
+        if start > self.start:
+            # Copied instead of resized in place, which fails while
+            # NumPy arrays refer to the data
+            self.data = self.data[start - self.start:]
+            self.start = start
+
+    def get(self, start, end):
+        return bytes(self.data[start - self.start:end - self.start])
+
+
+def literal_blocks(buffer, start, end, max_buffer):
+    for block_start in range(start, end, max_buffer):
+        yield buffer.get(block_start, min(block_start + max_buffer, end))
+
+
+class NumpyDeltaEngine:
+    """
+    Block checksums and deltas with the same results as pyrsync2 (and
+    wire compatible with it), with the weak checksums computed by NumPy.
+
+    The weak checksum of a window of block size B at offset o of the
+    data d is a | b << 16 where
+        a = sum(d[o:o + B])
+        b = sum((B - i) * d[o + i] for i in range(B))
+    For the delta they are computed for every offset at once from the
+    cumulative sums of d[j] and j * d[j]. The offsets whose weak checksum
+    may be one of the remote blocks' (looked up in a bit table indexed by
+    a hash of the checksum) are then checked with the strong hash from
+    left to right, like the rolling checksum would find them.
+    """
+
+    # Bytes of the file whose checksums are computed at once. It bounds
+    # the size of the temporary arrays and keeps the cumulative sums
+    # well within 64 bits.
+    SEGMENT_SIZE = 1024 * 1024
+
+    # Multiplier of the (Fibonacci) hash of the weak checksums
+    HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+    def blockchecksums(self, file, block_size):
+        checksums = []
+
+        buffer = FileBuffer(file)
+        weights = numpy.arange(block_size, 0, -1, dtype=numpy.int64)
+        segment_size = max(1, self.SEGMENT_SIZE // block_size) * block_size
+
+        while not buffer.eof:
+            buffer.fill(buffer.start + segment_size)
+            data = bytes(buffer.data)
+            count = len(data) // block_size
+
+            if count > 0:
+                blocks = numpy.frombuffer(
+                    data,
+                    dtype=numpy.uint8,
+                    count=count * block_size
+                ).reshape(count, block_size).astype(numpy.int64)
+
+                a = blocks.sum(axis=1)
+                b = blocks @ weights
+                del blocks
+
+                offset = 0
+                for weak in ((b << 16) | a).tolist():
+                    checksums.append((weak, hashlib.md5(
+                        data[offset:offset + block_size]
+                    ).digest()))
+                    offset += block_size
+
+            # Only the last segment can have a shorter block
+            tail = data[count * block_size:]
+            if tail:
+                checksums.append((
+                    pyrsync2.weakchecksum(tail)[0],
+                    hashlib.md5(tail).digest()
+                ))
+
+            buffer.discard(buffer.end)
+
+        return checksums
+
+    def __hash(self, weaks, hash_bits):
+        return (weaks.view(numpy.uint64) *
+                numpy.uint64(self.HASH_MULTIPLIER)) >> \
+            numpy.uint64(64 - hash_bits)
+
+    def __create_table(self, remote_weaks):
+        """
+        Return a bit table of the hashes of `remote_weaks`, with about 256
+        times more bits than checksums, and the number of bits of the
+        hashes.
+        """
+        hash_bits = max(16, min(len(remote_weaks).bit_length() + 8, 28))
+
+        table = numpy.zeros(1 << hash_bits, dtype=numpy.bool_)
+        table[self.__hash(remote_weaks, hash_bits)] = True
+
+        return table, hash_bits
+
+    def __find_candidates(self, data, start, count, block_size, table,
+                          hash_bits):
+        """
+        Return the offsets (from `start`, `count` of them) of the windows
+        whose weak checksum hash is in `table` and their checksums.
+        """
+        window = numpy.frombuffer(
+            data,
+            dtype=numpy.uint8,
+            count=count + block_size - 1,
+            offset=start
+        ).astype(numpy.int64)
+
+        positions = numpy.arange(len(window), dtype=numpy.int64)
+
+        sums = numpy.zeros(len(window) + 1, dtype=numpy.int64)
+        numpy.cumsum(window, out=sums[1:])
+
+        weighted_sums = numpy.zeros(len(window) + 1, dtype=numpy.int64)
+        numpy.cumsum(window * positions, out=weighted_sums[1:])
+        del window
+
+        offsets = positions[:count]
+        a = sums[block_size:block_size + count] - sums[:count]
+        b = (offsets + block_size) * a - (
+            weighted_sums[block_size:block_size + count] -
+            weighted_sums[:count]
+        )
+        weaks = (b << 16) | a
+
+        matches = table[self.__hash(weaks, hash_bits)]
+
+        return (offsets[matches] + start).tolist(), weaks[matches].tolist()
+
+    def rsyncdelta(self, file, remote_checksums, block_size, max_buffer):
+        """
+        Generator of the delta of `file` against the remote block
+        checksums: block indexes for the matched blocks and bytes for the
+        data in between, in chunks of at most `max_buffer` bytes.
+        """
+        signatures = dict()
+        for index, (weak, strong) in enumerate(remote_checksums):
+            signatures.setdefault(weak, []).append((index, strong))
+
+        # Weak checksums of a valid block size are well within 64 bits
+        remote_weaks = numpy.array(
+            [weak for weak in signatures if 0 <= weak < 2 ** 63],
+            dtype=numpy.int64
+        )
+
+        buffer = FileBuffer(file)
+
+        # Start of the data which isn't sent yet
+        position = 0
+
+        if len(remote_weaks) > 0:
+            table, hash_bits = self.__create_table(remote_weaks)
+
+            # Offset of the first window of the next segment
+            start = 0
+
+            while True:
+                buffer.fill(start + self.SEGMENT_SIZE + block_size - 1)
+                count = min(
+                    self.SEGMENT_SIZE,
+                    buffer.end - block_size + 1 - start
+                )
+
+                if count <= 0:
+                    break
+
+                if start + count > position:
+                    offsets, weaks = self.__find_candidates(
+                        buffer.data,
+                        start - buffer.start,
+                        count,
+                        block_size,
+                        table,
+                        hash_bits
+                    )
+
+                    for offset, weak in zip(offsets, weaks):
+                        offset += buffer.start
+
+                        if offset < position or weak not in signatures:
+                            continue
+
+                        strong = hashlib.md5(
+                            buffer.get(offset, offset + block_size)
+                        ).digest()
+
+                        for index, remote_strong in signatures[weak]:
+                            if remote_strong == strong:
+                                yield from literal_blocks(
+                                    buffer,
+                                    position,
+                                    offset,
+                                    max_buffer
+                                )
+                                yield index
+
+                                position = offset + block_size
+                                break
+
+                start += count
+
+                # The data before `start` can't be matched anymore, send
+                # the whole literal blocks of it (the same ones as when
+                # a block after it is matched)
+                if position < start:
+                    end = position + \
+                        (start - position) // max_buffer * max_buffer
+
+                    yield from literal_blocks(
+                        buffer,
+                        position,
+                        end,
+                        max_buffer
+                    )
+                    position = end
+
+                buffer.discard(min(position, start))
+
+        # The remote's last block can be shorter than a block
+        buffer.fill(position + block_size)
+        if buffer.eof and 0 < buffer.end - position < block_size and \
+                signatures:
+            tail = buffer.get(position, buffer.end)
+            strong = hashlib.md5(tail).digest()
+
+            for index, remote_strong in signatures.get(
+                pyrsync2.weakchecksum(tail)[0], ()
+            ):
+                if remote_strong == strong:
+                    yield index
+
+                    position = buffer.end
+                    break
+
+        while True:
+            buffer.fill(position + max(self.SEGMENT_SIZE, max_buffer))
+
+            if buffer.eof:
+                end = buffer.end
+            else:
+                end = position + \
+                    (buffer.end - position) // max_buffer * max_buffer
+
+            if end <= position:
+                break
+
+            yield from literal_blocks(buffer, position, end, max_buffer)
+
+            position = end
+            buffer.discard(position)
+
+
+# Delta engines selectable with the `delta_engine` option of `Directory`
+DELTA_ENGINES = {
+    'python': PythonDeltaEngine
+}
+
+if numpy is not None:
+    DELTA_ENGINES['numpy'] = NumpyDeltaEngine
+    DEFAULT_DELTA_ENGINE = 'numpy'
+else:
+    DEFAULT_DELTA_ENGINE = 'python'
+
+
+def create_delta_engine(name=None, workers=0):
+    """
+    Return a delta engine of the `DELTA_ENGINES` class `name`, or a
+    `ProcessDeltaEngine` running it on `workers` processes.
+    """
+    if name is None:
+        name = DEFAULT_DELTA_ENGINE
+
+    if name not in DELTA_ENGINES:
+        raise ValueError("Unsupported delta engine {}".format(name))
+
+    if workers > 0:
+        return ProcessDeltaEngine(name, workers)
+
+    return DELTA_ENGINES[name]()
+
+
+def get_file_version(file):
+    """
+    Return the (inode, size, mtime_ns) of an open file, which tell if
+    two opens of the same path are of the same file.
+    """
+    stat = os.fstat(file.fileno())
+
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def compute_checksums(engine_name, file_path, block_size, version):
+    """
+    Return the block checksums of a file, or None if it isn't the
+    `version` the caller has open.
+    """
+    with open(file_path, 'rb') as file:
+        if get_file_version(file) != version:
+            return None
+
+        return create_delta_engine(engine_name).blockchecksums(
+            file,
+            block_size
+        )
+
+
+def compute_delta_operations(engine_name, file_path, remote_checksums,
+                             block_size, version):
+    """
+    Return the delta of a file as a list of block indexes for the matched
+    blocks and (offset, length) tuples for the data in between, so the
+    data itself doesn't have to be passed between processes.
+
+    Return None if the file isn't the `version` the caller has open
+    (e.g. it was replaced by a rename), as the offsets would be of
+    another file.
+    """
+    operations = []
+    position = 0
+
+    with open(file_path, 'rb') as file:
+        version_opened = get_file_version(file)
+        if version_opened != version:
+            return None
+
+        file_size = version_opened[1]
+
+        for block in create_delta_engine(engine_name).rsyncdelta(
+            file,
+            remote_checksums,
+            block_size,
+            block_size
+        ):
+            if isinstance(block, int):
+                operations.append(block)
+                position = min(position + block_size, file_size)
+            elif operations and not isinstance(operations[-1], int):
+                offset, length = operations[-1]
+                operations[-1] = (offset, length + len(block))
+                position += len(block)
+            else:
+                operations.append((position, len(block)))
+                position += len(block)
+
+    return operations
+
+
+class ProcessDeltaEngine:
+    """
+    Runs the block checksum and delta computations of another engine on
+    a shared pool of worker processes, so they don't hold the GIL of the
+    transfer threads.
+
+    The workers open the files by path and return the delta data as file
+    offsets, which are read by the calling thread. Files without a path,
+    or which the workers find replaced, are handled on the calling
+    thread.
+
+    A delta isn't streamed from a worker: the remote checksums are
+    pickled to it on every call and the whole delta is pickled back as a
+    list, so both are held in memory (twice, while pickled) with an
+    entry for every block of the two files. Deltas of files bigger than
+    `MAX_FILE_SIZE` are computed on the calling thread instead, which
+    streams them.
+    """
+
+    # Size above which the local or the remote file of a delta is too big
+    # to pass its checksums and operations between processes
+    MAX_FILE_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, engine_name, workers):
+        self.engine_name = engine_name
+        self.workers = workers
+
+        self.engine = DELTA_ENGINES[engine_name]()
+
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def __get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # Forking a process with running threads isn't safe
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+
+            return self.executor
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    @staticmethod
+    def __get_path(file):
+        path = getattr(file, 'name', None)
+
+        if isinstance(path, str) and hasattr(file, 'fileno'):
+            return path
+
+        return None
+
+    def blockchecksums(self, file, block_size):
+        file_path = self.__get_path(file)
+
+        if file_path is not None:
+            checksums = self.__get_executor().submit(
+                compute_checksums,
+                self.engine_name,
+                file_path,
+                block_size,
+                get_file_version(file)
+            ).result()
+
+            if checksums is not None:
+                return checksums
+
+            # Replaced since it was opened
+            file.seek(0)
+
+        return self.engine.blockchecksums(file, block_size)
+
+    def rsyncdelta(self, file, remote_checksums, block_size, max_buffer):
+        file_path = self.__get_path(file)
+        operations = None
+
+        if file_path is not None:
+            version = get_file_version(file)
+
+            if version[1] > self.MAX_FILE_SIZE or \
+                    len(remote_checksums) * block_size > self.MAX_FILE_SIZE:
+                file_path = None
+
+        if file_path is not None:
+            operations = self.__get_executor().submit(
+                compute_delta_operations,
+                self.engine_name,
+                file_path,
+                remote_checksums,
+                block_size,
+                version
+            ).result()
+
+        if operations is None:
+            if file_path is not None:
+                # Replaced since it was opened
+                file.seek(0)
+
+            yield from self.engine.rsyncdelta(
+                file,
+                remote_checksums,
+                block_size,
+                max_buffer
+            )
+            return
+
+        for operation in operations:
+            if isinstance(operation, int):
+                yield operation
+                continue
+
+            offset, length = operation
+            file.seek(offset)
+
+            while length > 0:
+                block = file.read(min(length, max_buffer))
+                if not block:
+                    raise IOError("{} was truncated".format(file_path))
+
+                length -= len(block)
+                yield block
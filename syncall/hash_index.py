@@ -0,0 +1,112 @@
+# Algorithm of the index entries which don't have a 'hash_algorithm'
+LEGACY_HASH_ALGORITHM = 'md5'
+
+
+def get_content_key(file_data):
+    """
+    Return the (<hash algorithm>, <hash>, <size>) key of an index entry's
+    content, or None if it's deleted or hasn't been hashed.
+    """
+    if file_data is None or file_data.get('deleted', False) or \
+            not file_data.get('hash') or 'size' not in file_data:
+        return None
+
+    return (
+        file_data.get('hash_algorithm', LEGACY_HASH_ALGORITHM),
+        file_data['hash'],
+        file_data['size']
+    )
+
+
+def get_content_keys(file_data):
+    """
+    Return the set of the content keys of an index entry: the one of its
+    hash and one for each of the hashes of the same content in other
+    algorithms in its 'hashes' ({<algorithm>: <hash>}).
+    """
+    key = get_content_key(file_data)
+    if key is None:
+        return set()
+
+    keys = {key}
+
+    for algorithm, file_hash in file_data.get('hashes', dict()).items():
+        keys.add((algorithm, file_hash, key[2]))
+
+    return keys
+
+
+def same_content(file_data, other_data):
+    """
+    Return True if two index entries have the same content, compared in
+    an algorithm both of them have a hash of.
+    """
+    keys = get_content_keys(file_data)
+    other_keys = get_content_keys(other_data)
+
+    common = {key[0] for key in keys} & {key[0] for key in other_keys}
+    if not common:
+        return False
+
+    return all(
+        key in other_keys for key in keys if key[0] in common
+    )
+
+
+class HashIndex:
+    """
+    Reverse index of the file contents of an index: the names of the
+    files with each content key (see `get_content_keys`). Deleted files
+    aren't in it.
+    """
+
+    def __init__(self):
+        # content key -> set of file names
+        self.files = dict()
+        # file name -> set of content keys
+        self.keys = dict()
+
+    @classmethod
+    def build(cls, index_items):
+        hash_index = cls()
+
+        for file_name, file_data in index_items:
+            hash_index.update(file_name, file_data)
+
+        return hash_index
+
+    def update(self, file_name, file_data):
+        """
+        Set the entry of `file_name`. `file_data` None removes it.
+
+        Return True if the content keys of the file changed.
+        """
+        keys = get_content_keys(file_data)
+        old_keys = self.keys.get(file_name, set())
+
+        if keys == old_keys:
+            return False
+
+        for key in old_keys - keys:
+            file_names = self.files[key]
+            file_names.discard(file_name)
+
+            if not file_names:
+                del self.files[key]
+
+        for key in keys - old_keys:
+            self.files.setdefault(key, set()).add(file_name)
+
+        if keys:
+            self.keys[file_name] = keys
+        else:
+            self.keys.pop(file_name, None)
+
+        return True
+
+    def get_files(self, key):
+        """
+        Return the set of the names of the files with the content key
+        `key`.
+        """
+        return set(self.files.get(key, ()))
@@ -0,0 +1,127 @@
+import collections
+import bintools
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def hash_file(file_path, algorithm):
+    """
+    Return the digest of the file's content, or {<algorithm>: <digest>}
+    if `algorithm` is a list of algorithms (the file is read once).
+    """
+    if isinstance(algorithm, str):
+        return bintools.hash_file(file_path, algorithm)
+
+    if len(algorithm) == 1:
+        return {algorithm[0]: bintools.hash_file(file_path, algorithm[0])}
+
+    return bintools.hash_file_algorithms(file_path, algorithm)
+
+
+class HashPool:
+    """
+    Computes file content hashes on a pool of worker threads so hashing
+    overlaps with the directory scan and with other files' disk reads
+    (hashlib and file reads release the GIL).
+
+    With `workers` <= 1 files are hashed inline on the calling thread.
+    """
+
+    def __init__(self, workers=1, queue_size=None):
+        self.workers = max(1, workers)
+
+        if queue_size is None:
+            queue_size = self.workers * 4
+
+        # Maximum number of files submitted but not yet consumed
+        self.queue_size = max(1, queue_size)
+
+    def hash_files(self, items):
+        """
+        Generator of (key, hash) tuples for an iterable of
+        (key, file_path, hash_algorithm) tuples, in the same order as
+        `items`. See `hash_file` for lists of algorithms.
+
+        `items` is consumed lazily: no more than `queue_size` files
+        are hashed ahead of the consumer.
+        """
+        if self.workers == 1:
+            for key, file_path, algorithm in items:
+                yield (key, hash_file(file_path, algorithm))
+
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+
+            for key, file_path, algorithm in items:
+                pending.append((
+                    key,
+                    executor.submit(hash_file, file_path, algorithm)
+                ))
+
+                if len(pending) >= self.queue_size:
+                    key, future = pending.popleft()
+                    yield (key, future.result())
+
+            while pending:
+                key, future = pending.popleft()
+                yield (key, future.result())
+
+
+class HashingWriter:
+    """
+    Wrapper of a file opened for writing and reading which hashes the
+    data written to it. Data written in order from the start of the file
+    is hashed as it's written, `digest` reads back the rest.
+    """
+
+    # Read size of `digest`
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, file, algorithm='md5'):
+        self.file = file
+        self.algorithm = algorithm
+        self.hash = bintools.new_hash(algorithm)
+
+        self.position = 0
+        # Size of the start of the file which is hashed
+        self.hashed = 0
+
+    def write(self, data):
+        if self.position == self.hashed:
+            self.hash.update(data)
+            self.hashed += len(data)
+        elif self.position < self.hashed:
+            # Hashed data is overwritten, start over
+            self.hash = bintools.new_hash(self.algorithm)
+            self.hashed = 0
+
+        written = self.file.write(data)
+        self.position += len(data)
+
+        return written
+
+    def seek(self, offset, whence=0):
+        self.position = self.file.seek(offset, whence)
+
+        return self.position
+
+    def digest(self):
+        """
+        Return the digest of the file's content. Should only be called
+        once, after all data is written.
+        """
+        self.file.flush()
+        self.file.seek(self.hashed)
+
+        for data in iter(lambda: self.file.read(self.READ_SIZE), b''):
+            self.hash.update(data)
+
+        self.position = self.file.tell()
+        self.hashed = self.position
+
+        return self.hash.digest()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
@@ -0,0 +1,169 @@
+import re
+
+
+IGNORE_FILE_NAME = '.syncallignore'
+
+# Rules that always apply (the files syncall keeps in the directory)
+DEFAULT_RULES = ('.syncall_*',)
+
+
+def translate_glob(pattern):
+    """
+    Translate a gitignore-style glob (without the leading '!' or the
+    trailing '/') to a regular expression matching relative paths.
+
+    `*` and `?` don't match '/', `**/` matches any number of leading
+    directories and `/**` everything below. Patterns containing a '/'
+    (other than a trailing one) are anchored to the top directory,
+    the others match a name at any level.
+    """
+    anchored = '/' in pattern
+
+    if pattern.startswith('/'):
+        pattern = pattern[1:]
+
+    if pattern.startswith('**/'):
+        # Matches at any level anyway
+        pattern = pattern[3:]
+        anchored = False
+
+    regex = []
+    i = 0
+
+    while i < len(pattern):
+        char = pattern[i]
+
+        if pattern.startswith('/**/', i):
+            regex.append('(?:/.*)?/')
+            i += 4
+            continue
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex.append('/.*')
+            i += 3
+            continue
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        elif char == '[':
+            end = pattern.find(']', i + 2)
+
+            if end == -1:
+                regex.append(re.escape(char))
+            else:
+                chars = pattern[i + 1:end].replace('\\', '\\\\')
+
+                if chars[0] == '!':
+                    chars = '^' + chars[1:]
+
+                regex.append('[{}]'.format(chars))
+                i = end
+        else:
+            regex.append(re.escape(char))
+
+        i += 1
+
+    if anchored:
+        return ''.join(regex)
+    else:
+        return '(?:.*/)?' + ''.join(regex)
+
+
+class IgnoreRules:
+    """
+    Compiled gitignore-style rules (one per line):
+        - blank lines and lines starting with '#' are skipped;
+        - a leading '!' re-includes paths excluded by earlier rules;
+        - a trailing '/' matches only directories;
+        - see `translate_glob` for the patterns.
+
+    A rule matching a directory also matches everything below it.
+    The rules are compiled into one regular expression for files and
+    one for directories, with the rules in reverse order so the first
+    matching alternative is the last matching rule.
+    """
+
+    def __init__(self, lines=()):
+        self.rules = []
+
+        for line in lines:
+            line = line.rstrip('\n').rstrip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+
+            directory_only = line.endswith('/')
+            line = line.rstrip('/')
+
+            if line:
+                self.rules.append(
+                    (translate_glob(line), negated, directory_only)
+                )
+
+        self.file_regex, self.file_negated = self.__compile(False)
+        self.dir_regex, self.dir_negated = self.__compile(True)
+
+    @classmethod
+    def load(cls, path, default_rules=DEFAULT_RULES):
+        """
+        Return the default rules followed by the rules in the
+        file at `path` (if it exists).
+        """
+        lines = list(default_rules)
+
+        try:
+            with open(path, 'r', encoding='utf-8') as ignore_file:
+                lines.extend(ignore_file)
+        except FileNotFoundError:
+            pass
+
+        return cls(lines)
+
+    def __compile(self, is_dir):
+        alternatives = []
+        negated = []
+
+        for regex, rule_negated, directory_only in reversed(self.rules):
+            if directory_only and not is_dir:
+                # Only the files below the matching directories
+                regex += '/.*'
+            else:
+                regex += '(?:/.*)?'
+
+            alternatives.append('({})'.format(regex))
+            negated.append(rule_negated)
+
+        if not alternatives:
+            return (None, negated)
+
+        return (re.compile('|'.join(alternatives), re.DOTALL), negated)
+
+    def matches(self, relative_path, is_dir=False):
+        """
+        Return True if the file (or directory if `is_dir`) at
+        `relative_path` (relative to the top directory, with '/'
+        separators) is ignored.
+        """
+        if is_dir:
+            regex, negated = self.dir_regex, self.dir_negated
+        else:
+            regex, negated = self.file_regex, self.file_negated
+
+        if regex is None or not relative_path:
+            return False
+
+        match = regex.fullmatch(relative_path)
+
+        return match is not None and not negated[match.lastindex - 1]
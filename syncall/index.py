@@ -1,23 +1,37 @@
+import hashlib
 import logging
 import threading
 import os
 import pathext
-import msgpack
 import bintools
-import re
-import pyrsync2
 import shutil
 
+from collections import OrderedDict
 from datetime import datetime
+from stat import S_ISREG
 
 import syncall
 
+from syncall import scanner, hashing, ignore, merkle
+from syncall.index_store import INDEX_STORES
+from syncall.index_entry import IndexEntry
+from syncall.checksum_cache import ChecksumCache
+from syncall.chunk_index import ChunkIndex
+from syncall.chunking import chunk_file, chunk_id
+from syncall.delta import create_delta_engine
+from syncall.hash_index import HashIndex, get_content_key, \
+    get_content_keys, same_content, LEGACY_HASH_ALGORITHM
 from events import Event
 
 
 CONFLICT = -1
 NOT_MODIFIED = 0
 NEEDS_UPDATE = 1
+# The files have the same content, only their sync logs need to be merged
+SAME_CONTENT = 2
+
+# Renames kept by a `Directory` until they're synced
+MAX_RENAMES = 10000
 
 
 class Directory:
@@ -26,11 +40,14 @@ class Directory:
     changes from different sources.
     """
 
-    IGNORE_PATTERNS = r'\.syncall_.*'
-
     def __init__(self, uuid, dir_path, index_name='.syncall_index',
                  load_index=True, temp_dir_name='.syncall_temp',
-                 create_temp_dir=False):
+                 create_temp_dir=False, hash_workers=1,
+                 hash_queue_size=None, hash_algorithm='md5',
+                 index_backend='journal', checksum_cache=True,
+                 warm_checksum_cache=False, delta_engine=None,
+                 delta_workers=0, chunking=False, preserve_mtime=False,
+                 legacy_hashes=True):
         self.logger = logging.getLogger(__name__)
 
         self.uuid = uuid
@@ -38,6 +55,10 @@ class Directory:
         self.index_name = index_name
         self.index_path = os.path.join(self.dir_path, self.index_name)
         self.temp_dir = os.path.join(self.dir_path, temp_dir_name)
+        self.ignore_path = os.path.join(
+            self.dir_path,
+            ignore.IGNORE_FILE_NAME
+        )
         self.last_update = datetime.now().timestamp()
 
         if create_temp_dir and not os.path.exists(self.temp_dir):
@@ -45,23 +66,134 @@ class Directory:
 
         self.fs_access_lock = threading.Lock()
         self.temp_dir_lock = threading.Lock()
+        # Held by index updates, which only take `fs_access_lock` to
+        # start and to commit
+        self.update_lock = threading.Lock()
 
         self.temp_files = set()
 
+        self.ignore_rules = None
+        self.load_ignore_rules()
+
+        if hash_algorithm not in bintools.HASH_ALGORITHMS:
+            raise ValueError(
+                "Unsupported hash algorithm {}".format(hash_algorithm)
+            )
+
+        # Algorithm for the hashes of new and modified files
+        self.hash_algorithm = hash_algorithm
+
+        # Also hash the files in the legacy algorithm when indexing them,
+        # for peers which only support it (see `get_extra_algorithms`)
+        self.legacy_hashes = legacy_hashes
+
+        if index_backend not in INDEX_STORES:
+            raise ValueError(
+                "Unsupported index backend {}".format(index_backend)
+            )
+
+        # Class of the index store ('sqlite' keeps the index out of memory)
+        self.index_store_class = INDEX_STORES[index_backend]
+
+        # Hashes the files found by `update_index` scans
+        self.hash_pool = hashing.HashPool(
+            hash_workers,
+            hash_queue_size
+        )
+
+        # Computes block checksums and deltas ('numpy' if it's installed),
+        # on `delta_workers` processes if there are any
+        self.delta_engine = create_delta_engine(delta_engine, delta_workers)
+
+        # Block checksums of the basis files of incoming transfers,
+        # optionally computed in the background after `update_index`
+        if checksum_cache:
+            self.checksum_cache = ChecksumCache(
+                self.index_path + '.checksums',
+                self.delta_engine
+            )
+        else:
+            self.checksum_cache = None
+
+        self.warm_checksum_cache = warm_checksum_cache and checksum_cache
+
+        # Chunks of the files for content-defined chunking transfers,
+        # which are only used if `chunking` is enabled on both sides
+        if chunking:
+            self.chunk_index = ChunkIndex(self.index_path + '.chunks')
+        else:
+            self.chunk_index = None
+        self.__warm_thread = None
+
+        # Set the modification times of received files to the remote ones
+        self.preserve_mtime = preserve_mtime
+
         self.transfer_manager = syncall.TransferManager(self)
 
         self.index_updated = Event()
+        self.index_updated += self.__index_updated
         # Contains tuple(uuid, file_name, file_index) as data
         self.transfer_finalized = Event()
 
+        # Built when first needed, see `_get_merkle_tree_unsafe`
+        self._merkle_tree = None
+        # Built when first needed, see `_get_hash_index_unsafe`
+        self._hash_index = None
+        # Files whose content changed since the last `index_updated`
+        # event, only tracked if there are content caches to invalidate
+        self._content_changes = set()
+
+        # Files renamed since they were last synced:
+        # <new file name>: (<old file name>, <content key>)
+        self._renames = OrderedDict()
+
         if load_index:
             self.load_index()
         else:
-            self._index = dict()
+            self._index = self.__create_index_store()
 
     def get_last_update(self):
         return self.last_update
 
+    def get_hash_algorithms(self):
+        """
+        Return the supported hash algorithms in order of preference,
+        starting with the configured one.
+        """
+        return [self.hash_algorithm] + [
+            algorithm for algorithm in bintools.HASH_ALGORITHMS
+            if algorithm != self.hash_algorithm
+        ]
+
+    def get_extra_algorithms(self, algorithm):
+        """
+        Return the algorithms besides `algorithm` which the files with
+        hashes in `algorithm` are also hashed with. The hashes are kept in
+        the index entries' 'hashes' ({<algorithm>: <hash>}).
+        """
+        if self.legacy_hashes and algorithm != LEGACY_HASH_ALGORITHM:
+            return [LEGACY_HASH_ALGORITHM]
+
+        return []
+
+    def _needs_extra_hashes(self, file_data):
+        """
+        Return True if a live index entry is missing some of the hashes
+        of `get_extra_algorithms`.
+        """
+        if not file_data or file_data.get('deleted', False) or \
+                'hash' not in file_data:
+            return False
+
+        hashes = file_data.get('hashes', dict())
+
+        return any(
+            algorithm not in hashes for algorithm in
+            self.get_extra_algorithms(
+                file_data.get('hash_algorithm', LEGACY_HASH_ALGORITHM)
+            )
+        )
+
     def get_temp_path(self, proposed_name):
         """
         Return a path to a temp file that can be written to.
@@ -104,37 +236,166 @@ class Directory:
     def get_file_path(self, file_name):
         return os.path.join(self.dir_path, file_name)
 
+    def load_ignore_rules(self):
+        """
+        (Re)load the ignore rules if the ignore file has changed since
+        they were loaded.
+        """
+        try:
+            stat = os.stat(self.ignore_path)
+            ignore_file_key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            ignore_file_key = None
+
+        if self.ignore_rules is None or \
+                ignore_file_key != self.__ignore_file_key:
+            self.ignore_rules = ignore.IgnoreRules.load(self.ignore_path)
+            self.__ignore_file_key = ignore_file_key
+
+    def is_ignored(self, relative_path, is_dir=False):
+        return self.ignore_rules.matches(relative_path, is_dir)
+
     def get_block_checksums(self, file_name, block_size):
+        # The file is read without the lock, received files replace it
+        # (see `finalize_transfer`) instead of changing it
         with self.fs_access_lock:
-            if file_name not in self._index:
-                return []
+            file_data = self._get_index_unsafe(file_name)
+
+        if file_data is None or \
+                ('deleted' in file_data and file_data['deleted']):
+            return []
+
+        if self.checksum_cache is not None and 'hash' in file_data:
+            return self.checksum_cache.get_checksums(
+                file_name,
+                self.get_file_path(file_name),
+                file_data['hash'],
+                block_size
+            )
+
+        with open(self.get_file_path(file_name), 'rb') as file:
+            return self.delta_engine.blockchecksums(file, block_size)
 
+    def get_file_chunks(self, file_name):
+        """
+        Return the content-defined chunks of a file as a list of
+        (<chunk id>, <length>) tuples, indexing them.
+        """
+        with self.fs_access_lock:
             file_data = self._get_index_unsafe(file_name)
-            if 'deleted' in file_data and file_data['deleted']:
-                return []
 
-            with open(self.get_file_path(file_name), 'rb') as file:
-                block_checksums = list(pyrsync2.blockchecksums(
-                    file,
-                    blocksize=block_size
-                ))
+        if self.chunk_index is not None and file_data is not None and \
+                'hash' in file_data:
+            return self.chunk_index.get_chunks(
+                file_name,
+                self.get_file_path(file_name),
+                file_data['hash']
+            )
 
-        return block_checksums
+        with open(self.get_file_path(file_name), 'rb') as file:
+            return chunk_file(file)
 
-    def load_index(self):
+    def read_chunk(self, wanted_id):
+        """
+        Return the data of the chunk `wanted_id` if it's found in one of
+        the indexed files, otherwise None.
+        """
+        if self.chunk_index is None:
+            return None
+
+        return self.__read_verified(
+            self.chunk_index.find_chunk(wanted_id),
+            wanted_id,
+            chunk_id
+        )
+
+    def read_block(self, strong, length):
+        """
+        Return the data of a block of `length` bytes with the strong
+        (MD5) hash `strong` if it's found in one of the files in the
+        checksum cache, otherwise None.
+        """
+        if self.checksum_cache is None:
+            return None
+
+        return self.__read_verified(
+            [
+                (file_name, offset, length) for file_name, offset in
+                self.checksum_cache.find_block(strong, length)
+            ],
+            strong,
+            lambda data: hashlib.md5(data).digest()
+        )
+
+    def __read_verified(self, locations, wanted_hash, hash_function):
+        """
+        Return the data at the first of `locations` ((file name, offset,
+        length) tuples) whose hash is still `wanted_hash`.
+        """
+        for file_name, offset, length in locations:
+            try:
+                with open(self.get_file_path(file_name), 'rb') as file:
+                    file.seek(offset)
+                    data = file.read(length)
+            except OSError:
+                continue
+
+            # The file may have changed since it was indexed
+            if len(data) == length and hash_function(data) == wanted_hash:
+                return data
+
+        return None
+
+    def __index_updated(self, changes):
+        # Only the files whose content changed, the caches are still
+        # valid for the ones with changed sync metadata
         with self.fs_access_lock:
-            if os.path.isfile(self.index_path):
-                with open(self.index_path, 'rb') as index_file:
-                    index = msgpack.unpackb(index_file.read())
-
-                # Decode the object to utf strings except the 'hash' values
-                self._index = bintools.decode_object(
-                    index,
-                    except_keys=('hash',)
-                )
+            content_changes = self._content_changes
+            self._content_changes = set()
 
-            else:
-                self._index = dict()
+        if self.checksum_cache is not None and content_changes:
+            self.checksum_cache.invalidate(content_changes)
+
+        if self.chunk_index is not None and content_changes:
+            self.chunk_index.invalidate(content_changes)
+
+    def warm_checksums(self, block_size=None):
+        """
+        Compute the block checksums of the big files which aren't in the
+        checksum cache yet on a background thread. By default each file's
+        block size is the one chosen for its transfers.
+        """
+        if self.checksum_cache is None or \
+                (self.__warm_thread is not None and
+                 self.__warm_thread.is_alive()):
+            return
+
+        self.__warm_thread = threading.Thread(
+            target=self.__warm_checksums,
+            args=(self.get_index_snapshot(), block_size)
+        )
+        self.__warm_thread.daemon = True
+        self.__warm_thread.start()
+
+    def __warm_checksums(self, index, block_size):
+        with index:
+            self.checksum_cache.warm(self, index.items(), block_size)
+
+    def wait_for_checksums(self):
+        thread = self.__warm_thread
+
+        if thread is not None:
+            thread.join()
+
+    def __create_index_store(self):
+        return self.index_store_class(self.index_path, self.fs_access_lock)
+
+    def load_index(self):
+        with self.fs_access_lock:
+            self._index = self.__create_index_store()
+            self._index.load()
+            self._merkle_tree = None
+            self._hash_index = None
 
             self.last_update = datetime.now().timestamp()
 
@@ -150,18 +411,225 @@ class Directory:
         else:
             return self._index[file_name]
 
-    def save_index(self):
+    def is_file_unchanged(self, file_name):
+        """
+        Return True if the file is still the one its index entry was
+        computed from, going by its fingerprint.
+        """
+        with self.fs_access_lock:
+            return self._is_file_unchanged_unsafe(file_name)
+
+    def _is_file_unchanged_unsafe(self, file_name):
+        try:
+            stat = os.stat(self.get_file_path(file_name))
+        except OSError:
+            return False
+
+        return S_ISREG(stat.st_mode) and \
+            not self._needs_hash(self._get_index_unsafe(file_name), stat)
+
+    def _put_index_unsafe(self, file_name, file_data):
+        if self.checksum_cache is not None or self.chunk_index is not None:
+            old_key = get_content_key(self._get_index_unsafe(file_name))
+
+            if get_content_key(file_data) != old_key:
+                self._content_changes.add(file_name)
+
+        self._index[file_name] = file_data
+
+        if self._merkle_tree is not None:
+            self._merkle_tree.update(file_name, file_data)
+
+        if self._hash_index is not None:
+            self._hash_index.update(file_name, file_data)
+
+    def get_index_snapshot(self):
+        """
+        Return a read-only view of the index which isn't affected by
+        later changes and can be read without holding `fs_access_lock`.
+        It should be closed (`close` or `with`) when it's not needed.
+        """
+        with self.fs_access_lock:
+            return self._index.snapshot()
+
+    def get_index_entries(self, file_names):
+        """
+        Return a dict with the index entries of the files in
+        `file_names` which are in the index.
+        """
+        with self.fs_access_lock:
+            return {
+                file_name: self._index[file_name]
+                for file_name in file_names
+                if file_name in self._index
+            }
+
+    def _get_merkle_tree_unsafe(self):
+        """
+        Return the Merkle tree of the index, building it on first use.
+        It's updated with the index after that. For index stores which
+        aren't in memory only the directories are kept in memory.
+        """
+        if self._merkle_tree is None:
+            if self._index.in_memory:
+                self._merkle_tree = merkle.MerkleTree.build(
+                    self._index.items()
+                )
+            else:
+                self._merkle_tree = merkle.IndexMerkleTree.build(self._index)
+
+        return self._merkle_tree
+
+    def _get_hash_index_unsafe(self):
+        """
+        Return the content hash reverse index of the index, building it
+        on first use. It's updated with the index after that.
+        """
+        if self._hash_index is None:
+            self._hash_index = HashIndex.build(self._index.items())
+
+        return self._hash_index
+
+    def find_files(self, file_data):
+        """
+        Return the set of the names of the files with the same content
+        (hash and size) as the index entry `file_data`.
+        """
+        keys = get_content_keys(file_data)
+        if not keys:
+            return set()
+
+        with self.fs_access_lock:
+            hash_index = self._get_hash_index_unsafe()
+
+            return set().union(*(hash_index.get_files(key) for key in keys))
+
+    def find_local_copy(self, file_data):
+        """
+        Return the name of a file with the same content as the index entry
+        `file_data` which hasn't changed since it was indexed, or None.
+        """
+        for file_name in sorted(self.find_files(file_data)):
+            local_data = self.get_index(file_name)
+
+            try:
+                stat = os.stat(self.get_file_path(file_name))
+            except OSError:
+                continue
+
+            if local_data is not None and \
+                    scanner.fingerprint_matches(local_data, stat):
+                return file_name
+
+        return None
+
+    def get_rename_source(self, file_name):
+        """
+        Return the old name of a file which was renamed (or moved) to
+        `file_name`, or None if it wasn't or either of them has changed
+        since.
+        """
         with self.fs_access_lock:
-            index = msgpack.packb(self._index)
+            if file_name not in self._renames:
+                return None
+
+            old_name, key = self._renames[file_name]
+            old_data = self._get_index_unsafe(old_name)
+
+            if get_content_key(self._get_index_unsafe(file_name)) != key or \
+                    old_data is None or not old_data.get('deleted', False):
+                del self._renames[file_name]
+                return None
+
+            return old_name
+
+    def __detect_renames(self, update, changes):
+        """
+        Pair the files deleted by `update` with the files it added with
+        the same content and record them as renames.
+        """
+        deleted = []
+        added = set()
+
+        for file_name in changes:
+            base_data = update.base.get(file_name)
+            base_live = base_data is not None and \
+                not base_data.get('deleted', False)
+
+            if self._get_index_unsafe(file_name).get('deleted', False):
+                if base_live and get_content_key(base_data) is not None:
+                    deleted.append((file_name, get_content_key(base_data)))
+            elif not base_live:
+                added.add(file_name)
+
+        if not deleted or not added:
+            return
+
+        hash_index = self._get_hash_index_unsafe()
+
+        for old_name, key in sorted(deleted):
+            candidates = hash_index.get_files(key) & added
+            if not candidates:
+                continue
+
+            new_name = min(candidates)
+            added.remove(new_name)
+
+            self.logger.debug(
+                "Detected rename of {} to {}".format(old_name, new_name)
+            )
+
+            self._renames[new_name] = (old_name, key)
+            self._renames.move_to_end(new_name)
 
-            with open(self.index_path, 'wb') as index_file:
-                index_file.write(index)
+        while len(self._renames) > MAX_RENAMES:
+            self._renames.popitem(last=False)
+
+    def get_merkle_root(self):
+        with self.fs_access_lock:
+            return self._get_merkle_tree_unsafe().get_hash()
+
+    def get_merkle_snapshot(self):
+        """
+        Return (<index snapshot>, <Merkle tree snapshot>) taken at the
+        same time, see `get_index_snapshot` and `MerkleTree.snapshot`.
+        """
+        with self.fs_access_lock:
+            index = self._index.snapshot()
+
+            return (index, self._get_merkle_tree_unsafe().snapshot(index))
+
+    def get_merkle_children(self, dir_paths):
+        """
+        Return {<dir_path>: <children>} with the Merkle tree children
+        (see `MerkleTree.get_children`) of each directory in `dir_paths`.
+        """
+        with self.fs_access_lock:
+            tree = self._get_merkle_tree_unsafe()
+
+            return {
+                dir_path: tree.get_children(dir_path)
+                for dir_path in dir_paths
+            }
+
+    def save_index(self):
+        """
+        Persist the index entries changed since the last save.
+
+        Index entries are shared with the index snapshots, so they must
+        not be changed in place: change a copy (`copy_entry`) and assign
+        it back with `_put_index_unsafe`.
+        """
+        with self.fs_access_lock:
+            self._index.save()
 
     def update_index(self, save_index=True, force=False):
         """
         Update self._index (use the get_index() method to get it).
 
-        Return True if index changed, False otherwise.
+        The directory is scanned and hashed against a snapshot of the
+        index without holding `fs_access_lock` and the changes are
+        committed at once (see `IndexUpdate`).
 
         The index structure is:
             <index> ::= {
@@ -176,109 +644,365 @@ class Directory:
                 },
                 'last_update_location': <remote_uuid (or the local UUID) (str)>
                 'last_update': <timestamp>,
-                'hash': <md5 byte-string>,
+                'hash': <content hash byte-string>,
+                'hash_algorithm': <name of the hash algorithm ('md5' if
+                                   missing)>,
+                [optional 'hashes': {
+                    <algorithm>: <hash of the content in it>,
+                    ...
+                }] (see `get_extra_algorithms`)
+                'size': <file size in bytes>,
+                'inode': <inode number>,
+                'mtime_ns': <modification time in nanoseconds>,
                 [optional 'deleted': (True|False)]
             }
             <timestamp> ::= Datetime in unix timestamp (seconds).
                             Depends on the os time on the system on which
                             the change happened.
         """
-        changes = set()
+        with self.update_lock, self.__start_update() as update:
+            found = set()
+            self._update_tree_index(self.dir_path, update, found)
 
-        with self.fs_access_lock:
-            for file_data in self._index.values():
-                file_data['not_found'] = True
+            # Mark each deleted file with the current timestamp
+            # and UUID to avoid conflicts and to propagate properly.
+            # Files which are ignored now aren't found either, they're
+            # marked as deleted so they aren't advertised anymore (the
+            # local files are kept).
+            timestamp = datetime.now().timestamp()
+            for file_name, file_data in update.base.items():
+                if file_name not in found:
+                    self._mark_deleted(file_name, file_data, timestamp, update)
 
-            for dirpath, dirnames, filenames in os.walk(self.dir_path):
-                for name in filenames:
-                    file_path = pathext.normalize(os.path.join(dirpath, name))
+            changes, modified = self.__commit_update(update)
 
-                    if not re.search(self.IGNORE_PATTERNS, file_path):
-                        self._update_file_index(file_path, changes)
+        if save_index and modified:
+            self.save_index()
 
-            # Mark each deleted file with the current timestamp
-            # and UUID to avoid conflicts and to propagate properly
+        if force:
+            self.index_updated.notify(None)
+        elif changes:
+            self.index_updated.notify(changes)
+
+        if self.warm_checksum_cache:
+            self.warm_checksums()
+
+    def update_paths(self, paths, save_index=True):
+        """
+        Update the index only for the given paths (relative to the
+        directory top) instead of rescanning the whole directory.
+
+        A path can point to a file, a directory (which is scanned
+        recursively) or to something that doesn't exist anymore
+        (the file or everything below the directory is marked as deleted).
+
+        Return the set of changed file names. The `index_updated` event is
+        notified with the same set, just like `update_index` does.
+        """
+        with self.update_lock, self.__start_update() as update:
             timestamp = datetime.now().timestamp()
-            for file_name, file_data in self._index.items():
-                if 'not_found' in file_data:
-                    del file_data['not_found']
 
-                    if 'deleted' in file_data and file_data['deleted']:
-                        # File has been deleted some time ago...
-                        continue
+            for path in paths:
+                relative_path = pathext.normalize(path)
+                file_path = pathext.normalize(
+                    self.get_file_path(relative_path)
+                )
+
+                ignored = self.is_ignored(
+                    relative_path,
+                    os.path.isdir(file_path)
+                )
+
+                if not ignored and os.path.isfile(file_path):
+                    self._update_file_index(file_path, update)
+
+                elif not ignored and os.path.isdir(file_path):
+                    self._update_tree_index(file_path, update)
 
-                    # File has been deleted now
-                    file_data['deleted'] = True
-                    file_data['last_update'] = timestamp
-                    file_data['last_update_location'] = self.uuid
-                    file_data['hash'] = b''
+                else:
+                    # Deleted or ignored now, like in `update_index`
+                    for file_name, file_data in \
+                            update.base.prefix_items(relative_path):
+                        self._mark_deleted(
+                            file_name,
+                            file_data,
+                            timestamp,
+                            update
+                        )
+
+            changes, modified = self.__commit_update(update)
 
-                    sync_log = file_data.setdefault('sync_log', dict())
-                    sync_log[self.uuid] = timestamp
+        if save_index and modified:
+            self.save_index()
+
+        if changes:
+            self.index_updated.notify(changes)
 
+        return changes
+
+    def __start_update(self):
+        with self.fs_access_lock:
+            self.load_ignore_rules()
+
+            return IndexUpdate(self._index.snapshot())
+
+    def __commit_update(self, update):
+        """
+        Write the entries of `update` to the index. Entries changed in the
+        index since the update's snapshot was taken (by a transfer) are
+        left as they are; they are checked again by the next update.
+
+        Return (<changed file names>, <True if any entry was written>).
+        """
+        changes = set()
+        modified = False
+
+        with self.fs_access_lock:
+            for file_name, file_data in update.entries.items():
+                if self._get_index_unsafe(file_name) != \
+                        update.base.get(file_name):
+                    self.logger.debug(
+                        "Index entry of {} changed during the update"
+                        .format(file_name)
+                    )
+                    continue
+
+                self._put_index_unsafe(file_name, file_data)
+                modified = True
+
+                if file_name in update.changes:
                     changes.add(file_name)
 
             if changes:
                 self.last_update = datetime.now().timestamp()
+                self.__detect_renames(update, changes)
 
-        if save_index and changes:
-            self.save_index()
+        return (changes, modified)
 
-        if force:
-            self.index_updated.notify(None)
-        elif changes:
-            self.index_updated.notify(changes)
+    def _update_tree_index(self, top, update, found=None):
+        """
+        Stage the index entries of all files under `top` in `update`.
+        Add the (relative) names of the scanned files to `found` if given.
+        """
+        relative_top = self._get_relative_path(top)
+        if relative_top == '.':
+            relative_top = ''
+
+        def hash_candidates():
+            """
+            Update the entries which don't need hashing right away and
+            yield the rest to the hash pool.
+            """
+            for relative_path, file_path, stat in scanner.scan_tree(
+                top,
+                self.is_ignored,
+                relative_top
+            ):
+                if found is not None:
+                    found.add(relative_path)
+
+                file_data = update.get(relative_path)
+
+                if self._needs_hash(file_data, stat) or \
+                        self._needs_extra_hashes(file_data):
+                    algorithm = self._get_compare_algorithm(file_data)
+
+                    yield (
+                        (relative_path, file_path, stat),
+                        file_path,
+                        [algorithm] + self.get_extra_algorithms(algorithm)
+                    )
+                else:
+                    self._update_file_index(file_path, update, stat,
+                                            relative_path)
+
+        for (relative_path, file_path, stat), file_hashes in \
+                self.hash_pool.hash_files(hash_candidates()):
+            self._update_file_index(
+                file_path,
+                update,
+                stat,
+                relative_path,
+                file_hashes
+            )
 
-    def _update_file_index(self, file_path, changes):
-        relative_path = pathext.normalize(
-            os.path.relpath(file_path, self.dir_path)
-        )
-        file_data = self._index.setdefault(relative_path, dict())
+    def _get_relative_path(self, file_path):
+        return pathext.normalize(os.path.relpath(file_path, self.dir_path))
+
+    def _mark_deleted(self, file_name, file_data, timestamp, update):
+        if 'deleted' in file_data and file_data['deleted']:
+            # File has been deleted some time ago...
+            return
+
+        # File has been deleted now
+        file_data = copy_entry(file_data)
+        file_data['deleted'] = True
+        file_data['last_update'] = timestamp
+        file_data['last_update_location'] = self.uuid
+        file_data['hash'] = b''
+
+        if 'hashes' in file_data:
+            del file_data['hashes']
+
+        sync_log = file_data.setdefault('sync_log', dict())
+        sync_log[self.uuid] = timestamp
+
+        update.put(file_name, file_data)
+        update.changes.add(file_name)
+
+    @staticmethod
+    def _needs_hash(file_data, stat):
+        """
+        Return True if the file has to be hashed to update its index entry.
+        """
+        if not file_data or 'deleted' in file_data:
+            return True
+
+        if scanner.fingerprint_matches(file_data, stat):
+            return False
+
+        # Entries from an index without fingerprints are trusted
+        # if the file hasn't been modified since their last update
+        return scanner.has_fingerprint(file_data) or \
+            scanner.mtime_seconds(stat) > file_data['last_update']
+
+    def _get_compare_algorithm(self, file_data):
+        """
+        Return the algorithm a file should be hashed with
+        to be compared with its index entry.
+        """
+        if not file_data or 'deleted' in file_data:
+            return self.hash_algorithm
+
+        algorithm = file_data.get('hash_algorithm', LEGACY_HASH_ALGORITHM)
+
+        if algorithm not in bintools.HASH_ALGORITHMS:
+            # Entry received from a peer with an unknown algorithm
+            return self.hash_algorithm
+
+        return algorithm
+
+    def _update_file_index(self, file_path, update, stat=None,
+                           relative_path=None, file_hashes=None):
+        """
+        Stage the index entry of a single file in `update`. The file is
+        only hashed if its fingerprint (size, inode, mtime_ns) has changed
+        or hashes of `get_extra_algorithms` are missing. `file_hashes`
+        ({<algorithm>: <hash>}) can be given if the file has already been
+        hashed.
+
+        Return True if the index entry was staged.
+        """
+        if stat is None:
+            stat = os.stat(file_path)
+
+        if relative_path is None:
+            relative_path = self._get_relative_path(file_path)
+
+        file_data = update.get(relative_path)
+        if file_data is None:
+            file_data = IndexEntry()
+
+        if not self._needs_hash(file_data, stat) and \
+                not self._needs_extra_hashes(file_data):
+            if scanner.fingerprint_matches(file_data, stat):
+                return False
+
+            # Only the fingerprint of a legacy entry is missing
+            file_data = copy_entry(file_data)
+            file_data.update(scanner.get_fingerprint(stat))
+            update.put(relative_path, file_data)
+            return True
+
+        file_data = copy_entry(file_data)
+
+        algorithm = self._get_compare_algorithm(file_data)
+
+        if file_hashes is None:
+            file_hashes = hashing.hash_file(
+                file_path,
+                [algorithm] + self.get_extra_algorithms(algorithm)
+            )
+
+        file_hash = file_hashes[algorithm]
+
+        if not file_data or 'deleted' in file_data:
+            if not file_data:
+                # New file
+                file_data['last_update'] = scanner.mtime_seconds(stat)
+            else:
+                # File has been created again after it was deleted
+                file_data['last_update'] = datetime.now().timestamp()
+                del file_data['deleted']
 
-        if not file_data:
-            # New file
-            file_hash = bintools.hash_file(file_path)
-            file_data['last_update'] = int(os.path.getmtime(file_path))
             file_data['hash'] = file_hash
+            file_data['hash_algorithm'] = algorithm
             file_data['last_update_location'] = self.uuid
 
             sync_log = file_data.setdefault('sync_log', dict())
             sync_log[self.uuid] = file_data['last_update']
 
-            changes.add(relative_path)
+            update.changes.add(relative_path)
 
-        elif int(os.path.getmtime(file_path)) > file_data['last_update']:
-            # Check if file is actually changed or the system time is off
-            file_hash = bintools.hash_file(file_path)
+        else:
+            entry_algorithm = file_data.get(
+                'hash_algorithm',
+                LEGACY_HASH_ALGORITHM
+            )
+
+            if entry_algorithm == algorithm:
+                # Check if file is actually changed or it was only touched
+                modified = file_data['hash'] != file_hash
+            else:
+                # The digests can't be compared
+                modified = \
+                    scanner.mtime_seconds(stat) > file_data['last_update']
 
-            if file_data['hash'] != file_hash:
+            if modified:
                 # File modified locally (since last sync)
-                file_data['last_update'] = int(os.path.getmtime(file_path))
-                file_data['hash'] = file_hash
+                if algorithm != self.hash_algorithm:
+                    algorithm = self.hash_algorithm
+                    file_hashes = hashing.hash_file(
+                        file_path,
+                        [algorithm] + self.get_extra_algorithms(algorithm)
+                    )
+                    file_hash = file_hashes[algorithm]
+
+                file_data['last_update'] = scanner.mtime_seconds(stat)
                 file_data['last_update_location'] = self.uuid
 
                 sync_log = file_data.setdefault('sync_log', dict())
                 sync_log[self.uuid] = file_data['last_update']
 
-                changes.add(relative_path)
+                update.changes.add(relative_path)
 
-        if 'deleted' in file_data:
-            file_data['last_update'] = datetime.now().timestamp()
-            file_data['hash'] = bintools.hash_file(file_path)
-            file_data['last_update_location'] = self.uuid
+            if modified or entry_algorithm != algorithm:
+                file_data['hash'] = file_hash
+                file_data['hash_algorithm'] = algorithm
 
-            sync_log = file_data.setdefault('sync_log', dict())
-            sync_log[self.uuid] = file_data['last_update']
+        extra_hashes = {
+            extra_algorithm: file_hashes[extra_algorithm]
+            for extra_algorithm in self.get_extra_algorithms(algorithm)
+        }
 
-            changes.add(relative_path)
+        if extra_hashes != file_data.get('hashes', dict()):
+            # Sent instead of the entry's hash to peers which don't
+            # support its algorithm, see `RemoteStore.get_entry_for_remote`
+            update.changes.add(relative_path)
 
-            del file_data['deleted']
+        if extra_hashes:
+            file_data['hashes'] = extra_hashes
+        elif 'hashes' in file_data:
+            del file_data['hashes']
 
-        if 'not_found' in file_data:
-            del file_data['not_found']
+        file_data.update(scanner.get_fingerprint(stat))
+        update.put(relative_path, file_data)
+
+        return True
 
     def diff(self, remote_index):
-        return IndexDiff.diff(self._index, remote_index)
+        with self.get_index_snapshot() as index:
+            return IndexDiff.diff(index, remote_index)
 
     def finalize_transfer(self, transfer):
         if transfer.type == syncall.transfers.FileTransfer.TO_REMOTE:
@@ -289,15 +1013,28 @@ class Directory:
         self.save_index()
 
     def __finalize_transfer_to_remote(self, transfer):
+        file_names = self.__get_transfer_files(transfer)
+
         with self.fs_access_lock:
-            self.__update_index_after_transfer(
-                transfer.file_name,
-                self._get_index_unsafe(transfer.file_name),
-                transfer.get_remote_uuid(),
-                transfer.timestamp
-            )
+            for file_name in file_names:
+                file_data = self._get_index_unsafe(file_name)
+
+                if transfer.metadata_only:
+                    # The receiver had the same content
+                    file_data = copy_entry(file_data)
+                    file_data['sync_log'] = merge_sync_logs(
+                        file_data['sync_log'],
+                        transfer.sync_log
+                    )
+
+                self.__update_index_after_transfer(
+                    file_name,
+                    file_data,
+                    transfer.get_remote_uuid(),
+                    transfer.timestamp
+                )
 
-        self.index_updated.notify({transfer.file_name})
+        self.index_updated.notify(file_names)
 
     def __finalize_transfer_from_remote(self, transfer):
         updated = False
@@ -308,7 +1045,40 @@ class Directory:
                 self._get_index_unsafe(transfer.file_name)
             )
 
-            if diff == NEEDS_UPDATE:
+            if transfer.metadata_only and diff == SAME_CONTENT:
+                # The file is the same, take the remote entry (so both
+                # sides have the same one) with the merged sync logs
+                local_data = self._get_index_unsafe(transfer.file_name)
+
+                file_data = copy_entry(transfer.remote_file_data)
+                file_data['sync_log'] = merge_sync_logs(
+                    local_data['sync_log'],
+                    transfer.remote_file_data['sync_log']
+                )
+
+                # The local file wasn't changed
+                for key in ('size', 'inode', 'mtime_ns'):
+                    if key in local_data:
+                        file_data[key] = local_data[key]
+
+                self.__update_index_after_transfer(
+                    transfer.file_name,
+                    file_data,
+                    transfer.messanger.my_uuid,
+                    transfer.timestamp
+                )
+
+                updated = True
+            elif not transfer.metadata_only and diff == NEEDS_UPDATE and \
+                    transfer.rename_from is not None and \
+                    self.__rename_source_changed(transfer):
+                # The file isn't updated, so the next sync requests it
+                # again and it's transferred instead of renamed
+                self.logger.info(
+                    "Not renaming {} to {}, it was changed"
+                    .format(transfer.rename_from, transfer.file_name)
+                )
+            elif not transfer.metadata_only and diff == NEEDS_UPDATE:
                 if 'deleted' in transfer.remote_file_data and \
                         transfer.remote_file_data['deleted']:
 
@@ -328,20 +1098,39 @@ class Directory:
                     except:
                         pass
 
-                    # Update the actual file
-                    shutil.move(
-                        transfer.get_temp_path(),
-                        self.get_file_path(transfer.file_name)
-                    )
+                    if transfer.rename_from is not None:
+                        # The file is renamed instead of transferred
+                        os.rename(
+                            self.get_file_path(transfer.rename_from),
+                            self.get_file_path(transfer.file_name)
+                        )
+                    else:
+                        # Update the actual file
+                        shutil.move(
+                            transfer.get_temp_path(),
+                            self.get_file_path(transfer.file_name)
+                        )
 
                 # Update the file index
                 self.__update_index_after_transfer(
                     transfer.file_name,
-                    transfer.remote_file_data,
+                    self.__get_received_entry(
+                        transfer.file_name,
+                        transfer.remote_file_data,
+                        transfer.verified_hash
+                    ),
                     transfer.messanger.my_uuid,
                     transfer.timestamp
                 )
 
+                if transfer.rename_from is not None:
+                    self.__update_index_after_transfer(
+                        transfer.rename_from,
+                        transfer.rename_data,
+                        transfer.messanger.my_uuid,
+                        transfer.timestamp
+                    )
+
                 updated = True
             else:
                 self.logger.debug(
@@ -350,16 +1139,123 @@ class Directory:
                 )
 
         if updated:
-            self.index_updated.notify({transfer.file_name})
+            self.index_updated.notify(self.__get_transfer_files(transfer))
+
+    def __rename_source_changed(self, transfer):
+        """
+        Return True if the local file a transfer renames doesn't have the
+        received content anymore.
+        """
+        return not same_content(
+            self._get_index_unsafe(transfer.rename_from),
+            transfer.remote_file_data
+        ) or not self._is_file_unchanged_unsafe(transfer.rename_from)
+
+    def __get_received_entry(self, file_name, remote_data,
+                             verified_hash=None):
+        """
+        Return the index entry of a file which was received with the
+        remote entry `remote_data`, with the fingerprint of the local file
+        so it isn't hashed again by the next scan. `verified_hash` is the
+        hash of the received data, if it was computed.
+        """
+        if remote_data.get('deleted', False):
+            return remote_data
+
+        file_path = self.get_file_path(file_name)
+
+        try:
+            if self.preserve_mtime and 'mtime_ns' in remote_data:
+                stat = os.stat(file_path)
+                os.utime(
+                    file_path,
+                    ns=(stat.st_atime_ns, remote_data['mtime_ns'])
+                )
+
+            stat = os.stat(file_path)
+        except OSError as ex:
+            self.logger.error(
+                "Can't stat received file {}: {}".format(file_name, ex)
+            )
+            return remote_data
+
+        file_data = copy_entry(remote_data)
+        file_data.update(scanner.get_fingerprint(stat))
+
+        if verified_hash is not None:
+            file_data['hash'] = verified_hash
+
+        return file_data
+
+    @staticmethod
+    def __get_transfer_files(transfer):
+        if transfer.rename_from is not None:
+            return {transfer.file_name, transfer.rename_from}
+
+        return {transfer.file_name}
 
     def __update_index_after_transfer(self, file_name, file_index, uuid, time):
+        file_index = copy_entry(file_index)
         file_index['sync_log'][uuid] = time
-        self._index[file_name] = file_index
+        self._put_index_unsafe(file_name, file_index)
 
         self.last_update = datetime.now().timestamp()
         self.transfer_finalized.notify((uuid, file_name, file_index))
 
 
+def merge_sync_logs(sync_log, other_sync_log):
+    """
+    Return a sync log with the later time of each location in the two.
+    """
+    merged = dict(sync_log)
+
+    for location, time in other_sync_log.items():
+        if location not in merged or merged[location] < time:
+            merged[location] = time
+
+    return merged
+
+
+def copy_entry(file_data):
+    """
+    Return a copy of an index entry that can be changed independently.
+    """
+    return IndexEntry(file_data)
+
+
+class IndexUpdate:
+    """
+    Index entries staged by a scan against a snapshot of the index
+    (`base`), to be committed to the index at once. It's a context
+    manager which closes the snapshot.
+    """
+
+    def __init__(self, base):
+        self.base = base
+
+        # file name -> new entry
+        self.entries = dict()
+        # Names of the files changed (not only re-fingerprinted)
+        self.changes = set()
+
+    def get(self, file_name):
+        file_data = self.entries.get(file_name)
+
+        if file_data is None:
+            file_data = self.base.get(file_name)
+
+        return file_data
+
+    def put(self, file_name, file_data):
+        self.entries[file_name] = file_data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.base.close()
+
+
 class IndexDiff:
     @staticmethod
     def diff(local, remote):
@@ -386,7 +1282,7 @@ class IndexDiff:
                 remote.get(file, None)
             )
 
-            if sync_status == NEEDS_UPDATE:
+            if sync_status in (NEEDS_UPDATE, SAME_CONTENT):
                 updates.add(file)
             elif sync_status == CONFLICT:
                 conflicts.add(file)
@@ -401,22 +1297,40 @@ class IndexDiff:
 
         Return NEEDS_UPDATE if file needs to be synchronized (local -> remote),
         CONFLICT on conflict and NOT_MODIFIED otherwise.
+
+        If the files would be updated or in conflict but their contents
+        are the same, return SAME_CONTENT instead: only the sync log needs
+        to be sent. For conflicts only the side with the later update
+        sends it.
         """
         if remote is None:
             if 'deleted' not in local or not local['deleted']:
                 return NEEDS_UPDATE
 
+            # Deleted file the remote doesn't know about
+            return NOT_MODIFIED
+
         if (local['last_update_location'] in remote['sync_log'] and
                 local['last_update'] <=
                 remote['sync_log'][local['last_update_location']]):
             # File on remote is either the same or derived from this one
             return NOT_MODIFIED
 
-        elif (remote['last_update_location'] in local['sync_log'] and
+        content_equal = same_content(local, remote)
+
+        if (remote['last_update_location'] in local['sync_log'] and
                 remote['last_update'] <=
                 local['sync_log'][remote['last_update_location']]):
             # File needs to be transferred to remote
-            return NEEDS_UPDATE
+            return SAME_CONTENT if content_equal else NEEDS_UPDATE
+
+        if content_equal:
+            # Both sides would send the sync log otherwise
+            if (local['last_update'], local['last_update_location']) > \
+                    (remote['last_update'], remote['last_update_location']):
+                return SAME_CONTENT
+
+            return NOT_MODIFIED
 
         # Files are in conflict
         return CONFLICT
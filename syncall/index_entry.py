@@ -0,0 +1,330 @@
+import sys
+import threading
+
+from array import array
+from collections.abc import Mapping, MutableMapping
+
+
+# Peer UUIDs are interned to small integer ids (their position in
+# `PEERS`) so index entries don't keep their own copies of the strings.
+# The ids are only valid in the current process.
+PEER_IDS = dict()
+PEERS = []
+PEERS_LOCK = threading.Lock()
+
+
+def get_peer_id(uuid):
+    peer_id = PEER_IDS.get(uuid)
+
+    if peer_id is None:
+        with PEERS_LOCK:
+            peer_id = PEER_IDS.get(uuid)
+
+            if peer_id is None:
+                peer_id = len(PEERS)
+                PEERS.append(uuid)
+                PEER_IDS[uuid] = peer_id
+
+    return peer_id
+
+
+def get_peer(peer_id):
+    return PEERS[peer_id]
+
+
+def pack_sync_log(sync_log):
+    """
+    Return the sync log {<uuid>: <timestamp>} as an array of
+    <peer id>, <timestamp> pairs.
+    """
+    data = []
+
+    for uuid, timestamp in sync_log.items():
+        data.append(get_peer_id(uuid))
+        data.append(timestamp)
+
+    # Not appended to the array as it would over-allocate
+    return array('d', data)
+
+
+def unpack_sync_log(data):
+    return {
+        PEERS[int(data[index])]: data[index + 1]
+        for index in range(0, len(data), 2)
+    }
+
+
+class SyncLog(MutableMapping):
+    """
+    Dict-like view of an `IndexEntry`'s sync log. Changes are written
+    to the entry.
+    """
+
+    __slots__ = ('entry',)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def __find(self, uuid):
+        peer_id = PEER_IDS.get(uuid)
+
+        if peer_id is not None:
+            data = self.entry._sync_log
+
+            for index in range(0, len(data), 2):
+                if data[index] == peer_id:
+                    return index
+
+        return None
+
+    def __getitem__(self, uuid):
+        index = self.__find(uuid)
+
+        if index is None:
+            raise KeyError(uuid)
+
+        return self.entry._sync_log[index + 1]
+
+    def __setitem__(self, uuid, timestamp):
+        index = self.__find(uuid)
+
+        if index is None:
+            self.entry._sync_log.append(get_peer_id(uuid))
+            self.entry._sync_log.append(timestamp)
+        else:
+            self.entry._sync_log[index + 1] = timestamp
+
+    def __delitem__(self, uuid):
+        index = self.__find(uuid)
+
+        if index is None:
+            raise KeyError(uuid)
+
+        del self.entry._sync_log[index:index + 2]
+
+    def __contains__(self, uuid):
+        return self.__find(uuid) is not None
+
+    def __iter__(self):
+        data = self.entry._sync_log
+
+        for index in range(0, len(data), 2):
+            yield PEERS[int(data[index])]
+
+    def __len__(self):
+        return len(self.entry._sync_log) // 2
+
+    def items(self):
+        return unpack_sync_log(self.entry._sync_log).items()
+
+    def __eq__(self, other):
+        if isinstance(other, SyncLog):
+            other = unpack_sync_log(other.entry._sync_log)
+
+        return unpack_sync_log(self.entry._sync_log) == other
+
+    def __repr__(self):
+        return repr(unpack_sync_log(self.entry._sync_log))
+
+
+class IndexEntry(MutableMapping):
+    """
+    Compact index entry with the dict interface of the index entries.
+
+    The known keys are kept in slots: the last update location as an
+    interned peer id, the sync log as an array of peer id and timestamp
+    pairs (`entry['sync_log']` is a `SyncLog` view of it) and the hash
+    as bytes. Unknown keys are kept in a dict.
+    """
+
+    # Known keys in iteration order and their slots
+    SLOTS = {
+        'last_update': '_last_update',
+        'last_update_location': '_location',
+        'hash': '_hash',
+        'hash_algorithm': '_hash_algorithm',
+        'sync_log': '_sync_log',
+        'size': '_size',
+        'inode': '_inode',
+        'mtime_ns': '_mtime_ns',
+        'deleted': '_deleted'
+    }
+
+    __slots__ = tuple(SLOTS.values()) + ('_extra',)
+
+    def __init__(self, file_data=None):
+        self._extra = None
+
+        if isinstance(file_data, IndexEntry):
+            for slot in self.__slots__:
+                if hasattr(file_data, slot):
+                    setattr(self, slot, getattr(file_data, slot))
+
+            if hasattr(file_data, '_sync_log'):
+                self._sync_log = array('d', file_data._sync_log)
+            if file_data._extra is not None:
+                self._extra = dict(file_data._extra)
+        elif file_data is not None:
+            for key, value in file_data.items():
+                self[key] = value
+
+    @classmethod
+    def compact(cls, file_data):
+        """
+        Return `file_data` as an `IndexEntry` (`file_data` itself if it
+        already is one).
+        """
+        if isinstance(file_data, cls):
+            return file_data
+
+        return cls(file_data)
+
+    def __getitem__(self, key):
+        slot = self.SLOTS.get(key)
+
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(key)
+
+            return self._extra[key]
+
+        try:
+            value = getattr(self, slot)
+        except AttributeError:
+            raise KeyError(key) from None
+
+        if key == 'last_update_location':
+            return PEERS[value]
+        elif key == 'sync_log':
+            return SyncLog(self)
+
+        return value
+
+    def __setitem__(self, key, value):
+        slot = self.SLOTS.get(key)
+
+        if slot is None:
+            if self._extra is None:
+                self._extra = dict()
+
+            self._extra[key] = value
+            return
+
+        if key == 'last_update_location':
+            value = get_peer_id(value)
+        elif key == 'sync_log':
+            value = pack_sync_log(value)
+        elif key == 'hash_algorithm' and isinstance(value, str):
+            value = sys.intern(value)
+        elif key == 'hash' and isinstance(value, (bytearray, memoryview)):
+            value = bytes(value)
+
+        setattr(self, slot, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __delitem__(self, key):
+        slot = self.SLOTS.get(key)
+
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(key)
+
+            del self._extra[key]
+            return
+
+        try:
+            delattr(self, slot)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        slot = self.SLOTS.get(key)
+
+        if slot is None:
+            return self._extra is not None and key in self._extra
+
+        return hasattr(self, slot)
+
+    def __iter__(self):
+        for key, slot in self.SLOTS.items():
+            if hasattr(self, slot):
+                yield key
+
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def setdefault(self, key, default=None):
+        # MutableMapping.setdefault returns `default`, which isn't the
+        # stored value for the sync log
+        if key not in self:
+            self[key] = default
+
+        return self[key]
+
+    def copy(self):
+        return IndexEntry(self)
+
+    def to_dict(self):
+        file_data = dict()
+
+        for key, slot in self.SLOTS.items():
+            if hasattr(self, slot):
+                file_data[key] = getattr(self, slot)
+
+        if 'last_update_location' in file_data:
+            file_data['last_update_location'] = \
+                PEERS[file_data['last_update_location']]
+        if 'sync_log' in file_data:
+            file_data['sync_log'] = unpack_sync_log(file_data['sync_log'])
+        if self._extra is not None:
+            file_data.update(self._extra)
+
+        return file_data
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __eq__(self, other):
+        if isinstance(other, IndexEntry):
+            other = other.to_dict()
+        elif not isinstance(other, Mapping):
+            return NotImplemented
+
+        return self.to_dict() == other
+
+    def __reduce__(self):
+        # The peer ids are only valid in this process
+        return (IndexEntry, (self.to_dict(),))
+
+    def __repr__(self):
+        return 'IndexEntry({!r})'.format(self.to_dict())
+
+
+def compact_index(index):
+    """
+    Return a dict with the entries of `index` as `IndexEntry`s.
+    """
+    return {
+        file_name: IndexEntry.compact(file_data)
+        for file_name, file_data in index.items()
+    }
+
+
+def msgpack_default(obj):
+    """
+    `default` hook for msgpack to pack index entries as maps.
+    """
+    if isinstance(obj, IndexEntry):
+        return obj.to_dict()
+    elif isinstance(obj, Mapping):
+        return dict(obj)
+
+    raise TypeError("Can't serialize {!r}".format(obj))
@@ -0,0 +1,1054 @@
+import logging
+import threading
+import mmap
+import os
+import struct
+import sqlite3
+import zlib
+import msgpack
+import bintools
+
+from collections.abc import Mapping, MutableMapping, ItemsView
+from syncall.index_entry import IndexEntry, msgpack_default
+
+
+class MappedSnapshot:
+    """
+    Read-only, memory-mapped index snapshot. Entries are looked up by
+    binary search over the offset table and only the requested entries
+    are read, so opening a snapshot doesn't depend on its size.
+
+    Format (integers are little endian):
+        <header> ::= MAGIC <version (uint32)> <seq (uint64)>
+                     <count (uint64)>
+        <offset table> ::= <record offset (uint64)> * count
+        <records> ::= (<name length (uint32)> <data length (uint32)>
+                       <utf-8 name> <msgpack file data>) * count
+    Records are sorted by name.
+    """
+
+    MAGIC = b'SYNCALLI'
+    VERSION = 2
+
+    HEADER = struct.Struct('<8sIQQ')
+    OFFSET = struct.Struct('<Q')
+    RECORD_HEADER = struct.Struct('<II')
+
+    def __init__(self, file):
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.seq, self.count = \
+            self.HEADER.unpack_from(self.map, 0)
+
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("Unknown index snapshot format")
+
+    @classmethod
+    def is_mapped_snapshot(cls, data):
+        return data[:len(cls.MAGIC)] == cls.MAGIC
+
+    @classmethod
+    def pack(cls, seq, records):
+        """
+        Return a snapshot with the (name, msgpack data) tuples of
+        `records`, which must be sorted by name.
+        """
+        records = [
+            (name.encode('utf-8'), data) for name, data in records
+        ]
+
+        offsets = []
+        offset = cls.HEADER.size + cls.OFFSET.size * len(records)
+
+        for name, data in records:
+            offsets.append(cls.OFFSET.pack(offset))
+            offset += cls.RECORD_HEADER.size + len(name) + len(data)
+
+        parts = [cls.HEADER.pack(cls.MAGIC, cls.VERSION, seq, len(records))]
+        parts.extend(offsets)
+
+        for name, data in records:
+            parts.append(cls.RECORD_HEADER.pack(len(name), len(data)))
+            parts.append(name)
+            parts.append(data)
+
+        return b''.join(parts)
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, position):
+        """
+        Return (name offset, name length, data length) of a record.
+        """
+        offset = self.OFFSET.unpack_from(
+            self.map,
+            self.HEADER.size + self.OFFSET.size * position
+        )[0]
+        name_length, data_length = \
+            self.RECORD_HEADER.unpack_from(self.map, offset)
+
+        return (offset + self.RECORD_HEADER.size, name_length, data_length)
+
+    def _name(self, position):
+        offset, name_length, data_length = self._record(position)
+
+        return self.map[offset:offset + name_length]
+
+    def _data(self, position):
+        offset, name_length, data_length = self._record(position)
+        offset += name_length
+
+        return self.map[offset:offset + data_length]
+
+    def bisect(self, name):
+        """
+        Return the position of the first record with a name >= `name`.
+        """
+        name = name.encode('utf-8')
+        low = 0
+        high = self.count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def get(self, name):
+        """
+        Return the msgpack data of the entry `name` or None.
+        """
+        position = self.bisect(name)
+
+        if position < self.count and \
+                self._name(position) == name.encode('utf-8'):
+            return self._data(position)
+
+        return None
+
+    def records(self, start=0, end=None):
+        """
+        Generator of the (name, msgpack data) of the records in
+        [start, end) positions.
+        """
+        if end is None:
+            end = self.count
+
+        for position in range(start, end):
+            offset, name_length, data_length = self._record(position)
+            data_offset = offset + name_length
+
+            yield (
+                self.map[offset:data_offset].decode('utf-8'),
+                self.map[data_offset:data_offset + data_length]
+            )
+
+
+class JournalIndexView(Mapping):
+    """
+    Read-only index made of a mapped snapshot and the in-memory entries
+    changed since it (`DELETED` for removed ones).
+
+    `JournalIndexStore.snapshot` returns views with a copy of the
+    in-memory entries, which aren't affected by later changes of the
+    store. The snapshot file is immutable (compaction writes a new one).
+    Like `SQLiteSnapshot` they can be closed and used as context
+    managers, though they don't hold anything that needs it.
+    """
+
+    # Value of the in-memory entries removed from the snapshot
+    DELETED = object()
+
+    # The entries are in memory or in the mapped snapshot, so structures
+    # derived from the whole index can be held in memory too
+    in_memory = True
+
+    def __init__(self, snapshot, data, length):
+        self._snapshot = snapshot
+        self._data = data
+        self._length = length
+
+    @staticmethod
+    def _decode(data):
+        # Decode the object to utf strings except the hash values
+        return bintools.decode_object(
+            msgpack.unpackb(data),
+            except_keys=('hash', 'hashes')
+        )
+
+    def __getitem__(self, file_name):
+        file_data = self._data.get(file_name)
+
+        if file_data is self.DELETED:
+            raise KeyError(file_name)
+        elif file_data is not None:
+            return file_data
+
+        if self._snapshot is not None:
+            data = self._snapshot.get(file_name)
+
+            if data is not None:
+                return IndexEntry(self._decode(data))
+
+        raise KeyError(file_name)
+
+    def __contains__(self, file_name):
+        file_data = self._data.get(file_name)
+
+        if file_data is not None:
+            return file_data is not self.DELETED
+
+        return self._snapshot is not None and \
+            self._snapshot.get(file_name) is not None
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for file_name, file_data in self._merged_records():
+            yield file_name
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def items(self):
+        return JournalItemsView(self)
+
+    def _merged_records(self):
+        """
+        Generator of (file_name, file_data) of all entries, ordered by name.
+        `file_data` is the in-memory entry or the snapshot's msgpack data.
+        """
+        changed = sorted(self._data)
+        records = self._snapshot.records() if self._snapshot else iter(())
+        index = 0
+
+        for file_name, data in records:
+            while index < len(changed) and changed[index] < file_name:
+                file_data = self._data[changed[index]]
+
+                if file_data is not self.DELETED:
+                    yield (changed[index], file_data)
+
+                index += 1
+
+            if index < len(changed) and changed[index] == file_name:
+                index += 1
+                data = self._data[file_name]
+
+                if data is self.DELETED:
+                    continue
+
+            yield (file_name, data)
+
+        for file_name in changed[index:]:
+            file_data = self._data[file_name]
+
+            if file_data is not self.DELETED:
+                yield (file_name, file_data)
+
+    def prefix_items(self, prefix):
+        """
+        Return a list of the (file_name, file_data) of the entry named
+        `prefix` and all entries below the `prefix` directory.
+        """
+        directory_prefix = prefix + '/'
+        names = set(
+            file_name for file_name in self._data
+            if file_name == prefix or file_name.startswith(directory_prefix)
+        )
+
+        if self._snapshot is not None:
+            if self._snapshot.get(prefix) is not None:
+                names.add(prefix)
+
+            # '0' is the character after '/'
+            names.update(
+                file_name for file_name, data in self._snapshot.records(
+                    self._snapshot.bisect(directory_prefix),
+                    self._snapshot.bisect(prefix + '0')
+                )
+            )
+
+        return [
+            (file_name, self[file_name]) for file_name in sorted(names)
+            if file_name in self
+        ]
+
+    def updated_since(self, timestamp):
+        """
+        Return a list of the names of the entries with a `last_update`
+        after `timestamp`.
+        """
+        return [
+            file_name for file_name, file_data in self.items()
+            if file_data['last_update'] > timestamp
+        ]
+
+
+class JournalItemsView(ItemsView):
+    def __iter__(self):
+        for file_name, file_data in self._mapping._merged_records():
+            if isinstance(file_data, bytes):
+                file_data = IndexEntry(self._mapping._decode(file_data))
+
+            yield (file_name, file_data)
+
+
+class JournalIndexStore(JournalIndexView, MutableMapping):
+    """
+    Index (file name -> file data) persisted as a base snapshot plus an
+    append-only journal of changed entries.
+
+    The snapshot is memory-mapped (see `MappedSnapshot`) and its entries
+    are decoded when accessed, so loading the index only replays the
+    journal. Entries changed or removed since then are kept in memory.
+    Entries read from the snapshot are decoded again on each access,
+    so changes made in place have to be assigned back
+    (`store[name] = data`) to take effect and to be saved. In-memory
+    entries are shared with the snapshots (`snapshot`), so they must
+    not be changed in place at all.
+
+    Saving appends only the entries changed since the last save, so it
+    costs O(changes) instead of rewriting the whole index. When the
+    journal grows bigger than the snapshot it is compacted into a new
+    snapshot on a background thread.
+
+    All access, including `load` and `save`, must happen while holding
+    `lock`; background compaction acquires it too.
+
+    Journal format, a sequence of records:
+        <length (uint32 LE)> <crc32 of payload (uint32 LE)> <payload>
+        <payload> ::= msgpack [<seq>, <file_name>, <file_data or nil>]
+    Replaying stops at the first incomplete or corrupt record (and the
+    journal is truncated there), so a crash while writing loses at most
+    that last record. Records up to the snapshot's seq are skipped.
+
+    Snapshots in the earlier msgpack formats
+    ([1, <seq>, <index>] or just <index>) are loaded into memory and
+    rewritten on the next save.
+    """
+
+    RECORD_HEADER = struct.Struct('<II')
+
+    # Compact when the journal is bigger than the snapshot, but not
+    # before it reaches this size
+    MIN_COMPACTION_SIZE = 1024 * 1024
+
+    def __init__(self, path, lock, background_compaction=True):
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.lock = lock
+        self.background_compaction = background_compaction
+
+        # The snapshot and the entries changed since it (or DELETED)
+        JournalIndexView.__init__(self, None, dict(), 0)
+
+        # Names changed since the last save
+        self._dirty = set()
+        # Names changed since the compaction in progress started
+        self._changed = set()
+
+        self._seq = 0
+        self._snapshot_size = 0
+        self._journal_size = 0
+        self._needs_compaction = False
+        self._compaction_thread = None
+
+    def _put(self, file_name, file_data):
+        """
+        Change an entry (`DELETED` to remove it) without marking it dirty.
+        """
+        exists = file_name in self
+
+        if file_data is self.DELETED:
+            if exists:
+                self._length -= 1
+        else:
+            file_data = IndexEntry.compact(file_data)
+
+            if not exists:
+                self._length += 1
+
+        self._data[file_name] = file_data
+
+    def __setitem__(self, file_name, file_data):
+        self._put(file_name, file_data)
+        self._dirty.add(file_name)
+        self._changed.add(file_name)
+
+    def __delitem__(self, file_name):
+        if file_name not in self:
+            raise KeyError(file_name)
+
+        self[file_name] = self.DELETED
+
+    def snapshot(self):
+        """
+        Return a read-only view of the current index which isn't affected
+        by later changes. Costs O(entries changed since the last
+        compaction).
+        """
+        return JournalIndexView(self._snapshot, dict(self._data), self._length)
+
+    def load(self):
+        self._data = dict()
+        self._dirty = set()
+        self._snapshot = None
+        self._length = 0
+        self._seq = 0
+        self._snapshot_size = 0
+        self._journal_size = 0
+        self._needs_compaction = False
+
+        if os.path.isfile(self.path):
+            self.__load_snapshot()
+
+        if os.path.isfile(self.journal_path):
+            self.__replay_journal()
+
+    def __load_snapshot(self):
+        with open(self.path, 'rb') as snapshot_file:
+            self._snapshot_size = os.fstat(snapshot_file.fileno()).st_size
+
+            if MappedSnapshot.is_mapped_snapshot(
+                    snapshot_file.read(len(MappedSnapshot.MAGIC))):
+                self._snapshot = MappedSnapshot(snapshot_file)
+                self._seq = self._snapshot.seq
+                self._length = len(self._snapshot)
+
+                return
+
+            snapshot_file.seek(0)
+            snapshot = msgpack.unpackb(snapshot_file.read())
+
+        if isinstance(snapshot, dict):
+            index = snapshot
+        elif snapshot[0] == 1:
+            self._seq = snapshot[1]
+            index = snapshot[2]
+        else:
+            raise ValueError(
+                "Unknown index snapshot version {}".format(snapshot[0])
+            )
+
+        self._data = {
+            file_name: IndexEntry(file_data)
+            for file_name, file_data in bintools.decode_object(
+                index,
+                except_keys=('hash', 'hashes')
+            ).items()
+        }
+        self._length = len(self._data)
+        self._needs_compaction = True
+
+    def __replay_journal(self):
+        with open(self.journal_path, 'rb') as journal:
+            data = journal.read()
+
+        offset = 0
+        header_size = self.RECORD_HEADER.size
+
+        while offset + header_size <= len(data):
+            length, crc = self.RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + header_size:offset + header_size + length]
+
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+
+            seq, file_name, file_data = self._decode(payload)
+
+            # Records up to the snapshot's seq are already in it
+            # (the journal wasn't truncated after the last compaction)
+            if seq > self._seq:
+                if file_data is None:
+                    self._put(file_name, self.DELETED)
+                else:
+                    self._put(file_name, file_data)
+
+                self._seq = seq
+
+            offset += header_size + length
+
+        if offset < len(data):
+            self.logger.error(
+                "Discarding {} bytes of incomplete index journal records"
+                .format(len(data) - offset)
+            )
+
+            with open(self.journal_path, 'r+b') as journal:
+                journal.truncate(offset)
+
+        self._journal_size = offset
+
+    def save(self):
+        """
+        Persist the entries changed since the last save.
+        """
+        if not os.path.isfile(self.path) or self._needs_compaction:
+            self.__compact_locked()
+            return
+
+        if not self._dirty:
+            return
+
+        records = []
+
+        for file_name in self._dirty:
+            file_data = self._data.get(file_name)
+            if file_data is self.DELETED:
+                file_data = None
+
+            self._seq += 1
+            payload = msgpack.packb(
+                [self._seq, file_name, file_data],
+                default=msgpack_default
+            )
+
+            records.append(
+                self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+            )
+            records.append(payload)
+
+        data = b''.join(records)
+
+        with open(self.journal_path, 'ab') as journal:
+            journal.write(data)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        self._journal_size += len(data)
+        self._dirty = set()
+
+        if self._journal_size > max(self.MIN_COMPACTION_SIZE,
+                                    self._snapshot_size):
+            if self.background_compaction:
+                self.__start_compaction()
+            else:
+                self.__compact_locked()
+
+    def __start_compaction(self):
+        if self._compaction_thread is not None and \
+                self._compaction_thread.is_alive():
+            return
+
+        self._compaction_thread = threading.Thread(target=self.compact)
+        self._compaction_thread.daemon = True
+        self._compaction_thread.start()
+
+    def wait_for_compaction(self):
+        thread = self._compaction_thread
+
+        if thread is not None:
+            thread.join()
+
+    def compact(self):
+        """
+        Write a new snapshot with the whole index and drop the journal
+        records it includes. Must be called without holding `lock`.
+        """
+        with self.lock:
+            snapshot, journal_offset = self.__pack_snapshot()
+
+        self.__write_snapshot(snapshot)
+
+        with self.lock:
+            self.__open_snapshot()
+            self.__truncate_journal(journal_offset)
+
+    def __compact_locked(self):
+        snapshot, journal_offset = self.__pack_snapshot()
+
+        # The unsaved changes are in the snapshot
+        self._dirty = set()
+        self._changed = set()
+
+        self.__write_snapshot(snapshot)
+        self.__open_snapshot()
+        self.__truncate_journal(journal_offset)
+
+    def __pack_snapshot(self):
+        # Unsaved entries are kept in memory, the next `save` journals
+        # them (the snapshot's seq doesn't include them)
+        self._changed = set(self._dirty)
+
+        snapshot = MappedSnapshot.pack(self._seq, (
+            (file_name, file_data if isinstance(file_data, bytes)
+             else msgpack.packb(file_data, default=msgpack_default))
+            for file_name, file_data in self._merged_records()
+        ))
+
+        return (snapshot, self._journal_size)
+
+    def __write_snapshot(self, snapshot):
+        temp_path = self.path + '.tmp'
+
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(snapshot)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+        os.replace(temp_path, self.path)
+        self._snapshot_size = len(snapshot)
+
+    def __open_snapshot(self):
+        """
+        Map the new snapshot and drop the in-memory entries it contains
+        (those not changed while it was being written).
+        """
+        with open(self.path, 'rb') as snapshot_file:
+            self._snapshot = MappedSnapshot(snapshot_file)
+
+        self._data = {
+            file_name: file_data
+            for file_name, file_data in self._data.items()
+            if file_name in self._changed
+        }
+        self._needs_compaction = False
+
+    def __truncate_journal(self, offset):
+        """
+        Remove the first `offset` bytes of the journal, keeping the records
+        appended while the snapshot was being written.
+        """
+        if not os.path.isfile(self.journal_path):
+            self._journal_size = 0
+            return
+
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(offset)
+            tail = journal.read()
+
+        temp_path = self.journal_path + '.tmp'
+
+        with open(temp_path, 'wb') as journal:
+            journal.write(tail)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        os.replace(temp_path, self.journal_path)
+        self._journal_size = len(tail)
+
+
+class SQLiteIndexView(Mapping):
+    """
+    Read-only access to the index database through `connection`.
+    """
+
+    BATCH_SIZE = 1000
+
+    # See `JournalIndexView.in_memory`
+    in_memory = False
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    @staticmethod
+    def _decode(data):
+        return IndexEntry(bintools.decode_object(
+            msgpack.unpackb(data),
+            except_keys=('hash', 'hashes')
+        ))
+
+    def __getitem__(self, file_name):
+        row = self._connection.execute(
+            'SELECT data FROM files WHERE name = ?',
+            (file_name,)
+        ).fetchone()
+
+        if row is None:
+            raise KeyError(file_name)
+
+        return self._decode(row[0])
+
+    def __contains__(self, file_name):
+        return self._connection.execute(
+            'SELECT 1 FROM files WHERE name = ?',
+            (file_name,)
+        ).fetchone() is not None
+
+    def __len__(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM files'
+        ).fetchone()[0]
+
+    def __iter__(self):
+        for file_name, data in self._iter_rows():
+            yield file_name
+
+    def items(self):
+        return SQLiteItemsView(self)
+
+    def _iter_rows(self, start='', end=None):
+        """
+        Iterate (name, data) rows ordered by name, `BATCH_SIZE` at a time,
+        so the index can be changed while iterating and at most one batch
+        is held in memory.
+        """
+        name = None
+
+        while True:
+            if name is None:
+                condition, args = 'name >= ?', [start]
+            else:
+                condition, args = 'name > ?', [name]
+
+            if end is not None:
+                condition += ' AND name < ?'
+                args.append(end)
+
+            rows = self._connection.execute(
+                'SELECT name, data FROM files WHERE {} '
+                'ORDER BY name LIMIT ?'.format(condition),
+                args + [self.BATCH_SIZE]
+            ).fetchall()
+
+            for row in rows:
+                yield row
+
+            if len(rows) < self.BATCH_SIZE:
+                return
+
+            name = rows[-1][0]
+
+    def prefix_items(self, prefix):
+        """
+        Return a list of the (file_name, file_data) of the entry named
+        `prefix` and all entries below the `prefix` directory.
+        """
+        items = []
+
+        if prefix in self:
+            items.append((prefix, self[prefix]))
+
+        # '0' is the character after '/'
+        for file_name, data in self._iter_rows(prefix + '/', prefix + '0'):
+            items.append((file_name, self._decode(data)))
+
+        return items
+
+    def dir_items(self, dir_path):
+        """
+        Generator of the (file_name, file_data) of the entries directly
+        in the `dir_path` directory ('' is the top one). The entries of
+        its subdirectories are skipped with range queries.
+        """
+        prefix = dir_path + '/' if dir_path else ''
+        # '0' is the character after '/'
+        end = dir_path + '0' if dir_path else None
+        start = prefix
+
+        while start is not None:
+            next_start = None
+
+            for file_name, data in self._iter_rows(start, end):
+                separator = file_name.find('/', len(prefix))
+
+                if separator == -1:
+                    yield (file_name, self._decode(data))
+                else:
+                    # Continue after the subdirectory
+                    next_start = file_name[:separator] + '0'
+                    break
+
+            start = next_start
+
+    def updated_since(self, timestamp):
+        """
+        Return a list of the names of the entries with a `last_update`
+        after `timestamp`.
+        """
+        return [
+            row[0] for row in self._connection.execute(
+                'SELECT name FROM files WHERE last_update > ?',
+                (timestamp,)
+            )
+        ]
+
+
+class SQLiteItemsView(ItemsView):
+    def __iter__(self):
+        for file_name, data in self._mapping._iter_rows():
+            yield (file_name, self._mapping._decode(data))
+
+
+class SQLiteSnapshot(SQLiteIndexView):
+    """
+    View of the index database as it was when created. It has its own
+    connection holding a read transaction, which (in WAL mode) keeps
+    seeing that state while the database is changed, but also keeps
+    the database from being checkpointed past it. So it should be
+    closed (`close` or `with`) as soon as it's not needed; that ends the
+    transaction and gives the connection back to `store` for the next
+    snapshots.
+    """
+
+    def __init__(self, store, connection):
+        # The read transaction starts with its first read
+        connection.execute('BEGIN')
+        connection.execute('SELECT 1 FROM files LIMIT 1').fetchone()
+
+        super().__init__(connection)
+        self._store = store
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._store._release_connection(self._connection)
+            self._connection = None
+
+    def __del__(self):
+        self.close()
+
+
+class SQLiteIndexStore(SQLiteIndexView, MutableMapping):
+    """
+    Index (file name -> file data) kept in an SQLite database instead of
+    memory, for shares with too many files to hold the whole index.
+
+    Entries are msgpack blobs decoded on every access, so changing a
+    returned entry in place has no effect until it's assigned back.
+    Changes are visible right away and are committed to the database by
+    `save`. Like `JournalIndexStore`, all access must happen while
+    holding `lock`.
+
+    The file names are the (clustered) primary key, so the entries below
+    a directory are a range query, and `last_update` has its own index.
+    """
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY,
+            last_update REAL NOT NULL,
+            data BLOB NOT NULL
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS files_last_update
+            ON files (last_update)
+        """
+    )
+
+    # Connections of closed snapshots kept for the next snapshots
+    MAX_IDLE_CONNECTIONS = 2
+
+    def __init__(self, path, lock):
+        self.path = path + '.sqlite'
+        self.lock = lock
+
+        SQLiteIndexView.__init__(self, None)
+
+        # Snapshots are closed without holding `lock`
+        self._idle_lock = threading.Lock()
+        self._idle_connections = []
+
+    def load(self):
+        if self._connection is not None:
+            self._connection.close()
+
+        # Used from the thread holding `lock`, which changes
+        self._connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False
+        )
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+
+        for statement in self.SCHEMA:
+            self._connection.execute(statement)
+
+        self._connection.commit()
+
+    def save(self):
+        self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+        with self._idle_lock:
+            for connection in self._idle_connections:
+                connection.close()
+
+            self._idle_connections = []
+
+    def snapshot(self):
+        """
+        Return a read-only view of the current index which isn't affected
+        by later changes (see `SQLiteSnapshot`). The pending changes are
+        committed first, as other connections don't see them until then.
+        """
+        self._connection.commit()
+
+        with self._idle_lock:
+            if self._idle_connections:
+                connection = self._idle_connections.pop()
+            else:
+                connection = None
+
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path,
+                check_same_thread=False,
+                isolation_level=None
+            )
+
+        return SQLiteSnapshot(self, connection)
+
+    def _release_connection(self, connection):
+        """
+        End the read transaction of a closed snapshot's connection and
+        keep it for the next snapshots.
+        """
+        try:
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            connection.close()
+            return
+
+        with self._idle_lock:
+            if self._connection is not None and \
+                    len(self._idle_connections) < self.MAX_IDLE_CONNECTIONS:
+                self._idle_connections.append(connection)
+                return
+
+        connection.close()
+
+    def __setitem__(self, file_name, file_data):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO files (name, last_update, data) '
+            'VALUES (?, ?, ?)',
+            (
+                file_name,
+                file_data['last_update'],
+                msgpack.packb(file_data, default=msgpack_default)
+            )
+        )
+
+    def __delitem__(self, file_name):
+        cursor = self._connection.execute(
+            'DELETE FROM files WHERE name = ?',
+            (file_name,)
+        )
+
+        if cursor.rowcount == 0:
+            raise KeyError(file_name)
+
+
+class OverlayIndex(MutableMapping):
+    """
+    Index which starts as a read-only index (`base`, e.g. a store
+    snapshot) and keeps only its own changes in memory, so it doesn't
+    have to copy the base. The base must not change while it's used.
+    The overlay owns the base: `close` closes it too.
+    """
+
+    def __init__(self, base):
+        self._base = base
+        # Changed entries, None for the removed ones
+        self._data = dict()
+
+    def __getitem__(self, file_name):
+        if file_name not in self._data:
+            return self._base[file_name]
+
+        file_data = self._data[file_name]
+
+        if file_data is None:
+            raise KeyError(file_name)
+
+        return file_data
+
+    def __contains__(self, file_name):
+        if file_name in self._data:
+            return self._data[file_name] is not None
+
+        return file_name in self._base
+
+    def __setitem__(self, file_name, file_data):
+        self._data[file_name] = file_data
+
+    def __delitem__(self, file_name):
+        if file_name not in self:
+            raise KeyError(file_name)
+
+        self._data[file_name] = None
+
+    def __len__(self):
+        length = len(self._base)
+
+        for file_name, file_data in self._data.items():
+            in_base = file_name in self._base
+
+            if file_data is None and in_base:
+                length -= 1
+            elif file_data is not None and not in_base:
+                length += 1
+
+        return length
+
+    def __iter__(self):
+        for file_name, file_data in self.items():
+            yield file_name
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if hasattr(self._base, 'close'):
+            self._base.close()
+
+        self._base = dict()
+        self._data = dict()
+
+    def items(self):
+        return OverlayItemsView(self)
+
+
+class OverlayItemsView(ItemsView):
+    def __iter__(self):
+        changed = self._mapping._data
+
+        for file_name, file_data in self._mapping._base.items():
+            if file_name not in changed:
+                yield (file_name, file_data)
+
+        for file_name, file_data in list(changed.items()):
+            if file_data is not None:
+                yield (file_name, file_data)
+
+
+# Index backends selectable with the `index_backend` option of `Directory`
+INDEX_STORES = {
+    'journal': JournalIndexStore,
+    'sqlite': SQLiteIndexStore
+}
@@ -0,0 +1,403 @@
+import copy
+import hashlib
+import msgpack
+
+from syncall.index_store import OverlayIndex
+
+
+def hash_entry(file_data):
+    """
+    Return the hash (hex string) of the synchronization state of an index
+    entry. The local file system fingerprint (size, inode, mtime_ns) is
+    left out as it differs between peers, and the timestamps are hashed
+    as floats so 5 and 5.0 hash the same.
+    """
+    sync_log = sorted(
+        [uuid, float(timestamp)]
+        for uuid, timestamp in file_data.get('sync_log', dict()).items()
+    )
+
+    data = msgpack.packb([
+        float(file_data.get('last_update', 0)),
+        file_data.get('last_update_location'),
+        file_data.get('hash', b''),
+        bool(file_data.get('deleted', False)),
+        sync_log
+    ])
+
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def hash_children(children):
+    """
+    Return the hash of a directory from its sorted (name, is directory,
+    hash) children.
+    """
+    hash = hashlib.blake2b(digest_size=16)
+
+    for name, is_dir, child_hash in children:
+        hash.update('{}\0{}\0{}\n'.format(
+            name,
+            'd' if is_dir else 'f',
+            child_hash
+        ).encode('utf-8'))
+
+    return hash.hexdigest()
+
+
+def split_path(file_name):
+    """
+    Return the (parent directory, name) of an index file name.
+    The top directory is ''.
+    """
+    parent, _, name = file_name.rpartition('/')
+
+    return (parent, name)
+
+
+class MerkleNode:
+    __slots__ = ('files', 'dirs', 'hash')
+
+    def __init__(self):
+        # name -> entry hash
+        self.files = dict()
+        # names of the subdirectories
+        self.dirs = set()
+        # Cached directory hash, None if it has to be computed again
+        self.hash = None
+
+    def copy(self):
+        node = MerkleNode()
+        node.files = dict(self.files)
+        node.dirs = set(self.dirs)
+        node.hash = self.hash
+
+        return node
+
+
+class MerkleTree:
+    """
+    Hash tree of an index following the directory structure. A file's
+    hash is `hash_entry` of its index entry and a directory's hash
+    covers the names and hashes of its children, so two indexes with
+    the same root hash have the same synchronization state and equal
+    directory hashes mean equal subtrees.
+
+    Changing an entry only invalidates the hashes of its directory and
+    their ancestors, which are computed again when requested.
+
+    Nodes are shared with the snapshots of the tree (see `snapshot`) and
+    copied before they are changed.
+    """
+
+    def __init__(self):
+        self.nodes = {'': MerkleNode()}
+        # Paths of the nodes which aren't shared with a snapshot
+        self._owned = {''}
+
+    @classmethod
+    def build(cls, index_items):
+        tree = cls()
+
+        for file_name, file_data in index_items:
+            tree.update(file_name, file_data)
+
+        return tree
+
+    def snapshot(self, index=None):
+        """
+        Return a read-only copy of the tree which isn't affected by later
+        changes. Costs O(directories) as the nodes are shared until
+        they are changed. `index` is a snapshot of the index taken at
+        the same time, for trees which read the entries from it.
+        """
+        tree = copy.copy(self)
+        tree.nodes = dict(self.nodes)
+        tree._owned = set()
+        self._owned = set()
+
+        return tree
+
+    def update(self, file_name, file_data):
+        """
+        Set the entry of `file_name`. `file_data` None removes it.
+        """
+        parent, name = split_path(file_name)
+
+        if file_data is None:
+            node = self.nodes.get(parent)
+
+            if node is None or name not in node.files:
+                return
+
+            del self._own(parent).files[name]
+            self._invalidate(parent)
+            self._remove_empty(parent)
+        else:
+            self._get_node(parent).files[name] = hash_entry(file_data)
+            self._invalidate(parent)
+
+    def _own(self, dir_path):
+        """
+        Return the node of an existing directory, copying it first if
+        it's shared with a snapshot.
+        """
+        node = self.nodes[dir_path]
+
+        if dir_path not in self._owned:
+            node = self.nodes[dir_path] = node.copy()
+            self._owned.add(dir_path)
+
+        return node
+
+    def _get_node(self, dir_path):
+        if dir_path in self.nodes:
+            return self._own(dir_path)
+
+        node = self.nodes[dir_path] = MerkleNode()
+        self._owned.add(dir_path)
+
+        parent, name = split_path(dir_path)
+        self._get_node(parent).dirs.add(name)
+
+        return node
+
+    def _remove_empty(self, dir_path):
+        while dir_path:
+            node = self.nodes[dir_path]
+
+            if node.dirs or self._has_files(dir_path, node):
+                return
+
+            del self.nodes[dir_path]
+            self._owned.discard(dir_path)
+
+            dir_path, name = split_path(dir_path)
+            self._own(dir_path).dirs.discard(name)
+
+    def _invalidate(self, dir_path):
+        while True:
+            self._own(dir_path).hash = None
+
+            if not dir_path:
+                return
+
+            dir_path = split_path(dir_path)[0]
+
+    def get_hash(self, dir_path=''):
+        """
+        Return the hash of a directory ('' is the root) or None if
+        there is no such directory.
+        """
+        node = self.nodes.get(dir_path)
+
+        if node is None:
+            return None
+
+        if node.hash is None:
+            node.hash = hash_children(self._children(dir_path, node))
+
+        return node.hash
+
+    def _file_hashes(self, dir_path, node):
+        """
+        Return an iterable of the (name, hash) of the files directly in
+        a directory.
+        """
+        return node.files.items()
+
+    def _has_files(self, dir_path, node):
+        return bool(node.files)
+
+    def _children(self, dir_path, node):
+        children = [
+            (name, False, file_hash)
+            for name, file_hash in self._file_hashes(dir_path, node)
+        ]
+
+        for name in node.dirs:
+            if dir_path:
+                child_path = dir_path + '/' + name
+            else:
+                child_path = name
+
+            children.append((name, True, self.get_hash(child_path)))
+
+        children.sort()
+
+        return children
+
+    def get_children(self, dir_path):
+        """
+        Return {<name>: [<is directory>, <hash>]} of the children of
+        a directory (empty if there is no such directory).
+        """
+        node = self.nodes.get(dir_path)
+
+        if node is None:
+            return dict()
+
+        return {
+            name: [is_dir, child_hash]
+            for name, is_dir, child_hash in self._children(dir_path, node)
+        }
+
+    def file_names(self, dir_path):
+        """
+        Generator of the names of all files below a directory.
+        """
+        node = self.nodes.get(dir_path)
+
+        if node is None:
+            return
+
+        for name in node.files:
+            yield dir_path + '/' + name if dir_path else name
+
+        for name in node.dirs:
+            yield from self.file_names(
+                dir_path + '/' + name if dir_path else name
+            )
+
+
+class IndexMerkleTree(MerkleTree):
+    """
+    Merkle tree of an index store which isn't held in memory (see
+    `SQLiteIndexView.dir_items`). Only the directories and their hashes
+    are kept, the hashes of the files in a directory are computed from
+    their entries in `index` when its hash or children are needed.
+
+    Entries must be changed in `index` before the tree is updated.
+    """
+
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    @classmethod
+    def build(cls, index):
+        tree = cls(index)
+
+        for file_name in index:
+            tree._get_node(split_path(file_name)[0])
+
+        return tree
+
+    def snapshot(self, index=None):
+        tree = super().snapshot()
+        tree.index = index
+
+        return tree
+
+    def update(self, file_name, file_data):
+        parent = split_path(file_name)[0]
+
+        if file_data is None:
+            if parent not in self.nodes:
+                return
+
+            self._invalidate(parent)
+            self._remove_empty(parent)
+        else:
+            self._get_node(parent)
+            self._invalidate(parent)
+
+    def _file_hashes(self, dir_path, node):
+        return (
+            (split_path(file_name)[1], hash_entry(file_data))
+            for file_name, file_data in self.index.dir_items(dir_path)
+        )
+
+    def _has_files(self, dir_path, node):
+        return next(iter(self.index.dir_items(dir_path)), None) is not None
+
+    def file_names(self, dir_path):
+        if dir_path not in self.nodes:
+            return
+
+        if dir_path:
+            for file_name, file_data in self.index.prefix_items(dir_path):
+                if file_name != dir_path:
+                    yield file_name
+        else:
+            yield from self.index
+
+
+class MerkleWalk:
+    """
+    Reconstructs a remote's index from a snapshot of the local index by
+    walking down only the subtrees whose hashes differ from the local ones.
+
+    `local_index` and `local_tree` (a `MerkleTree.snapshot`) must be
+    taken at the same time, so unchanged subtrees are taken from the same
+    index the hashes were compared against. `index` starts as the local
+    index (without copying it) and is corrected with each directory
+    listing and the entries received from the remote. `changed` has the
+    names of the files whose entries were found to differ.
+    """
+
+    def __init__(self, walk_id, local_index, local_tree):
+        self.id = walk_id
+        self.index = OverlayIndex(local_index)
+        self.local_tree = local_tree
+        self.changed = set()
+
+    def nodes_received(self, remote_dirs, remote_files):
+        """
+        Apply the children listings (`get_children` results) of remote
+        directories (`remote_dirs`) compared to the local ones and the
+        remote index entries in `remote_files`.
+
+        Return (dirs, files) that have to be requested from the remote
+        (both empty when the walk is complete).
+        """
+        dirs = []
+        files = []
+
+        self.index.update(remote_files)
+        self.changed.update(remote_files)
+
+        for dir_path, remote_children in remote_dirs.items():
+            local_children = self.local_tree.get_children(dir_path)
+
+            for name, (is_dir, child_hash) in remote_children.items():
+                if dir_path:
+                    child_path = dir_path + '/' + name
+                else:
+                    child_path = name
+
+                if local_children.get(name) == [is_dir, child_hash]:
+                    continue
+
+                if is_dir:
+                    dirs.append(child_path)
+                else:
+                    files.append(child_path)
+                    self.changed.add(child_path)
+
+                local_child = local_children.get(name)
+                if local_child is not None and local_child[0] != is_dir:
+                    # A file replaced by a directory or the other way around
+                    self.__remove(child_path, local_child[0])
+
+            for name, (is_dir, child_hash) in local_children.items():
+                if name not in remote_children:
+                    if dir_path:
+                        self.__remove(dir_path + '/' + name, is_dir)
+                    else:
+                        self.__remove(name, is_dir)
+
+        return (dirs, files)
+
+    def __remove(self, path, is_dir):
+        """
+        Remove a file or a directory missing on the remote.
+        """
+        if not is_dir:
+            self.index.pop(path, None)
+            self.changed.add(path)
+            return
+
+        for file_name in self.local_tree.file_names(path):
+            self.index.pop(file_name, None)
+            self.changed.add(file_name)
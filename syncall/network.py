@@ -9,6 +9,7 @@ from socketserver import TCPServer, StreamRequestHandler
 from threading import Thread
 
 from events import Event
+from syncall.index_entry import msgpack_default
 
 
 class Messanger(Thread):
@@ -34,6 +35,11 @@ class Messanger(Thread):
 
         self.__unpacker = msgpack.Unpacker()
 
+        # File receiving raw data (see `receive_raw`) and the number of
+        # bytes still expected
+        self.__raw_file = None
+        self.__raw_remaining = 0
+
     @staticmethod
     def connect(address, my_uuid, remote_uuid):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -76,10 +82,10 @@ class Messanger(Thread):
         self.packet_received.clear_handlers()
 
     def send(self, data):
-        packet = msgpack.packb(data)
+        packet = msgpack.packb(data, default=msgpack_default)
 
         try:
-            self.socket.send(packet)
+            self.socket.sendall(packet)
         except Exception as ex:
             self.logger.error(
                 "Couldn't send data to {}"
@@ -88,14 +94,76 @@ class Messanger(Thread):
             self.logger.exception(ex)
             self.disconnect()
 
+    def send_file(self, file, count):
+        """
+        Send `count` bytes of `file` from its start as raw data, with
+        `os.sendfile` where possible. The remote side has to expect them
+        (see `receive_raw`).
+
+        Return the number of bytes sent, which is less than `count` if
+        the file is shorter or the data couldn't be sent.
+        """
+        try:
+            return self.socket.sendfile(file, 0, count)
+        except Exception as ex:
+            self.logger.error(
+                "Couldn't send file data to {}"
+                .format(self.address[0])
+            )
+            self.logger.exception(ex)
+            self.disconnect()
+
+            return 0
+
+    def receive_raw(self, file, count):
+        """
+        Write the next `count` bytes of the stream to `file` instead of
+        decoding them as packets. Should be called from a
+        `packet_received` handler, the raw data follows the packet
+        being handled.
+        """
+        self.__raw_file = file
+        self.__raw_remaining = count
+
+    def __write_raw_data(self):
+        raw_data = self.__unpacker.read_bytes(self.__raw_remaining)
+
+        self.__raw_file.write(raw_data)
+        self.__raw_remaining -= len(raw_data)
+
+        if self.__raw_remaining == 0:
+            self.__raw_file = None
+
     def __handle_received_data(self, data):
         self.__unpacker.feed(data)
 
-        for packet in self.__unpacker:
+        while True:
+            if self.__raw_remaining > 0:
+                try:
+                    self.__write_raw_data()
+                except Exception as ex:
+                    self.logger.error(
+                        "Couldn't write raw data from {}"
+                        .format(self.address[0])
+                    )
+                    self.logger.exception(ex)
+
+                    return False
+
+                if self.__raw_remaining > 0:
+                    # The rest is still to be received
+                    break
+
+            try:
+                packet = next(self.__unpacker)
+            except StopIteration:
+                break
+
             try:
                 unpacked_packet = bintools.decode_object(
                     packet,
-                    except_keys=('hash', 'binary_data', 'checksums')
+                    except_keys=('hash', 'binary_data', 'checksums',
+                                 'chunks')
                 )
             except Exception as ex:
                 self.logger.error(
@@ -1,6 +1,12 @@
 import syncall
 import logging
+import bintools
 
+from syncall import merkle
+from syncall.hash_index import get_content_key
+from syncall.index_store import OverlayIndex
+from syncall.sync_state import SyncState
+from syncall.index_entry import IndexEntry, compact_index
 from events import Event
 
 
@@ -8,6 +14,24 @@ MSG_INDEX = 1
 MSG_REQUEST_INDEX = 2
 MSG_INDEX_DELTA = 3
 MSG_INDEX_NO_CHANGE = 4
+# Sent by both sides when connected. Contains `hash_algorithms`: the
+# supported content hash algorithms in order of preference, and
+# `capabilities`: the supported optional protocol features.
+# Peers which don't send it support only the legacy algorithm (md5)
+# and no optional features.
+MSG_HELLO = 5
+# Merkle tree index exchange (capability 'merkle'), replaces MSG_INDEX.
+# Contains `root`: the root hash of the sender's index Merkle tree.
+MSG_MERKLE_ROOT = 6
+# Contains `walk`: id echoed in the reply, `dirs`: directories to list
+# and `files`: files to send the index entries of.
+MSG_MERKLE_REQUEST = 7
+# Reply to MSG_MERKLE_REQUEST. Contains `walk`, `dirs`:
+# {<dir>: {<name>: [<is directory>, <hash>]}} and `files`:
+# {<file_name>: <file_data>}
+MSG_MERKLE_NODES = 8
+
+CAPABILITIES = ('merkle',)
 
 
 class RemoteStore:
@@ -23,6 +47,22 @@ class RemoteStore:
         self.my_index_last_updated = 0
         self.remote_index = None
 
+        # Files to send to the remote and files in conflict with it
+        self.sync_state = SyncState()
+        self.directory.index_updated += self.__local_index_updated
+
+        # Agreed on in the MSG_HELLO exchange. Entries with hashes of
+        # algorithms the remote doesn't support are sent with their hash
+        # in this one instead (see `get_entry_for_remote`).
+        self.hash_algorithm = syncall.index.LEGACY_HASH_ALGORITHM
+        self.remote_hash_algorithms = [syncall.index.LEGACY_HASH_ALGORITHM]
+        # None until the remote's MSG_HELLO is received
+        self.remote_capabilities = None
+
+        # The walk in progress of the remote's Merkle tree
+        self.merkle_walk = None
+        self.merkle_walk_count = 0
+
         self.address = self.messanger.address[0]
         self.my_uuid = self.messanger.my_uuid
         self.uuid = self.messanger.remote_uuid
@@ -38,7 +78,26 @@ class RemoteStore:
             return
 
         if self.remote_index is not None:
-            self.remote_index[file_name] = file_data
+            self.remote_index[file_name] = IndexEntry.compact(file_data)
+            self.__update_sync_state({file_name})
+
+    def __local_index_updated(self, changes):
+        # The files are synced when the remote replies to the index
+        # (delta) sent by the RemoteStoreManager
+        if self.remote_index is None:
+            return
+
+        if changes is None:
+            self.sync_state.rebuild(self.directory.diff(self.remote_index))
+        else:
+            self.__update_sync_state(changes)
+
+    def __update_sync_state(self, file_names):
+        self.sync_state.update_files(
+            file_names,
+            self.directory.get_index_entries(file_names),
+            self.remote_index
+        )
 
     def request_transfer(self, transfer_messanger):
         # Pass the transfer request to the transfer manager
@@ -51,8 +110,64 @@ class RemoteStore:
         return self.remote_index is not None
 
     def start_receiving(self):
+        # The index is sent when the remote's MSG_HELLO is received
+        # (or its MSG_INDEX if it doesn't send one), as the way it's
+        # sent depends on the remote's capabilities
         self.messanger.start_receiving()
-        self.send_index(request=False)
+        self.send_hello()
+
+    def send_hello(self):
+        self.messanger.send({
+            'type': MSG_HELLO,
+            'hash_algorithms': self.directory.get_hash_algorithms(),
+            'capabilities': list(CAPABILITIES)
+        })
+
+    def supports(self, capability):
+        return self.remote_capabilities is not None and \
+            capability in self.remote_capabilities
+
+    def __hello_received(self, packet):
+        algorithm = bintools.negotiate_hash_algorithm(
+            self.directory.get_hash_algorithms(),
+            packet.get('hash_algorithms', [])
+        )
+
+        if algorithm is None:
+            self.logger.error(
+                "No common hash algorithm with {}, falling back to {}"
+                .format(self.address, syncall.index.LEGACY_HASH_ALGORITHM)
+            )
+            algorithm = syncall.index.LEGACY_HASH_ALGORITHM
+
+        self.hash_algorithm = algorithm
+        self.remote_hash_algorithms = packet.get('hash_algorithms', [])
+        self.remote_capabilities = packet.get('capabilities', [])
+
+        self.send_index(request=False, force=True)
+
+    def get_entry_for_remote(self, file_data):
+        """
+        Return the index entry `file_data` as it's sent to the remote:
+        without the local 'hashes' and, if the remote doesn't support its
+        algorithm, with the hash in the agreed one from them (see
+        `Directory.get_extra_algorithms`).
+        """
+        if 'hashes' not in file_data:
+            return file_data
+
+        hashes = file_data['hashes']
+        key = get_content_key(file_data)
+
+        file_data = syncall.index.copy_entry(file_data)
+        del file_data['hashes']
+
+        if key is not None and key[0] not in self.remote_hash_algorithms \
+                and self.hash_algorithm in hashes:
+            file_data['hash'] = hashes[self.hash_algorithm]
+            file_data['hash_algorithm'] = self.hash_algorithm
+
+        return file_data
 
     def send_index(self, request=True, force=False):
         if not force and \
@@ -70,10 +185,20 @@ class RemoteStore:
 
         self.my_index_last_updated = self.directory.get_last_update()
 
-        self.messanger.send({
-            'type': MSG_INDEX,
-            'index': self.directory.get_index()
-        })
+        if self.supports('merkle'):
+            self.messanger.send({
+                'type': MSG_MERKLE_ROOT,
+                'root': self.directory.get_merkle_root()
+            })
+        else:
+            with self.directory.get_index_snapshot() as index:
+                self.messanger.send({
+                    'type': MSG_INDEX,
+                    'index': {
+                        file_name: self.get_entry_for_remote(file_data)
+                        for file_name, file_data in index.items()
+                    }
+                })
 
         if request:
             self.messanger.send({
@@ -87,7 +212,13 @@ class RemoteStore:
         """
         self.my_index_last_updated = self.directory.get_last_update()
 
-        index = self.directory.get_index()
+        index = {
+            file_name: self.get_entry_for_remote(file_data)
+            for file_name, file_data in
+            self.directory.get_index_entries(changes).items()
+        }
+        # The changes are passed to the other `index_updated` handlers too
+        changes = set(changes)
 
         if self.remote_index is not None:
             for file_name in list(changes):
@@ -100,7 +231,10 @@ class RemoteStore:
 
         self.messanger.send({
             'type': MSG_INDEX_DELTA,
-            'index': {file_name: index[file_name] for file_name in changes}
+            'index': {
+                file_name: index[file_name]
+                for file_name in changes
+            }
         })
 
         if request:
@@ -109,6 +243,9 @@ class RemoteStore:
             })
 
     def __disconnected(self, no_data):
+        self.directory.index_updated -= self.__local_index_updated
+        self.__stop_merkle_walk()
+        self.__set_remote_index(None)
         self.directory.transfer_manager.remote_disconnect(self)
         self.disconnected.notify(self)
 
@@ -128,28 +265,45 @@ class RemoteStore:
         # ))
 
         if packet['type'] == MSG_INDEX:
-            self.remote_index = packet['index']
+            if self.remote_capabilities is None and \
+                    self.my_index_last_updated == 0:
+                # Remote without MSG_HELLO, it's waiting for our index
+                self.send_index(request=False)
+
+            self.__set_remote_index(compact_index(packet['index']))
             self.__remote_index_updated()
 
         elif packet['type'] == MSG_INDEX_DELTA:
-            updates = False
+            updates = set()
 
             for file_name, file_data in packet['index'].items():
                 if self.remote_index is None or \
                         file_name not in self.remote_index or \
                         self.remote_index[file_name] != file_data:
-                    updates = True
+                    updates.add(file_name)
 
-                self.remote_index[file_name] = file_data
+                self.remote_index[file_name] = IndexEntry.compact(file_data)
 
             if updates:
-                self.__remote_index_updated()
+                self.__remote_index_updated(updates)
 
         elif packet['type'] == MSG_REQUEST_INDEX:
             self.send_index(request=False)
 
         elif packet['type'] == MSG_INDEX_NO_CHANGE:
-            self.__remote_index_updated()
+            self.__remote_index_updated(set())
+
+        elif packet['type'] == MSG_HELLO:
+            self.__hello_received(packet)
+
+        elif packet['type'] == MSG_MERKLE_ROOT:
+            self.__merkle_root_received(packet)
+
+        elif packet['type'] == MSG_MERKLE_REQUEST:
+            self.__merkle_request_received(packet)
+
+        elif packet['type'] == MSG_MERKLE_NODES:
+            self.__merkle_nodes_received(packet)
 
         else:
             self.logger.error("Unknown packet from {}: {}".format(
@@ -157,17 +311,132 @@ class RemoteStore:
                 packet['type']
             ))
 
-    def __remote_index_updated(self):
-        # self.logger.debug("{}'s index updated".format(self.address))
+    def __merkle_root_received(self, packet):
+        local_index, local_tree = self.directory.get_merkle_snapshot()
+
+        # Replies to a walk in progress are ignored from now on
+        self.__stop_merkle_walk()
+
+        if packet['root'] == local_tree.get_hash():
+            # Same synchronization state, nothing to sync
+            self.__set_remote_index(OverlayIndex(local_index))
+            self.sync_state.clear()
+            return
+
+        self.merkle_walk_count += 1
+        self.merkle_walk = merkle.MerkleWalk(
+            self.merkle_walk_count,
+            local_index,
+            local_tree
+        )
+
+        self.__request_merkle_nodes([''], [])
+
+    def __request_merkle_nodes(self, dirs, files):
+        self.messanger.send({
+            'type': MSG_MERKLE_REQUEST,
+            'walk': self.merkle_walk.id,
+            'dirs': dirs,
+            'files': files
+        })
+
+    def __merkle_request_received(self, packet):
+        self.messanger.send({
+            'type': MSG_MERKLE_NODES,
+            'walk': packet['walk'],
+            'dirs': self.directory.get_merkle_children(packet['dirs']),
+            'files': {
+                file_name: self.get_entry_for_remote(file_data)
+                for file_name, file_data in
+                self.directory.get_index_entries(packet['files']).items()
+            }
+        })
+
+    def __merkle_nodes_received(self, packet):
+        walk = self.merkle_walk
+
+        if walk is None or walk.id != packet['walk']:
+            return
+
+        dirs, files = walk.nodes_received(
+            packet['dirs'],
+            compact_index(packet['files'])
+        )
+
+        if dirs or files:
+            self.__request_merkle_nodes(dirs, files)
+        else:
+            self.merkle_walk = None
+            self.__set_remote_index(walk.index)
+
+            # The other files have the same entries on both sides, they
+            # only have to be compared again if they weren't in sync
+            self.__remote_index_updated(
+                walk.changed |
+                self.sync_state.get_needs_update() |
+                self.sync_state.get_conflicts()
+            )
+
+    def __stop_merkle_walk(self):
+        if self.merkle_walk is not None:
+            self.merkle_walk.index.close()
+            self.merkle_walk = None
+
+    def __set_remote_index(self, remote_index):
+        """
+        Replace the remote's index, closing the local index snapshot the
+        previous one was based on (see `OverlayIndex`).
+        """
+        if isinstance(self.remote_index, OverlayIndex):
+            self.remote_index.close()
+
+        self.remote_index = remote_index
+
+    def verify_sync_state(self):
+        """
+        Check the incrementally updated sync state against a full diff
+        of the indexes and rebuild it if they don't match.
+
+        Return True if the state was consistent.
+        """
+        if self.remote_index is None:
+            return True
 
         diff = self.directory.diff(self.remote_index)
 
-        if diff[2]:
+        if self.sync_state.verify(diff):
+            return True
+
+        self.logger.error(
+            "Sync state with {} doesn't match the index diff, rebuilding"
+            .format(self.uuid)
+        )
+        self.sync_state.rebuild(diff)
+
+        return False
+
+    def __remote_index_updated(self, file_names=None):
+        """
+        Update the sync state after the remote's index has changed and
+        sync the files that need to be updated. Only `file_names` are
+        compared again if given, otherwise the whole indexes are.
+        """
+        # self.logger.debug("{}'s index updated".format(self.address))
+
+        if file_names is None:
+            self.sync_state.rebuild(self.directory.diff(self.remote_index))
+        elif file_names:
+            self.__update_sync_state(file_names)
+
+        conflicts = self.sync_state.get_conflicts()
+        if conflicts:
             self.logger.debug(
                 "File conflicts with {}: {}"
-                .format(self.uuid, diff[2])
+                .format(self.uuid, conflicts)
             )
 
         # TODO: Handle conflicted files
-        self.directory.transfer_manager.sync_files(self, diff[0])
-        self.directory.transfer_manager.sync_files(self, diff[1])
+        self.directory.transfer_manager.sync_files(
+            self,
+            self.sync_state.get_needs_update()
+        )
@@ -0,0 +1,88 @@
+import os
+
+import pathext
+
+
+NS_PER_SECOND = 1000000000
+
+
+def scan_tree(top, is_ignored=None, relative_top=''):
+    """
+    Generator of (relative_path, file_path, stat_result) tuples for all
+    regular files under `top`. `file_path` is normalized with
+    `pathext.normalize` and `relative_path` is relative to `top`,
+    prefixed with `relative_top` if given.
+
+    Built on `os.scandir` so the file type comes from the directory
+    listing and each file costs a single stat call, which is cached in
+    the `DirEntry` and returned to the caller.
+
+    Symlinks to directories are not followed (like `os.walk`).
+    If `is_ignored` is given, it's called with the relative path and
+    whether it's a directory, and the files and directories for which it
+    returns True are skipped (ignored directories are not descended into).
+    """
+    stack = [(pathext.normalize(top), relative_top)]
+
+    while stack:
+        dir_path, relative_dir = stack.pop()
+
+        try:
+            entries = os.scandir(dir_path)
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                name = os.path.normcase(entry.name)
+                path = dir_path + '/' + name
+
+                if relative_dir:
+                    relative_path = relative_dir + '/' + name
+                else:
+                    relative_path = name
+
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+
+                    if not is_dir and not entry.is_file():
+                        continue
+
+                    if is_ignored is not None and \
+                            is_ignored(relative_path, is_dir):
+                        continue
+
+                    if is_dir:
+                        stack.append((path, relative_path))
+                    else:
+                        yield (relative_path, path, entry.stat())
+                except OSError:
+                    # Removed while scanning or a broken symlink
+                    continue
+
+
+def get_fingerprint(stat):
+    """
+    Return the index fingerprint (size, inode and modification time in
+    nanoseconds) of a stat result. The file content is considered
+    unchanged while the fingerprint stays the same.
+    """
+    return {
+        'size': stat.st_size,
+        'inode': stat.st_ino,
+        'mtime_ns': stat.st_mtime_ns
+    }
+
+
+def has_fingerprint(file_data):
+    return 'mtime_ns' in file_data
+
+
+def fingerprint_matches(file_data, stat):
+    return file_data.get('mtime_ns') == stat.st_mtime_ns and \
+        file_data.get('size') == stat.st_size and \
+        file_data.get('inode') == stat.st_ino
+
+
+def mtime_seconds(stat):
+    return stat.st_mtime_ns // NS_PER_SECOND
@@ -0,0 +1,80 @@
+import threading
+
+from syncall.index import IndexDiff, NEEDS_UPDATE, CONFLICT, SAME_CONTENT
+
+
+class SyncState:
+    """
+    Synchronization state of the local index with a single remote's index:
+    the files that need to be sent to the remote and the files in
+    conflict.
+
+    It's kept up to date per file (`update_files`) instead of diffing the
+    whole index on every change. `rebuild` sets it from a full
+    `IndexDiff.diff` and `verify` checks it against one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.needs_update = set()
+        self.conflicts = set()
+
+    def get_needs_update(self):
+        with self.lock:
+            return set(self.needs_update)
+
+    def get_conflicts(self):
+        with self.lock:
+            return set(self.conflicts)
+
+    def rebuild(self, diff):
+        """
+        Set the state from the result of a full `IndexDiff.diff`.
+        """
+        updates, deletes, conflicts = diff
+
+        with self.lock:
+            self.needs_update = updates | deletes
+            self.conflicts = set(conflicts)
+
+    def clear(self):
+        with self.lock:
+            self.needs_update = set()
+            self.conflicts = set()
+
+    def update_files(self, file_names, local_entries, remote_index):
+        """
+        Compare the files in `file_names` again. `local_entries` contains
+        their local index entries (files missing from it are not in the
+        local index).
+        """
+        with self.lock:
+            for file_name in file_names:
+                self.needs_update.discard(file_name)
+                self.conflicts.discard(file_name)
+
+                local_data = local_entries.get(file_name)
+                if local_data is None:
+                    continue
+
+                status = IndexDiff.compare_file(
+                    local_data,
+                    remote_index.get(file_name)
+                )
+
+                if status in (NEEDS_UPDATE, SAME_CONTENT):
+                    self.needs_update.add(file_name)
+                elif status == CONFLICT:
+                    self.conflicts.add(file_name)
+
+    def verify(self, diff):
+        """
+        Return True if the state matches the result of a full
+        `IndexDiff.diff`.
+        """
+        updates, deletes, conflicts = diff
+
+        with self.lock:
+            return self.needs_update == updates | deletes and \
+                self.conflicts == conflicts
@@ -1,12 +1,22 @@
 import logging
 import threading
 import os
+import functools
+import hashlib
 import pyrsync2
+import bintools
 
 from datetime import datetime
 from io import BytesIO
 
 from events import Event
+from syncall.block_size import DeltaHistory, choose_block_size, \
+    is_valid_block_size, MIN_DELTA_SIZE, DEDUP_BLOCK_SIZE
+from syncall.chunking import chunk_id
+from syncall.clone import clone_file
+from syncall.hash_index import get_content_key, same_content
+from syncall.hashing import HashingWriter
+from syncall.index import merge_sync_logs
 import syncall
 
 
@@ -88,6 +98,8 @@ class TransferManager:
         # uuid: set(file, remote)
         self.queue = dict()
 
+        self.delta_history = DeltaHistory()
+
     def process_transfer(self, remote, messanger):
         """
         Verify the request is legit, wrap it in a FileTransfer object
@@ -160,8 +172,9 @@ class TransferManager:
                 self.directory,
                 messanger,
                 file,
-                syncall.DEFAULT_BLOCK_SIZE
+                self.__get_block_size(file)
             )
+            transfer.remote_store = remote
 
             self.hook_events(transfer, start_event=False)
 
@@ -170,6 +183,21 @@ class TransferManager:
         transfer.initialize()
         transfer.start()
 
+    def __get_block_size(self, file_name):
+        """
+        Return the block size to propose for sending a file, based on its
+        size and the efficiency of its last delta.
+        """
+        file_data = self.directory.get_index(file_name)
+
+        try:
+            file_size = file_data['size']
+        except (KeyError, TypeError):
+            # Not scanned yet, let the remote choose
+            return None
+
+        return self.delta_history.get_block_size(file_name, file_size)
+
     def hook_events(self, transfer, start_event=True):
         transfer.transfer_completed += self.__transfer_completed
         transfer.transfer_failed += self.__transfer_failed
@@ -206,6 +234,12 @@ class TransferManager:
             self.transfers.add(transfer)
 
     def __transfer_completed(self, transfer):
+        if transfer.type == FileTransfer.TO_REMOTE:
+            literal_ratio = transfer.get_literal_ratio()
+
+            if literal_ratio is not None:
+                self.delta_history.add(transfer.file_name, literal_ratio)
+
         with self.transfers_lock:
             self.directory.finalize_transfer(transfer)
 
@@ -258,6 +292,15 @@ class TransferManager:
         return None
 
     def sync_files(self, remote, file_list):
+        file_list = set(file_list)
+
+        # The deletes of renamed files are sent with the renames
+        for file in list(file_list):
+            rename_source = self.directory.get_rename_source(file)
+
+            if rename_source is not None:
+                file_list.discard(rename_source)
+
         for file in file_list:
             self.sync_file(remote, file)
 
@@ -285,8 +328,13 @@ class FileTransfer(threading.Thread):
     MSG_BLOCK_DATA = 3
     MSG_DONE = 4
     MSG_DONE_ACCEPT = 5
+    MSG_RAW_DATA = 6
+    MSG_CHUNK_LIST = 7
+    MSG_CHUNK_REQUEST = 8
+    MSG_CHUNK_DATA = 9
 
-    def __init__(self, directory, messanger, file_name=None, block_size=4098):
+    def __init__(self, directory, messanger, file_name=None,
+                 block_size=None):
         super().__init__()
 
         self.logger = logging.getLogger(__name__)
@@ -298,6 +346,8 @@ class FileTransfer(threading.Thread):
 
         self.directory = directory
         self.messanger = messanger
+        # The RemoteStore of the receiver, if known
+        self.remote_store = None
 
         self.timestamp = None
         self.file_name = file_name
@@ -306,10 +356,57 @@ class FileTransfer(threading.Thread):
         else:
             self.file_data = None
 
+        # Proposed by the sender and chosen by the receiver
+        if block_size is None:
+            block_size = syncall.DEFAULT_BLOCK_SIZE
+
         self.block_size = block_size
         self.remote_file_data = None
         self.remote_checksums = None
 
+        # The file is streamed as it is, the receiver has no basis file
+        self.raw_stream = False
+
+        # The file is sent as content-defined chunks, the receiver asks
+        # only for the chunks it doesn't have
+        self.chunking = False
+
+        # The file is sent like chunks, in blocks of `block_size`, and the
+        # receiver takes the blocks it has in any of its files
+        self.dedup = False
+
+        self.chunks = None
+        self.missing_chunks = None
+        self.requested_chunks = None
+        self.__chunks_requested = threading.Event()
+
+        # Bytes of the file which weren't sent because the receiver had
+        # them in chunking and dedup modes
+        self.deduplicated_bytes = 0
+
+        # The file was renamed from `rename_from`, which is deleted
+        # (`rename_data` is its index entry), and the receiver renames its
+        # copy of that file instead of receiving the data
+        self.rename_from = None
+        self.rename_data = None
+        self.__rename_source = None
+
+        # The receiver had the file under the name `clone_from` and
+        # copied it locally instead of receiving the data
+        self.clone_from = None
+
+        # Both sides had the same content and only the sync logs were
+        # merged. `sync_log` is the merged log the receiver sent.
+        self.metadata_only = False
+        self.sync_log = None
+
+        # Hash of the received file, checked against the remote entry's
+        self.verified_hash = None
+
+        # Delta statistics of the sending side
+        self.matched_blocks = 0
+        self.literal_bytes = 0
+
         self.messanger.packet_received += self.__packet_received
         self.messanger.disconnected += self.__disconnected
 
@@ -341,6 +438,33 @@ class FileTransfer(threading.Thread):
     def get_remote_uuid(self):
         return self.messanger.remote_uuid
 
+    def get_literal_ratio(self):
+        """
+        Return the part of the sent file data which wasn't matched by
+        the receiver's blocks, or None if no delta was made.
+        """
+        total_bytes = self.literal_bytes + \
+            self.matched_blocks * self.block_size
+
+        if not self.remote_checksums or total_bytes == 0:
+            return None
+
+        return self.literal_bytes / total_bytes
+
+    def get_dedup_ratio(self):
+        """
+        Return the part of the file which the receiver had locally, or
+        None if the file wasn't sent in chunking or dedup mode.
+        """
+        if self.chunks is None:
+            return None
+
+        total_bytes = sum(chunk[1] for chunk in self.chunks)
+        if total_bytes == 0:
+            return None
+
+        return self.deduplicated_bytes / total_bytes
+
     def shutdown(self):
         self.__transfer_cancelled = True
         self.transfer_cancelled.notify(self)
@@ -379,13 +503,33 @@ class FileTransfer(threading.Thread):
         self.__transfer_started = True
         self.transfer_started.notify(self)
 
-        self.messanger.send({
+        file_data = self.file_data
+        if self.remote_store is not None:
+            file_data = self.remote_store.get_entry_for_remote(file_data)
+
+        init_data = {
             "type": self.MSG_INIT,
             "name": self.file_name,
-            "data": self.file_data
-        })
+            "data": file_data,
+            "block_size": self.block_size,
+            "raw_stream": True,
+            "dedup": True
+        }
+        if self.directory.chunk_index is not None:
+            init_data["chunking"] = True
+
+        self.__rename_source = self.directory.get_rename_source(
+            self.file_name
+        )
+        if self.__rename_source is not None:
+            self.rename_data = self.directory.get_index(self.__rename_source)
+            init_data["rename_from"] = self.__rename_source
+            init_data["rename_data"] = self.rename_data
 
-    def __transfer_file(self, remote_checksums, block_size):
+        self.messanger.send(init_data)
+
+    def __transfer_file(self, remote_checksums, block_size,
+                        raw_stream=False, chunking=False, dedup=False):
         self.logger.debug(
             "Started transferring file {} to remote {}"
             .format(self.file_name, self.messanger.address[0])
@@ -393,29 +537,28 @@ class FileTransfer(threading.Thread):
 
         self.block_size = block_size
         self.remote_checksums = remote_checksums
+        self.raw_stream = raw_stream
+        self.chunking = chunking
+        self.dedup = dedup
 
         super().start()
 
     def run(self):
         """
-        Send the delta data to the remote side.
+        Send the delta data, or the whole file in raw stream mode, to the
+        remote side.
         """
         try:
             with open(self.directory.get_file_path(self.file_name), 'rb') \
                     as file:
-                delta_generator = pyrsync2.rsyncdelta(
-                    file,
-                    self.remote_checksums,
-                    blocksize=self.block_size,
-                    max_buffer=self.block_size
-                )
-
-                # Actual transfer of data
-                for block in delta_generator:
-                    self.messanger.send({
-                        "type": self.MSG_BLOCK_DATA,
-                        "binary_data": block
-                    })
+                if self.raw_stream:
+                    self.__send_raw(file)
+                elif self.chunking or self.dedup:
+                    if not self.__send_chunks(file):
+                        # The transfer was stopped while waiting
+                        return
+                else:
+                    self.__send_delta(file)
         except Exception as ex:
             self.logger.exception(ex)
             self.logger.error(
@@ -424,10 +567,135 @@ class FileTransfer(threading.Thread):
             )
             self.shutdown()
         else:
+            self.logger.debug(
+                "Sent {} to {}: block size {}, {} matched blocks, "
+                "{} literal bytes, {} deduplicated bytes"
+                .format(self.file_name, self.messanger.address[0],
+                        self.block_size, self.matched_blocks,
+                        self.literal_bytes, self.deduplicated_bytes)
+            )
+
             self.messanger.send({
                 "type": self.MSG_DONE
             })
 
+    def __send_delta(self, file):
+        if self.remote_checksums:
+            delta_generator = self.directory.delta_engine.rsyncdelta(
+                file,
+                self.remote_checksums,
+                self.block_size,
+                self.block_size
+            )
+        else:
+            # Nothing to match against, send the file as it is
+            delta_generator = iter(
+                functools.partial(file.read, self.block_size),
+                b''
+            )
+
+        # Actual transfer of data
+        for block in delta_generator:
+            if isinstance(block, int):
+                self.matched_blocks += 1
+            else:
+                self.literal_bytes += len(block)
+
+            self.messanger.send({
+                "type": self.MSG_BLOCK_DATA,
+                "binary_data": block
+            })
+
+    def __send_raw(self, file):
+        """
+        Send the file's size in MSG_RAW_DATA and then its contents
+        directly from the file to the socket.
+        """
+        file_size = os.fstat(file.fileno()).st_size
+
+        self.messanger.send({
+            "type": self.MSG_RAW_DATA,
+            "size": file_size
+        })
+
+        sent_bytes = self.messanger.send_file(file, file_size)
+        self.literal_bytes += sent_bytes
+
+        if sent_bytes != file_size:
+            # The receiver can't tell where the data ends
+            raise IOError(
+                "Sent {} of {} bytes".format(sent_bytes, file_size)
+            )
+
+    def __send_chunks(self, file):
+        """
+        Send the list of the file's chunks (or blocks in dedup mode) in
+        MSG_CHUNK_LIST, wait for the receiver to request the chunks it
+        doesn't have and send them in MSG_CHUNK_DATA. Return False if the
+        transfer was stopped before the request.
+        """
+        if self.chunking:
+            self.chunks = self.directory.get_file_chunks(self.file_name)
+        else:
+            self.chunks = self.__get_blocks(file)
+
+        self.messanger.send({
+            "type": self.MSG_CHUNK_LIST,
+            "chunks": [list(chunk) for chunk in self.chunks]
+        })
+
+        self.__chunks_requested.wait()
+        if self.requested_chunks is None or self.is_done():
+            return False
+
+        offsets = []
+        offset = 0
+        for wanted_id, length in self.chunks:
+            offsets.append(offset)
+            offset += length
+
+        self.matched_blocks = len(self.chunks) - len(self.requested_chunks)
+
+        for index in self.requested_chunks:
+            length = self.chunks[index][1]
+
+            file.seek(offsets[index])
+            data = file.read(length)
+
+            if len(data) != length:
+                raise IOError("{} was truncated".format(self.file_name))
+
+            self.literal_bytes += length
+
+            self.messanger.send({
+                "type": self.MSG_CHUNK_DATA,
+                "index": index,
+                "binary_data": data
+            })
+
+        self.deduplicated_bytes = offset - self.literal_bytes
+
+        return True
+
+    def __get_blocks(self, file):
+        """
+        Return the blocks of the file as a list of (<strong hash>,
+        <length>) tuples.
+        """
+        file_size = os.fstat(file.fileno()).st_size
+        checksums = self.directory.get_block_checksums(
+            self.file_name,
+            self.block_size
+        )
+
+        return [
+            (strong, min(self.block_size, file_size - offset))
+            for offset, (weak, strong) in zip(
+                range(0, file_size, self.block_size),
+                checksums
+            )
+        ]
+
     def is_delete(self):
         if self.type == self.TO_REMOTE:
             return 'deleted' in self.file_data and self.file_data['deleted']
@@ -435,10 +703,107 @@ class FileTransfer(threading.Thread):
             return 'deleted' in self.remote_file_data and \
                 self.remote_file_data['deleted']
 
-    def __accept_file(self, file_name, file_data):
+    def __can_rename(self, old_name, old_data):
+        """
+        Return True if the local copy of `old_name` is the file being
+        received and the sender's delete of it (`old_data`) can be
+        applied, so it can be renamed.
+        """
+        if old_data is None or not old_data.get('deleted', False):
+            return False
+
+        local_data = self.directory.get_index(old_name)
+
+        if not same_content(local_data, self.remote_file_data):
+            return False
+
+        return syncall.IndexDiff.compare_file(old_data, local_data) == \
+            syncall.index.NEEDS_UPDATE and \
+            self.directory.is_file_unchanged(old_name)
+
+    def __get_verify_algorithm(self):
+        """
+        Return the hash algorithm of the received file's entry, or None
+        if it can't be verified.
+        """
+        content_key = get_content_key(self.remote_file_data)
+        if content_key is None or \
+                content_key[0] not in bintools.HASH_ALGORITHMS:
+            return None
+
+        return content_key[0]
+
+    def __verify_file(self):
+        """
+        Check the hash of the received temp file against the remote
+        entry. Return False if they're different.
+        """
+        if not isinstance(self.__temp_file_handle, HashingWriter):
+            return True
+
+        file_hash = self.__temp_file_handle.digest()
+
+        if file_hash != self.remote_file_data['hash']:
+            self.logger.error(
+                "Received {} from {} with a different hash than its index "
+                "entry".format(self.file_name, self.messanger.address[0])
+            )
+
+            # The basis checksums may be stale
+            if self.directory.checksum_cache is not None:
+                self.directory.checksum_cache.invalidate([self.file_name])
+
+            return False
+
+        self.verified_hash = file_hash
+        return True
+
+    def __clone_local_copy(self):
+        """
+        Copy a local file with the content of the received file to the
+        temp file, if there is one.
+        """
+        local_name = self.directory.find_local_copy(self.remote_file_data)
+        if local_name is None:
+            return
+
+        try:
+            method = clone_file(
+                self.directory.get_file_path(local_name),
+                self.__temp_file_name
+            )
+        except OSError as ex:
+            self.logger.error(
+                "Can't copy {} to the temp file of {}: {}"
+                .format(local_name, self.file_name, ex)
+            )
+            return
+
+        self.logger.debug(
+            "Copied {} for {} ({})".format(local_name, self.file_name, method)
+        )
+        self.clone_from = local_name
+
+    def __accept_file(self, file_name, file_data, block_size=None,
+                      raw_stream=False, chunking=False, dedup=False,
+                      rename_from=None, rename_data=None):
         """
         Make sure the file needs to be transferred
         and accept it if it does.
+
+        The block size proposed by the sender (`block_size`) is used if
+        it's valid, otherwise it's chosen from the size of the local file.
+        If there is no local file and the sender supports it
+        (`raw_stream`) the file is requested as a raw stream. If there is
+        one and both sides support it (`chunking`) the file is requested
+        as chunks. Without a local file the file is requested in dedup mode
+        instead of as a raw stream if the sender supports it (`dedup`) and
+        the checksum cache has blocks which may match.
+
+        If the file was renamed from `rename_from` (deleted with the index
+        entry `rename_data`) and the local copy of that file is the same,
+        it's renamed instead. Otherwise if there is a local file with the
+        same content it's copied and the transfer is completed right away.
         """
         file_status = syncall.IndexDiff.compare_file(
             file_data,
@@ -450,21 +815,56 @@ class FileTransfer(threading.Thread):
             self.file_data = self.directory.get_index(self.file_name)
             self.remote_file_data = file_data
 
-            if not self.is_delete():
+            if not self.is_delete() and rename_from is not None and \
+                    self.__can_rename(rename_from, rename_data):
+                self.rename_from = rename_from
+                self.rename_data = rename_data
+
+            elif not self.is_delete():
                 self.__temp_file_name = self.directory.get_temp_path(
                     self.file_name
                 )
-                self.__temp_file_handle = open(self.__temp_file_name, 'wb')
-
-                if os.path.exists(
-                    self.directory.get_file_path(self.file_name)
-                ):
-                    self.__file_handle = open(
-                        self.directory.get_file_path(self.file_name),
-                        'rb'
+                self.__clone_local_copy()
+
+            if self.clone_from is None and self.__temp_file_name is not None:
+                self.__temp_file_handle = open(self.__temp_file_name, 'w+b')
+
+                algorithm = self.__get_verify_algorithm()
+                if algorithm is not None:
+                    # The received file is hashed while it's written
+                    self.__temp_file_handle = HashingWriter(
+                        self.__temp_file_handle,
+                        algorithm
                     )
+
+                file_path = self.directory.get_file_path(self.file_name)
+
+                if os.path.exists(file_path):
+                    self.__file_handle = open(file_path, 'rb')
+                    basis_size = os.path.getsize(file_path)
                 else:
                     self.__file_handle = BytesIO()
+                    basis_size = 0
+
+                    self.dedup = dedup and \
+                        file_data.get('size', 0) >= MIN_DELTA_SIZE and \
+                        self.directory.checksum_cache is not None and \
+                        self.directory.checksum_cache.has_blocks(
+                            DEDUP_BLOCK_SIZE
+                        )
+                    self.raw_stream = raw_stream and not self.dedup
+
+                if self.dedup:
+                    # The size of the indexed blocks
+                    self.block_size = DEDUP_BLOCK_SIZE
+                elif is_valid_block_size(block_size):
+                    self.block_size = block_size
+                else:
+                    self.block_size = choose_block_size(basis_size)
+
+                self.chunking = chunking and \
+                    self.directory.chunk_index is not None and \
+                    basis_size >= MIN_DELTA_SIZE
 
             self.__transfer_started = True
             self.transfer_started.notify(self)
@@ -478,19 +878,73 @@ class FileTransfer(threading.Thread):
                     .format(file_name, self.messanger.address[0])
                 )
 
-            else:
+            elif self.rename_from is not None:
                 self.messanger.send({
                     "type": self.MSG_INIT_ACCEPT,
-                    "block_size": self.block_size,
-                    "checksums": self.directory.get_block_checksums(
+                    "rename": True
+                })
+                self.logger.debug(
+                    "Accepted a rename of {} to {} from {}"
+                    .format(self.rename_from, file_name,
+                            self.messanger.address[0])
+                )
+
+            elif self.clone_from is not None:
+                self.logger.debug(
+                    "Copied {} from the local {} instead of receiving it "
+                    "from {}"
+                    .format(file_name, self.clone_from,
+                            self.messanger.address[0])
+                )
+                self.__complete_transfer()
+
+            else:
+                # Small files are sent whole
+                if basis_size < MIN_DELTA_SIZE:
+                    checksums = []
+                elif self.chunking:
+                    # Index the chunks of the basis file
+                    self.directory.get_file_chunks(self.file_name)
+                    checksums = []
+                else:
+                    checksums = self.directory.get_block_checksums(
                         self.file_name,
                         self.block_size
                     )
-                })
+
+                accept_data = {
+                    "type": self.MSG_INIT_ACCEPT,
+                    "block_size": self.block_size,
+                    "checksums": checksums
+                }
+                if self.raw_stream:
+                    accept_data["raw_stream"] = True
+                if self.chunking:
+                    accept_data["chunking"] = True
+                if self.dedup:
+                    accept_data["dedup"] = True
+
+                self.messanger.send(accept_data)
                 self.logger.debug(
                     "Accepted a file transfer request for {} from {}"
                     .format(file_name, self.messanger.address[0])
                 )
+        elif file_status == syncall.index.SAME_CONTENT:
+            self.file_name = file_name
+            self.file_data = self.directory.get_index(self.file_name)
+            self.remote_file_data = file_data
+
+            self.metadata_only = True
+            self.sync_log = merge_sync_logs(
+                self.file_data['sync_log'],
+                file_data['sync_log']
+            )
+
+            self.logger.debug(
+                "{} from {} has the same content, merging the sync logs"
+                .format(file_name, self.messanger.address[0])
+            )
+            self.__complete_transfer()
         else:
             self.logger.error(
                 "File transfer requested for {} from {} shouldn't be updated"
@@ -503,14 +957,34 @@ class FileTransfer(threading.Thread):
         Message sequence should be:
 
             1. MSG_INIT | sender -> receiver
-                - Contains file_name and file_data (index data)
+                - Contains file_name, file_data (index data), the
+                  proposed block_size and `raw_stream` if the sender
+                  supports raw streams
             2. MSG_INIT_ACCEPT or MSG_CANCEL | receiver -> sender
-                - Contains block_size and block checksums
+                - Contains the block_size both sides use and the block
+                  checksums (empty if the file should be sent whole)
+                - Contains `raw_stream` if the receiver has no basis file
+                  and wants the file as a raw stream
             3. Multiple MSG_BLOCK_DATA | sender -> receiver
                 - Contains the delta data for each block, in sequence
+                - In raw stream mode a single MSG_RAW_DATA is sent
+                  instead. It contains the file size and is followed by
+                  that many bytes of file contents, outside of msgpack.
+                - In chunking mode (`chunking` in MSG_INIT and
+                  MSG_INIT_ACCEPT) the sender sends MSG_CHUNK_LIST with
+                  the ids and lengths of the file's chunks, the receiver
+                  replies with MSG_CHUNK_REQUEST with the indexes of the
+                  chunks it couldn't find locally and the sender sends
+                  each of them in a MSG_CHUNK_DATA.
+                - Dedup mode (`dedup` in MSG_INIT and MSG_INIT_ACCEPT) is
+                  the same with fixed blocks of `block_size`, identified
+                  by their strong hashes, instead of chunks.
             4. MSG_DONE | sender -> receiver
                 - No other data is going to be transfered
                   (no more MSG_BLOCK_DATA)
+                - The receiver checks the hash of the received file
+                  (computed while it was written) and replies with
+                  MSG_CANCEL if it's different from the sent index entry
             5. MSG_DONE_ACCEPT | receiver -> sender
                 - The receiver successfuly received and processed the data
                   and the file index for the file should be updated on both
@@ -527,6 +1001,21 @@ class FileTransfer(threading.Thread):
             after the MSG_DONE message and MSG_DONE_ACCEPT is sent if the
             delete is successful.
 
+            If the receiver has a file with the same content it copies it
+            and sends MSG_DONE_ACCEPT right after MSG_INIT.
+
+            If the receiver already has the same content under the same
+            name, it replies to MSG_INIT with MSG_DONE_ACCEPT containing
+            `sync_log`, the merge of both sync logs, and only the index
+            entries are updated on both sides.
+
+            If the file was renamed, MSG_INIT contains `rename_from` and
+            `rename_data`: the old name and its (deleted) index entry. If
+            the receiver has the same file under the old name it replies
+            with `rename` in MSG_INIT_ACCEPT and step 3 is skipped too.
+            The receiver renames the file after MSG_DONE and updates the
+            index entries of both names.
+
             MSG_CANCEL can be sent at any time from the receiver or the sender
             and the one that receives it should close the connection.
 
@@ -536,7 +1025,16 @@ class FileTransfer(threading.Thread):
         """
 
         if data['type'] == self.MSG_INIT:
-            self.__accept_file(data['name'], data['data'])
+            self.__accept_file(
+                data['name'],
+                data['data'],
+                data.get('block_size'),
+                data.get('raw_stream', False),
+                data.get('chunking', False),
+                data.get('dedup', False),
+                data.get('rename_from'),
+                data.get('rename_data')
+            )
 
         elif data['type'] == self.MSG_INIT_ACCEPT:
             if self.is_delete():
@@ -545,11 +1043,28 @@ class FileTransfer(threading.Thread):
                     .format(self.file_name, self.messanger.address[0])
                 )
 
+                self.messanger.send({
+                    "type": self.MSG_DONE
+                })
+            elif data.get('rename', False):
+                self.rename_from = self.__rename_source
+                self.logger.debug(
+                    "Transferring rename of {} to {} to {}"
+                    .format(self.rename_from, self.file_name,
+                            self.messanger.address[0])
+                )
+
                 self.messanger.send({
                     "type": self.MSG_DONE
                 })
             else:
-                self.__transfer_file(data['checksums'], data['block_size'])
+                self.__transfer_file(
+                    data['checksums'],
+                    data['block_size'],
+                    data.get('raw_stream', False),
+                    data.get('chunking', False),
+                    data.get('dedup', False)
+                )
 
         elif data['type'] == self.MSG_CANCEL:
             self.__transfer_cancelled = True
@@ -567,12 +1082,59 @@ class FileTransfer(threading.Thread):
 
             self.__data_received(data['binary_data'])
 
+        elif data['type'] == self.MSG_RAW_DATA:
+            if not self.__transfer_started or not self.raw_stream:
+                self.logger.error(
+                    "Received raw data from {} for {}, but not expected"
+                    .format(self.messanger.address[0], self.file_name)
+                )
+                self.terminate()
+                return
+
+            self.messanger.receive_raw(self.__temp_file_handle, data['size'])
+
+        elif data['type'] in (self.MSG_CHUNK_LIST, self.MSG_CHUNK_DATA):
+            if not self.__transfer_started or \
+                    not (self.chunking or self.dedup):
+                self.logger.error(
+                    "Received chunks from {} for {}, but not expected"
+                    .format(self.messanger.address[0], self.file_name)
+                )
+                self.terminate()
+                return
+
+            if data['type'] == self.MSG_CHUNK_LIST:
+                self.__chunk_list_received(data['chunks'])
+            else:
+                self.__chunk_received(data['index'], data['binary_data'])
+
+        elif data['type'] == self.MSG_CHUNK_REQUEST:
+            self.requested_chunks = data['indexes']
+            self.__chunks_requested.set()
+
         elif data['type'] == self.MSG_DONE:
+            if self.missing_chunks:
+                self.logger.error(
+                    "Transfer of {} from {} completed without {} chunks"
+                    .format(self.file_name, self.messanger.address[0],
+                            len(self.missing_chunks))
+                )
+                self.shutdown()
+                return
+
+            if not self.__verify_file():
+                self.shutdown()
+                return
+
             self.__complete_transfer()
 
         elif data['type'] == self.MSG_DONE_ACCEPT:
             self.__transfer_completed = True
 
+            if 'sync_log' in data:
+                self.metadata_only = True
+                self.sync_log = data['sync_log']
+
             self.timestamp = data['time']
             self.terminate()
 
@@ -600,10 +1162,69 @@ class FileTransfer(threading.Thread):
             )
             self.shutdown()
 
+    def __chunk_list_received(self, chunks):
+        """
+        Write the chunks which are found locally to the temp file and
+        request the rest.
+        """
+        self.chunks = []
+        self.missing_chunks = set()
+
+        offset = 0
+        for index, (wanted_id, length) in enumerate(chunks):
+            self.chunks.append((wanted_id, length, offset))
+
+            if self.dedup:
+                data = self.directory.read_block(wanted_id, length)
+            else:
+                data = self.directory.read_chunk(wanted_id)
+
+            if data is None:
+                self.missing_chunks.add(index)
+            else:
+                self.__temp_file_handle.seek(offset)
+                self.__temp_file_handle.write(data)
+                self.deduplicated_bytes += length
+
+            offset += length
+
+        self.logger.debug(
+            "Requesting {} of {} chunks of {} from {}, deduplicated {} "
+            "bytes ({:.0%})"
+            .format(len(self.missing_chunks), len(self.chunks),
+                    self.file_name, self.messanger.address[0],
+                    self.deduplicated_bytes, self.get_dedup_ratio() or 0)
+        )
+
+        self.messanger.send({
+            "type": self.MSG_CHUNK_REQUEST,
+            "indexes": sorted(self.missing_chunks)
+        })
+
+    def __chunk_received(self, index, data):
+        if self.dedup:
+            received_id = hashlib.md5(data).digest()
+        else:
+            received_id = chunk_id(data)
+
+        if index not in self.missing_chunks or \
+                received_id != self.chunks[index][0]:
+            self.logger.error(
+                "Received an invalid chunk of {} from {}"
+                .format(self.file_name, self.messanger.address[0])
+            )
+            self.shutdown()
+            return
+
+        self.__temp_file_handle.seek(self.chunks[index][2])
+        self.__temp_file_handle.write(data)
+
+        self.missing_chunks.remove(index)
+
     def __complete_transfer(self):
         self.timestamp = int(datetime.now().timestamp())
 
-        if not self.is_delete():
+        if self.__temp_file_handle is not None:
             # Flush the file contents
             self.__file_handle.close()
             self.__file_handle = None
@@ -615,13 +1236,20 @@ class FileTransfer(threading.Thread):
 
         self.transfer_completed.notify(self)
 
-        self.messanger.send({
+        done_data = {
             'type': self.MSG_DONE_ACCEPT,
             'time': self.timestamp
-        })
+        }
+        if self.metadata_only:
+            done_data['sync_log'] = self.sync_log
+
+        self.messanger.send(done_data)
 
     def __disconnected(self, data):
         self.__release_resources()
 
+        # Don't keep the sending thread waiting for a chunk request
+        self.__chunks_requested.set()
+
         if not self.__transfer_cancelled and not self.__transfer_completed:
             self.transfer_failed.notify(self)
@@ -0,0 +1,200 @@
+import logging
+import threading
+import os
+import time
+
+import inotify
+import pathext
+
+
+class DirectoryWatcher(threading.Thread):
+    """
+    Watches a Directory for file system changes using inotify and
+    feeds the changed paths to `Directory.update_paths`.
+
+    Events for the same path are debounced: the path is updated once
+    it has been quiet for `delay` seconds (but no later than `max_delay`
+    seconds after its first event) so a burst of writes from an editor
+    results in a single index update.
+    """
+
+    WATCH_MASK = (
+        inotify.IN_MODIFY |
+        inotify.IN_ATTRIB |
+        inotify.IN_CLOSE_WRITE |
+        inotify.IN_MOVED_FROM |
+        inotify.IN_MOVED_TO |
+        inotify.IN_CREATE |
+        inotify.IN_DELETE |
+        inotify.IN_DELETE_SELF |
+        inotify.IN_ONLYDIR |
+        inotify.IN_DONT_FOLLOW
+    )
+
+    POLL_INTERVAL = 1
+
+    def __init__(self, directory, delay=0.5, max_delay=5):
+        super().__init__()
+
+        self.logger = logging.getLogger(__name__)
+
+        self.directory = directory
+        self.delay = delay
+        self.max_delay = max_delay
+
+        self.inotify = inotify.Inotify()
+
+        # wd: relative directory path
+        self.watches = dict()
+        # relative directory path: wd
+        self.watched_dirs = dict()
+
+        # path: (first_event_time, last_event_time)
+        self.pending = dict()
+        self.rescan_needed = False
+
+        self.__stopped = False
+
+    def shutdown(self):
+        self.__stopped = True
+
+    def run(self):
+        try:
+            self.watch_tree('')
+
+            while not self.__stopped:
+                timeout = self.POLL_INTERVAL
+                if self.pending:
+                    timeout = min(timeout, self.delay)
+
+                for event in self.inotify.read_events(timeout):
+                    self.process_event(*event)
+
+                try:
+                    self.flush()
+                except Exception as ex:
+                    # E.g. a file removed or made unreadable while it was
+                    # being indexed. Don't stop watching, rescan instead.
+                    self.logger.exception(ex)
+                    self.logger.error(
+                        "Index update failed, rescanning the directory"
+                    )
+                    self.rescan_needed = True
+        finally:
+            self.inotify.close()
+
+    def watch_tree(self, relative_path):
+        """
+        Add watches for the given directory and all of its subdirectories.
+        """
+        top = self.directory.get_file_path(relative_path)
+
+        for dirpath, dirnames, filenames in os.walk(top):
+            dir_path = pathext.normalize(
+                os.path.relpath(dirpath, self.directory.dir_path)
+            )
+
+            if dir_path != '.' and self.directory.is_ignored(dir_path, True):
+                dirnames[:] = []
+                continue
+
+            self.add_watch(dir_path)
+
+    def add_watch(self, relative_path):
+        if relative_path == '.':
+            relative_path = ''
+
+        try:
+            wd = self.inotify.add_watch(
+                self.directory.get_file_path(relative_path),
+                self.WATCH_MASK
+            )
+        except OSError as ex:
+            self.logger.error(
+                "Couldn't watch {}: {}".format(relative_path, ex)
+            )
+            return
+
+        self.watches[wd] = relative_path
+        self.watched_dirs[relative_path] = wd
+
+    def remove_watches(self, relative_path):
+        """
+        Remove the watches for a directory (and its subdirectories)
+        that has been moved out or deleted.
+        """
+        prefix = relative_path + '/'
+
+        for path, wd in list(self.watched_dirs.items()):
+            if path == relative_path or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watched_dirs[path]
+                self.watches.pop(wd, None)
+
+    def process_event(self, wd, mask, cookie, name):
+        if mask & inotify.IN_Q_OVERFLOW:
+            self.logger.debug("Inotify queue overflow, rescanning")
+            self.rescan_needed = True
+            return
+
+        if mask & inotify.IN_IGNORED:
+            path = self.watches.pop(wd, None)
+            if path is not None and self.watched_dirs.get(path) == wd:
+                del self.watched_dirs[path]
+            return
+
+        if wd not in self.watches or not name:
+            return
+
+        relative_path = pathext.normalize(
+            os.path.join(self.watches[wd], name)
+        )
+
+        if self.directory.is_ignored(
+            relative_path,
+            bool(mask & inotify.IN_ISDIR)
+        ):
+            return
+
+        if mask & inotify.IN_ISDIR:
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                # Files may have been created in the directory
+                # before the watch was added, so the whole tree
+                # gets indexed when the path is updated
+                self.watch_tree(relative_path)
+            elif mask & (inotify.IN_MOVED_FROM | inotify.IN_DELETE):
+                self.remove_watches(relative_path)
+
+        self.queue_path(relative_path)
+
+    def queue_path(self, relative_path, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        first_event, _ = self.pending.get(relative_path, (now, now))
+        self.pending[relative_path] = (first_event, now)
+
+    def flush(self, now=None):
+        """
+        Update the index for all pending paths that are ready.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        if self.rescan_needed:
+            self.rescan_needed = False
+            self.pending.clear()
+
+            self.directory.update_index()
+            return
+
+        ready = set()
+
+        for path, (first_event, last_event) in list(self.pending.items()):
+            if now - last_event >= self.delay or \
+                    now - first_event >= self.max_delay:
+                ready.add(path)
+                del self.pending[path]
+
+        if ready:
+            self.directory.update_paths(ready)
@@ -6,3 +6,17 @@ from syncall_tests.commons import *
 from syncall_tests.remote_store import *
 from syncall_tests.remote_store_manager import *
 from syncall_tests.transfers import *
+from syncall_tests.watcher import *
+from syncall_tests.scanner import *
+from syncall_tests.hashing import *
+from syncall_tests.index_store import *
+from syncall_tests.ignore import *
+from syncall_tests.merkle import *
+from syncall_tests.sync_state import *
+from syncall_tests.index_entry import *
+from syncall_tests.checksum_cache import *
+from syncall_tests.block_size import *
+from syncall_tests.delta import *
+from syncall_tests.chunking import *
+from syncall_tests.hash_index import *
+from syncall_tests.clone import *
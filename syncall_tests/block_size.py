@@ -0,0 +1,53 @@
+import unittest
+
+from syncall.block_size import choose_block_size, is_valid_block_size, \
+    DeltaHistory, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE
+
+
+class BlockSizeTests(unittest.TestCase):
+    def test_square_root_of_file_size(self):
+        self.assertEqual(choose_block_size(2 ** 24), 4096)
+        self.assertEqual(choose_block_size(2 ** 30), 32768)
+
+    def test_rounded_up_to_power_of_two(self):
+        self.assertEqual(choose_block_size(5000 ** 2), 8192)
+
+    def test_limits(self):
+        self.assertEqual(choose_block_size(0), MIN_BLOCK_SIZE)
+        self.assertEqual(choose_block_size(100), MIN_BLOCK_SIZE)
+        self.assertEqual(choose_block_size(2 ** 40), MAX_BLOCK_SIZE)
+
+    def test_ineffective_delta(self):
+        self.assertEqual(choose_block_size(2 ** 24, 0.1), 4096)
+        self.assertEqual(choose_block_size(2 ** 24, 0.9), 16384)
+        self.assertEqual(choose_block_size(2 ** 36, 0.9), MAX_BLOCK_SIZE)
+
+    def test_is_valid_block_size(self):
+        self.assertTrue(is_valid_block_size(4096))
+        self.assertFalse(is_valid_block_size(None))
+        self.assertFalse(is_valid_block_size(4096.0))
+        self.assertFalse(is_valid_block_size(MIN_BLOCK_SIZE - 1))
+        self.assertFalse(is_valid_block_size(MAX_BLOCK_SIZE + 1))
+
+
+class DeltaHistoryTests(unittest.TestCase):
+    def test_get_block_size(self):
+        history = DeltaHistory()
+
+        self.assertEqual(history.get_block_size('file1', 2 ** 24), 4096)
+
+        history.add('file1', 0.9)
+        self.assertEqual(history.get_block_size('file1', 2 ** 24), 16384)
+        self.assertEqual(history.get_block_size('file2', 2 ** 24), 4096)
+
+    def test_max_size(self):
+        history = DeltaHistory(max_size=2)
+
+        history.add('file1', 0.1)
+        history.add('file2', 0.2)
+        history.add('file1', 0.3)
+        history.add('file3', 0.4)
+
+        self.assertIsNone(history.get('file2'))
+        self.assertEqual(history.get('file1'), 0.3)
+        self.assertEqual(history.get('file3'), 0.4)
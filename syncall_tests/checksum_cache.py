@@ -0,0 +1,162 @@
+import unittest
+import hashlib
+import os
+import shutil
+import tempfile
+import pyrsync2
+
+from unittest.mock import Mock, patch
+
+from syncall.checksum_cache import ChecksumCache
+from syncall.block_size import DEDUP_BLOCK_SIZE, MIN_DELTA_SIZE
+
+
+class ChecksumCacheTests(unittest.TestCase):
+    BLOCK_SIZE = 16
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, '.syncall_index.checksums')
+        self.file_path = os.path.join(self.temp_dir, 'file')
+
+        self.write_file(b'0123456789' * 10)
+
+        self.cache = ChecksumCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, data):
+        with open(self.file_path, 'wb') as file:
+            file.write(data)
+
+    def expected_checksums(self):
+        with open(self.file_path, 'rb') as file:
+            return list(pyrsync2.blockchecksums(
+                file,
+                blocksize=self.BLOCK_SIZE
+            ))
+
+    def get_checksums(self, file_hash=b'1', block_size=BLOCK_SIZE):
+        return self.cache.get_checksums(
+            'file',
+            self.file_path,
+            file_hash,
+            block_size
+        )
+
+    def test_checksums_are_cached(self):
+        expected = self.expected_checksums()
+
+        self.assertEqual(self.get_checksums(), expected)
+
+        with patch('pyrsync2.blockchecksums') as blockchecksums:
+            self.assertEqual(self.get_checksums(), expected)
+            self.assertFalse(blockchecksums.called)
+
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_cache_is_persistent(self):
+        self.get_checksums()
+        self.cache.close()
+
+        cache = ChecksumCache(self.path)
+        checksums = cache.get_checksums(
+            'file',
+            self.file_path,
+            b'1',
+            self.BLOCK_SIZE
+        )
+        cache.close()
+
+        self.assertEqual(checksums, self.expected_checksums())
+        self.assertEqual(cache.hits, 1)
+
+    def test_different_hash_is_a_miss(self):
+        self.get_checksums()
+        self.get_checksums(file_hash=b'2')
+
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_different_block_size_is_a_miss(self):
+        self.get_checksums()
+        self.get_checksums(block_size=self.BLOCK_SIZE * 2)
+
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_changed_file_is_a_miss(self):
+        self.get_checksums()
+
+        self.write_file(b'abcdefghij' * 11)
+
+        self.assertEqual(self.get_checksums(), self.expected_checksums())
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_invalidate(self):
+        self.get_checksums()
+        self.cache.invalidate(['file'])
+        self.get_checksums()
+
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_find_block(self):
+        self.write_file(b'0123456789abcdef' * 2 + b'abcdefghijklmnop' + b'xyz')
+        self.get_checksums()
+
+        self.assertTrue(self.cache.has_blocks())
+        self.assertEqual(
+            self.cache.find_block(hashlib.md5(b'abcdefghijklmnop').digest(),
+                                  16),
+            [('file', 32)]
+        )
+        # The last block is shorter
+        self.assertEqual(
+            self.cache.find_block(hashlib.md5(b'xyz').digest(), 3),
+            [('file', 48)]
+        )
+        self.assertEqual(
+            self.cache.find_block(hashlib.md5(b'xyz').digest(), 16),
+            []
+        )
+
+    def test_invalidate_removes_blocks(self):
+        self.get_checksums()
+        self.cache.invalidate(['file'])
+
+        self.assertFalse(self.cache.has_blocks())
+
+    def test_lookups_dont_create_database(self):
+        self.cache.invalidate(['file'])
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(self.cache.has_blocks())
+        self.assertEqual(self.cache.find_block(b'1', 16), [])
+
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_warm(self):
+        self.cache.WARM_MIN_SIZE = 5000
+
+        directory = Mock()
+        directory.get_file_path.return_value = self.file_path
+
+        self.cache.warm(directory, [
+            ('file', {'hash': b'1', 'size': 5000}),
+            ('medium', {'hash': b'2', 'size': MIN_DELTA_SIZE}),
+            ('small', {'hash': b'3', 'size': 10}),
+            ('deleted', {'hash': b'4', 'size': 5000, 'deleted': True})
+        ], self.BLOCK_SIZE)
+
+        self.assertEqual(
+            [call[0][0] for call in directory.get_file_path.call_args_list],
+            ['file', 'file', 'medium']
+        )
+        # The blocks of both for dedup transfers, only the big one as a
+        # basis
+        self.assertEqual(self.cache.misses, 3)
+        self.assertTrue(self.cache.has_blocks(DEDUP_BLOCK_SIZE))
+
+        self.get_checksums()
+        self.assertEqual(self.cache.hits, 1)
@@ -0,0 +1,136 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+
+from io import BytesIO
+from unittest.mock import patch
+
+from syncall import chunking
+from syncall.chunk_index import ChunkIndex
+from syncall.chunking import chunk_ends, chunk_file, chunk_id, \
+    MIN_CHUNK_SIZE, MAX_CHUNK_SIZE
+
+
+class ChunkingTests(unittest.TestCase):
+    def setUp(self):
+        self.data = random.Random(1).randbytes(2 ** 20)
+
+    def test_chunk_sizes(self):
+        ends = chunk_ends(self.data)
+        sizes = [end - start for start, end in zip([0] + ends, ends)]
+
+        self.assertEqual(ends[-1], len(self.data))
+        self.assertTrue(all(
+            MIN_CHUNK_SIZE < size <= MAX_CHUNK_SIZE for size in sizes[:-1]
+        ))
+
+    def test_small_data(self):
+        self.assertEqual(chunk_ends(b''), [])
+        self.assertEqual(chunk_ends(b'1234'), [4])
+
+    @unittest.skipIf(chunking.numpy is None, "numpy is not installed")
+    def test_python_chunks_match_numpy(self):
+        with patch('syncall.chunking.numpy', None):
+            python_ends = chunk_ends(self.data)
+
+        self.assertEqual(chunk_ends(self.data), python_ends)
+
+    def test_boundaries_resynchronize_after_insertion(self):
+        changed = self.data[:100000] + b'inserted' + self.data[100000:]
+
+        chunks = chunk_file(BytesIO(self.data))
+        changed_chunks = chunk_file(BytesIO(changed))
+
+        # Only the chunk with the insertion is different
+        self.assertEqual(
+            len(set(chunks) - set(changed_chunks)),
+            1
+        )
+
+    def test_chunk_file(self):
+        chunks = chunk_file(BytesIO(self.data))
+
+        offset = 0
+        for wanted_id, length in chunks:
+            self.assertEqual(
+                chunk_id(self.data[offset:offset + length]),
+                wanted_id
+            )
+            offset += length
+
+        self.assertEqual(offset, len(self.data))
+
+    def test_chunk_file_segments(self):
+        with patch('syncall.chunking.SEGMENT_SIZE', 100000):
+            chunks = chunk_file(BytesIO(self.data))
+
+        ends = chunk_ends(self.data)
+        self.assertEqual(
+            [length for chunk, length in chunks],
+            [end - start for start, end in zip([0] + ends, ends)]
+        )
+
+
+class ChunkIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, '.syncall_index.chunks')
+        self.file_path = os.path.join(self.temp_dir, 'file')
+
+        with open(self.file_path, 'wb') as file:
+            file.write(random.Random(1).randbytes(2 ** 19))
+
+        self.index = ChunkIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_chunks(self, file_hash=b'1'):
+        return self.index.get_chunks('file', self.file_path, file_hash)
+
+    def test_chunks_are_indexed(self):
+        with open(self.file_path, 'rb') as file:
+            expected = chunk_file(file)
+
+        self.assertEqual(self.get_chunks(), expected)
+
+        with patch('syncall.chunk_index.chunk_file') as chunk_file_mock:
+            self.assertEqual(self.get_chunks(), expected)
+            self.assertFalse(chunk_file_mock.called)
+
+        self.assertEqual(self.index.misses, 1)
+        self.assertEqual(self.index.hits, 1)
+
+    def test_changed_hash(self):
+        self.get_chunks()
+        self.get_chunks(b'2')
+
+        self.assertEqual(self.index.misses, 2)
+
+    def test_find_chunk(self):
+        chunks = self.get_chunks()
+        offset = chunks[0][1]
+
+        self.assertEqual(
+            self.index.find_chunk(chunks[1][0]),
+            [('file', offset, chunks[1][1])]
+        )
+        self.assertEqual(self.index.find_chunk(b'unknown'), [])
+
+    def test_invalidate(self):
+        chunks = self.get_chunks()
+
+        self.index.invalidate(['file'])
+
+        self.assertEqual(self.index.find_chunk(chunks[0][0]), [])
+        self.get_chunks()
+        self.assertEqual(self.index.misses, 2)
+
+    def test_database_is_created_when_needed(self):
+        self.index.invalidate(['file'])
+        self.assertEqual(self.index.find_chunk(b'1'), [])
+
+        self.assertFalse(os.path.exists(self.path))
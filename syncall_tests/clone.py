@@ -0,0 +1,61 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from unittest.mock import patch
+
+from syncall.clone import clone_file
+
+
+class CloneTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, 'source')
+        self.destination = os.path.join(self.temp_dir, 'destination')
+
+        with open(self.source, 'wb') as file:
+            file.write(b'1234' * 100000)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assertCopied(self):
+        with open(self.source, 'rb') as source, \
+                open(self.destination, 'rb') as destination:
+            self.assertEqual(source.read(), destination.read())
+
+    def test_clone_file(self):
+        self.assertIn(
+            clone_file(self.source, self.destination),
+            ('reflink', 'copy_file_range', 'copy')
+        )
+        self.assertCopied()
+
+    @patch('syncall.clone.reflink')
+    def test_reflink_not_supported(self, reflink):
+        reflink.side_effect = OSError()
+
+        self.assertIn(
+            clone_file(self.source, self.destination),
+            ('copy_file_range', 'copy')
+        )
+        self.assertCopied()
+
+    @patch('syncall.clone.copy_range')
+    @patch('syncall.clone.reflink')
+    def test_copy(self, reflink, copy_range):
+        reflink.side_effect = OSError()
+
+        def partial_copy(source, destination):
+            destination.write(source.read(10))
+            raise OSError()
+
+        copy_range.side_effect = partial_copy
+
+        self.assertEqual(clone_file(self.source, self.destination), 'copy')
+        self.assertCopied()
+
+    def test_missing_source(self):
+        with self.assertRaises(OSError):
+            clone_file(self.source + '1', self.destination)
@@ -0,0 +1,357 @@
+import unittest
+import os
+import random
+import tempfile
+import pyrsync2
+
+from io import BytesIO
+
+from syncall.delta import PythonDeltaEngine, NumpyDeltaEngine, \
+    ProcessDeltaEngine, create_delta_engine, compute_delta_operations, \
+    get_file_version, numpy
+
+
+class PythonDeltaEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = PythonDeltaEngine()
+
+    def test_delta(self):
+        basis = b'0123456789' * 10
+        new = b'abc' + basis
+
+        checksums = self.engine.blockchecksums(BytesIO(basis), 10)
+        delta = list(self.engine.rsyncdelta(BytesIO(new), checksums, 10, 10))
+
+        self.assertEqual(delta[0], b'abc')
+        self.assertIsInstance(delta[1], int)
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class NumpyDeltaEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = NumpyDeltaEngine()
+        self.python_engine = PythonDeltaEngine()
+
+        self.random = random.Random(1)
+
+    def random_bytes(self, size):
+        return bytes(self.random.getrandbits(8) for i in range(size))
+
+    def edit(self, data, num_edits):
+        data = bytearray(data)
+
+        for i in range(num_edits):
+            offset = self.random.randint(0, len(data))
+            size = self.random.randint(1, 50)
+
+            if i % 3 == 0:
+                data[offset:offset] = self.random_bytes(size)
+            elif i % 3 == 1:
+                del data[offset:offset + size]
+            else:
+                data[offset:offset + size] = self.random_bytes(size)
+
+        return bytes(data)
+
+    def patch(self, basis, delta, block_size):
+        result = BytesIO()
+        pyrsync2.patchstream(BytesIO(basis), result, delta, block_size)
+
+        return result.getvalue()
+
+    def test_blockchecksums_match_pyrsync2(self):
+        for size in (0, 10, 64, 1000, 5000):
+            data = self.random_bytes(size)
+
+            self.assertEqual(
+                self.engine.blockchecksums(BytesIO(data), 64),
+                self.python_engine.blockchecksums(BytesIO(data), 64)
+            )
+
+    def test_blockchecksums_file(self):
+        data = self.random_bytes(5000)
+
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            file.flush()
+            file.seek(0)
+
+            self.assertEqual(
+                self.engine.blockchecksums(file, 128),
+                self.python_engine.blockchecksums(BytesIO(data), 128)
+            )
+
+    def test_delta(self):
+        self.engine.SEGMENT_SIZE = 1000
+
+        for num_edits in (0, 1, 5, 20):
+            basis = self.random_bytes(10000)
+            new = self.edit(basis, num_edits)
+            checksums = self.python_engine.blockchecksums(BytesIO(basis), 64)
+
+            delta = list(self.engine.rsyncdelta(
+                BytesIO(new),
+                checksums,
+                64,
+                64
+            ))
+
+            self.assertEqual(self.patch(basis, delta, 64), new)
+            self.assertTrue(all(
+                len(block) <= 64 for block in delta
+                if not isinstance(block, int)
+            ))
+
+    def test_delta_matches_blocks(self):
+        basis = self.random_bytes(6400)
+        new = basis[:3200] + b'changed' + basis[3200:]
+        checksums = self.engine.blockchecksums(BytesIO(basis), 64)
+
+        delta = list(self.engine.rsyncdelta(BytesIO(new), checksums, 64, 64))
+
+        self.assertEqual(delta, list(range(50)) + [b'changed'] +
+                         list(range(50, 100)))
+
+    def test_delta_matches_short_last_block(self):
+        basis = self.random_bytes(6410)
+        new = b'changed' + basis
+        checksums = self.engine.blockchecksums(BytesIO(basis), 64)
+
+        delta = list(self.engine.rsyncdelta(BytesIO(new), checksums, 64, 64))
+
+        self.assertEqual(delta, [b'changed'] + list(range(101)))
+        self.assertEqual(self.patch(basis, delta, 64), new)
+
+    def test_delta_without_checksums(self):
+        new = self.random_bytes(1000)
+
+        delta = list(self.engine.rsyncdelta(BytesIO(new), [], 64, 256))
+
+        self.assertEqual(b''.join(delta), new)
+        self.assertEqual([len(block) for block in delta], [256] * 3 + [232])
+
+    def test_blockchecksums_segments(self):
+        self.engine.SEGMENT_SIZE = 1000
+        data = self.random_bytes(5000)
+
+        self.assertEqual(
+            self.engine.blockchecksums(BytesIO(data), 64),
+            self.python_engine.blockchecksums(BytesIO(data), 64)
+        )
+
+    def test_delta_segments_match_pyrsync2(self):
+        self.engine.SEGMENT_SIZE = 1000
+        basis = self.random_bytes(10000)
+        new = self.edit(basis, 5) + self.random_bytes(3000)
+        checksums = self.python_engine.blockchecksums(BytesIO(basis), 64)
+
+        self.assertEqual(
+            list(self.engine.rsyncdelta(BytesIO(new), checksums, 64, 64)),
+            list(self.python_engine.rsyncdelta(
+                BytesIO(new),
+                checksums,
+                64,
+                64
+            ))
+        )
+
+    def test_delta_truncated_file(self):
+        self.engine.SEGMENT_SIZE = 1000
+        basis = self.random_bytes(10000)
+        checksums = self.engine.blockchecksums(BytesIO(basis), 64)
+
+        new = b'changed' + basis
+
+        with tempfile.TemporaryFile() as file:
+            file.write(new)
+            file.flush()
+            file.seek(0)
+
+            delta = self.engine.rsyncdelta(file, checksums, 64, 64)
+            self.assertEqual(next(delta), b'changed')
+
+            file.truncate(3000)
+            delta = [b'changed'] + list(delta)
+
+        self.assertEqual(self.patch(basis, delta, 64), new[:3000])
+
+    def test_delta_file(self):
+        basis = self.random_bytes(10000)
+        new = self.edit(basis, 5)
+        checksums = self.engine.blockchecksums(BytesIO(basis), 128)
+
+        with tempfile.TemporaryFile() as file:
+            file.write(new)
+            file.flush()
+            file.seek(0)
+
+            delta = list(self.engine.rsyncdelta(file, checksums, 128, 128))
+
+        self.assertEqual(self.patch(basis, delta, 128), new)
+
+    def test_delta_empty_file(self):
+        checksums = self.engine.blockchecksums(BytesIO(b'1234'), 64)
+
+        with tempfile.TemporaryFile() as file:
+            self.assertEqual(
+                list(self.engine.rsyncdelta(file, checksums, 64, 64)),
+                []
+            )
+
+
+class ProcessDeltaEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = ProcessDeltaEngine('python', 1)
+        self.python_engine = PythonDeltaEngine()
+
+        generator = random.Random(1)
+        self.basis = bytes(generator.getrandbits(8) for i in range(1024))
+        self.new = b'abc' + self.basis[:512] + b'defg' + self.basis[512:]
+
+        self.file = tempfile.NamedTemporaryFile()
+        self.file.write(self.new)
+        self.file.flush()
+
+        self.checksums = self.python_engine.blockchecksums(
+            BytesIO(self.basis),
+            64
+        )
+
+    def tearDown(self):
+        self.engine.shutdown()
+        self.file.close()
+
+    def test_compute_delta_operations(self):
+        self.assertEqual(
+            compute_delta_operations(
+                'python',
+                self.file.name,
+                self.checksums,
+                64,
+                get_file_version(self.file)
+            ),
+            [(0, 3)] + list(range(8)) + [(515, 4)] + list(range(8, 16))
+        )
+
+    def test_compute_delta_operations_replaced_file(self):
+        self.assertIsNone(
+            compute_delta_operations(
+                'python',
+                self.file.name,
+                self.checksums,
+                64,
+                (0, 0, 0)
+            )
+        )
+
+    def test_rsyncdelta_replaced_file(self):
+        with open(self.file.name, 'rb') as file:
+            # The path is replaced after the caller opened it
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(self.file.name),
+                    delete=False) as other:
+                other.write(self.basis)
+            os.replace(other.name, self.file.name)
+
+            delta = list(self.engine.rsyncdelta(
+                file,
+                self.checksums,
+                64,
+                2
+            ))
+
+        # The delta is of the file the caller has open
+        self.assertEqual(
+            delta,
+            list(self.python_engine.rsyncdelta(
+                BytesIO(self.new),
+                self.checksums,
+                64,
+                2
+            ))
+        )
+
+    def test_rsyncdelta(self):
+        with open(self.file.name, 'rb') as file:
+            delta = list(self.engine.rsyncdelta(
+                file,
+                self.checksums,
+                64,
+                2
+            ))
+
+        self.assertEqual(
+            delta,
+            [b'ab', b'c'] + list(range(8)) + [b'de', b'fg'] +
+            list(range(8, 16))
+        )
+
+    def test_rsyncdelta_big_file(self):
+        # Bigger than the file, but not than the remote one
+        self.engine.MAX_FILE_SIZE = len(self.new) - 1
+
+        with open(self.file.name, 'rb') as file:
+            delta = list(self.engine.rsyncdelta(
+                file,
+                self.checksums,
+                64,
+                2
+            ))
+
+        self.assertEqual(
+            delta,
+            [b'ab', b'c'] + list(range(8)) + [b'de', b'fg'] +
+            list(range(8, 16))
+        )
+        # Computed on the calling thread
+        self.assertIsNone(self.engine.executor)
+
+    def test_rsyncdelta_big_remote_file(self):
+        self.engine.MAX_FILE_SIZE = len(self.basis) - 1
+
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(self.basis[:64])
+            file.flush()
+            file.seek(0)
+
+            delta = list(self.engine.rsyncdelta(
+                file,
+                self.checksums,
+                64,
+                64
+            ))
+
+        self.assertEqual(delta, [0])
+        self.assertIsNone(self.engine.executor)
+
+    def test_blockchecksums(self):
+        with open(self.file.name, 'rb') as file:
+            self.assertEqual(
+                self.engine.blockchecksums(file, 64),
+                self.python_engine.blockchecksums(BytesIO(self.new), 64)
+            )
+
+    def test_file_without_path(self):
+        self.assertEqual(
+            self.engine.blockchecksums(BytesIO(self.new), 64),
+            self.python_engine.blockchecksums(BytesIO(self.new), 64)
+        )
+        self.assertIsNone(self.engine.executor)
+
+
+class CreateDeltaEngineTests(unittest.TestCase):
+    def test_create(self):
+        self.assertIsInstance(
+            create_delta_engine('python'),
+            PythonDeltaEngine
+        )
+
+    def test_create_with_workers(self):
+        engine = create_delta_engine('python', 2)
+
+        self.assertIsInstance(engine, ProcessDeltaEngine)
+        self.assertEqual(engine.engine_name, 'python')
+        self.assertEqual(engine.workers, 2)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, create_delta_engine, 'unknown')
@@ -0,0 +1,86 @@
+import unittest
+
+from syncall.hash_index import HashIndex, get_content_key, \
+    get_content_keys, same_content
+
+
+class HashIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.index = HashIndex.build([
+            ('file1', {'hash': b'1', 'size': 10}),
+            ('file2', {'hash': b'1', 'size': 10}),
+            ('file3', {'hash': b'1', 'size': 20}),
+            ('deleted', {'hash': b'1', 'size': 10, 'deleted': True}),
+            ('not_hashed', {'size': 10})
+        ])
+
+    def test_get_content_key(self):
+        self.assertEqual(
+            get_content_key({'hash': b'1', 'size': 10}),
+            ('md5', b'1', 10)
+        )
+        self.assertEqual(
+            get_content_key({
+                'hash': b'1',
+                'size': 10,
+                'hash_algorithm': 'blake2b'
+            }),
+            ('blake2b', b'1', 10)
+        )
+        self.assertIsNone(get_content_key({'hash': b'', 'deleted': True}))
+        self.assertIsNone(get_content_key(None))
+
+    def test_get_content_keys(self):
+        self.assertEqual(
+            get_content_keys({
+                'hash': b'1',
+                'size': 10,
+                'hash_algorithm': 'blake2b',
+                'hashes': {'md5': b'2'}
+            }),
+            {('blake2b', b'1', 10), ('md5', b'2', 10)}
+        )
+        self.assertEqual(get_content_keys(None), set())
+
+    def test_same_content(self):
+        md5 = {'hash': b'2', 'size': 10}
+        blake2b = {'hash': b'1', 'size': 10, 'hash_algorithm': 'blake2b'}
+
+        self.assertTrue(same_content(md5, dict(md5)))
+        self.assertFalse(same_content(md5, dict(md5, hash=b'3')))
+        # No common algorithm
+        self.assertFalse(same_content(md5, blake2b))
+        self.assertTrue(same_content(md5, dict(blake2b, hashes={'md5': b'2'})))
+        self.assertFalse(
+            same_content(md5, dict(blake2b, hashes={'md5': b'3'}))
+        )
+        self.assertFalse(same_content(md5, None))
+
+    def test_get_files(self):
+        self.assertEqual(
+            self.index.get_files(('md5', b'1', 10)),
+            {'file1', 'file2'}
+        )
+        self.assertEqual(self.index.get_files(('md5', b'1', 20)), {'file3'})
+        self.assertEqual(self.index.get_files(('md5', b'2', 10)), set())
+
+    def test_update(self):
+        self.index.update('file1', {'hash': b'2', 'size': 10})
+        self.index.update('file3', None)
+        self.index.update('file2', {'hash': b'', 'deleted': True})
+
+        self.assertEqual(self.index.get_files(('md5', b'1', 10)), set())
+        self.assertEqual(self.index.get_files(('md5', b'2', 10)), {'file1'})
+        self.assertEqual(self.index.files, {('md5', b'2', 10): {'file1'}})
+
+        self.index.update('file1', {
+            'hash': b'3',
+            'size': 10,
+            'hash_algorithm': 'blake2b',
+            'hashes': {'md5': b'2'}
+        })
+        self.assertEqual(self.index.get_files(('md5', b'2', 10)), {'file1'})
+        self.assertEqual(
+            self.index.get_files(('blake2b', b'3', 10)),
+            {'file1'}
+        )
@@ -0,0 +1,144 @@
+import unittest
+import os
+import threading
+import time
+
+from io import BytesIO
+from unittest.mock import patch
+
+import bintools
+import syncall
+
+from syncall.hashing import HashPool, HashingWriter
+
+
+class HashPoolTests(unittest.TestCase):
+    TEST_DIR = os.path.dirname(os.path.realpath(__file__)) + '/test_files'
+
+    TEST_FILES = (
+        'README.txt',
+        'animals/README.txt',
+        'animals/cat.jpg',
+        'animals/dogs/dog.jpg'
+    )
+
+    def get_items(self):
+        return [
+            (name, os.path.join(self.TEST_DIR, name), 'md5')
+            for name in self.TEST_FILES
+        ]
+
+    def test_serial(self):
+        pool = HashPool(workers=1)
+
+        self.assertEqual(list(pool.hash_files(self.get_items())), [
+            (name, bintools.hash_file(path))
+            for name, path, algorithm in self.get_items()
+        ])
+
+    def test_parallel_same_as_serial(self):
+        serial = list(HashPool(workers=1).hash_files(self.get_items()))
+        parallel = list(
+            HashPool(workers=3, queue_size=2).hash_files(self.get_items())
+        )
+
+        self.assertEqual(parallel, serial)
+
+    def test_bounded_queue(self):
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def slow_hash(path, algorithm):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+
+            time.sleep(0.01)
+
+            with lock:
+                running[0] -= 1
+
+            return path
+
+        consumed = []
+
+        def items():
+            for i in range(20):
+                # Never more than queue_size items ahead of the consumer
+                self.assertLessEqual(i - len(consumed), 3)
+                yield (i, 'file{}'.format(i), 'md5')
+
+        pool = HashPool(workers=4, queue_size=3)
+
+        with patch('bintools.hash_file', side_effect=slow_hash):
+            for key, file_hash in pool.hash_files(items()):
+                consumed.append(key)
+                self.assertEqual(file_hash, 'file{}'.format(key))
+
+        self.assertEqual(consumed, list(range(20)))
+        self.assertLessEqual(max_running[0], 3)
+
+    def test_errors_propagate(self):
+        pool = HashPool(workers=2)
+
+        with self.assertRaises(OSError):
+            list(pool.hash_files([
+                ('missing', self.TEST_DIR + '/missing', 'md5')
+            ]))
+
+    @patch('logging.Logger')
+    def test_directory_parallel_index(self, Logger):
+        serial = syncall.Directory('uuid', self.TEST_DIR, load_index=False)
+        parallel = syncall.Directory(
+            'uuid',
+            self.TEST_DIR,
+            load_index=False,
+            hash_workers=4,
+            hash_queue_size=2
+        )
+
+        serial.update_index(save_index=False)
+        parallel.update_index(save_index=False)
+
+        self.assertEqual(parallel._index, serial._index)
+
+
+class HashingWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.file = BytesIO()
+        self.writer = HashingWriter(self.file, 'md5')
+
+    def expected_digest(self):
+        file_hash = bintools.new_hash('md5')
+        file_hash.update(self.file.getvalue())
+
+        return file_hash.digest()
+
+    def test_sequential_writes(self):
+        self.writer.write(b'1234')
+        self.writer.write(b'5678')
+
+        self.assertEqual(self.writer.hashed, 8)
+
+        # Nothing is read back
+        with patch.object(self.file, 'read') as read:
+            read.return_value = b''
+            self.assertEqual(self.writer.digest(), self.expected_digest())
+
+    def test_out_of_order_writes(self):
+        self.writer.write(b'1234')
+        self.writer.seek(8)
+        self.writer.write(b'9012')
+        self.writer.seek(4)
+        self.writer.write(b'5678')
+
+        self.assertEqual(self.file.getvalue(), b'123456789012')
+        self.assertEqual(self.writer.digest(), self.expected_digest())
+
+    def test_overwrite(self):
+        self.writer.write(b'1234')
+        self.writer.seek(0)
+        self.writer.write(b'4321')
+
+        self.assertEqual(self.writer.digest(), self.expected_digest())
@@ -0,0 +1,87 @@
+import unittest
+import os
+import tempfile
+
+from syncall.ignore import IgnoreRules
+
+
+class IgnoreRulesTests(unittest.TestCase):
+    def test_default_rules(self):
+        rules = IgnoreRules.load('/nonexistent/.syncallignore')
+
+        self.assertTrue(rules.matches('.syncall_index'))
+        self.assertTrue(rules.matches('.syncall_temp', is_dir=True))
+        self.assertTrue(rules.matches('.syncall_temp/file'))
+        self.assertTrue(rules.matches('dir/.syncall_index'))
+        self.assertFalse(rules.matches('.syncallignore'))
+        self.assertFalse(rules.matches('dir/file'))
+        self.assertFalse(rules.matches(''))
+
+    def test_no_rules(self):
+        rules = IgnoreRules()
+
+        self.assertFalse(rules.matches('file'))
+        self.assertFalse(rules.matches('dir', is_dir=True))
+
+    def test_name_patterns(self):
+        rules = IgnoreRules(['*.tmp', 'build', 'file?.txt', '[ab].log'])
+
+        self.assertTrue(rules.matches('x.tmp'))
+        self.assertTrue(rules.matches('dir/x.tmp'))
+        self.assertFalse(rules.matches('x.tmp.txt'))
+        self.assertTrue(rules.matches('build'))
+        self.assertTrue(rules.matches('build', is_dir=True))
+        self.assertTrue(rules.matches('dir/build/x.txt'))
+        self.assertFalse(rules.matches('dir/builds'))
+        self.assertTrue(rules.matches('file1.txt'))
+        self.assertFalse(rules.matches('file10.txt'))
+        self.assertTrue(rules.matches('a.log'))
+        self.assertFalse(rules.matches('c.log'))
+
+    def test_anchored_patterns(self):
+        rules = IgnoreRules(['/top.txt', 'docs/*.pdf', 'a/**/z', 'logs/**'])
+
+        self.assertTrue(rules.matches('top.txt'))
+        self.assertFalse(rules.matches('dir/top.txt'))
+        self.assertTrue(rules.matches('docs/x.pdf'))
+        self.assertFalse(rules.matches('docs/sub/x.pdf'))
+        self.assertFalse(rules.matches('dir/docs/x.pdf'))
+        self.assertTrue(rules.matches('a/z'))
+        self.assertTrue(rules.matches('a/b/c/z'))
+        self.assertTrue(rules.matches('logs/x/y'))
+        self.assertFalse(rules.matches('logs', is_dir=True))
+
+    def test_directory_only(self):
+        rules = IgnoreRules(['cache/'])
+
+        self.assertTrue(rules.matches('cache', is_dir=True))
+        self.assertTrue(rules.matches('dir/cache', is_dir=True))
+        self.assertTrue(rules.matches('cache/file'))
+        self.assertFalse(rules.matches('cache'))
+
+    def test_negation(self):
+        rules = IgnoreRules([
+            '# comment',
+            '',
+            '*.log',
+            '!important.log',
+            'dir/important.log'
+        ])
+
+        self.assertTrue(rules.matches('debug.log'))
+        self.assertFalse(rules.matches('important.log'))
+        self.assertFalse(rules.matches('x/important.log'))
+        self.assertTrue(rules.matches('dir/important.log'))
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, '.syncallignore')
+
+            with open(path, 'w') as ignore_file:
+                ignore_file.write('*.bak  \n!keep.bak\n')
+
+            rules = IgnoreRules.load(path)
+
+        self.assertTrue(rules.matches('x.bak'))
+        self.assertFalse(rules.matches('keep.bak'))
+        self.assertTrue(rules.matches('.syncall_index'))
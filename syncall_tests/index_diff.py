@@ -10,12 +10,16 @@ class IndexDiffTests(unittest.TestCase):
         self.assertEqual(diff[1], deletes)
         self.assertEqual(diff[2], conflicts)
 
+    def set_index(self, directory, index):
+        for file_name, file_data in index.items():
+            directory._index[file_name] = file_data
+
     def setUp(self):
         self.dirA = syncall.Directory('A', 'dummy_dir', load_index=False)
         self.dirB = syncall.Directory('B', 'dummy_dir', load_index=False)
 
     def test_new_file(self):
-        self.dirA._index = {
+        self.set_index(self.dirA, {
             'dir/file1': {
                 'last_update': 10,
                 'last_update_location': 'A',
@@ -24,8 +28,8 @@ class IndexDiffTests(unittest.TestCase):
                     'A': 10
                 }
             }
-        }
-        self.dirB._index = {}
+        })
+        self.set_index(self.dirB, {})
 
         diffAB = self.dirA.diff(self.dirB._index)
         self.assertDiff(diffAB, {'dir/file1'}, set(), set())
@@ -34,7 +38,7 @@ class IndexDiffTests(unittest.TestCase):
         self.assertDiff(diffBA, set(), set(), set())
 
     def test_modified_file_simple(self):
-        self.dirA._index = {
+        self.set_index(self.dirA, {
             'dir/file1': {
                 'last_update': 1,
                 'last_update_location': 'A',
@@ -43,8 +47,8 @@ class IndexDiffTests(unittest.TestCase):
                     'A': 1
                 }
             }
-        }
-        self.dirB._index = {
+        })
+        self.set_index(self.dirB, {
             'dir/file1': {
                 'last_update': 10,
                 'last_update_location': 'B',
@@ -54,7 +58,7 @@ class IndexDiffTests(unittest.TestCase):
                     'B': 10
                 }
             }
-        }
+        })
 
         diffAB = self.dirA.diff(self.dirB._index)
         self.assertDiff(diffAB, set(), set(), set())
@@ -63,7 +67,7 @@ class IndexDiffTests(unittest.TestCase):
         self.assertDiff(diffBA, {'dir/file1'}, set(), set())
 
     def test_modified_file_common_history(self):
-        self.dirA._index = {
+        self.set_index(self.dirA, {
             'dir/file1': {
                 'last_update': 5,
                 'last_update_location': 'C',
@@ -73,8 +77,8 @@ class IndexDiffTests(unittest.TestCase):
                     'C': 5
                 }
             }
-        }
-        self.dirB._index = {
+        })
+        self.set_index(self.dirB, {
             'dir/file1': {
                 'last_update': 10,
                 'last_update_location': 'B',
@@ -85,7 +89,7 @@ class IndexDiffTests(unittest.TestCase):
                     'B': 10
                 }
             }
-        }
+        })
 
         diffAB = self.dirA.diff(self.dirB._index)
         self.assertDiff(diffAB, set(), set(), set())
@@ -94,7 +98,7 @@ class IndexDiffTests(unittest.TestCase):
         self.assertDiff(diffBA, {'dir/file1'}, set(), set())
 
     def test_conflict_simple(self):
-        self.dirA._index = {
+        self.set_index(self.dirA, {
             'dir/file1': {
                 'last_update': 5,
                 'last_update_location': 'A',
@@ -103,8 +107,8 @@ class IndexDiffTests(unittest.TestCase):
                     'A': 5
                 }
             }
-        }
-        self.dirB._index = {
+        })
+        self.set_index(self.dirB, {
             'dir/file1': {
                 'last_update': 6,
                 'last_update_location': 'B',
@@ -113,10 +117,102 @@ class IndexDiffTests(unittest.TestCase):
                     'B': 6
                 }
             }
-        }
+        })
 
         diffAB = self.dirA.diff(self.dirB._index)
         self.assertDiff(diffAB, set(), set(), {'dir/file1'})
 
         diffBA = self.dirB.diff(self.dirA._index)
         self.assertDiff(diffBA, set(), set(), {'dir/file1'})
+
+    def test_same_content_conflict(self):
+        self.set_index(self.dirA, {
+            'dir/file1': {
+                'last_update': 5,
+                'last_update_location': 'A',
+                'hash': b'1',
+                'size': 10,
+                'sync_log': {
+                    'A': 5
+                }
+            }
+        })
+        self.set_index(self.dirB, {
+            'dir/file1': {
+                'last_update': 10,
+                'last_update_location': 'B',
+                'hash': b'1',
+                'size': 10,
+                'sync_log': {
+                    'B': 10
+                }
+            }
+        })
+
+        # Only the side with the later update sends its sync log
+        diffAB = self.dirA.diff(self.dirB._index)
+        self.assertDiff(diffAB, set(), set(), set())
+
+        diffBA = self.dirB.diff(self.dirA._index)
+        self.assertDiff(diffBA, {'dir/file1'}, set(), set())
+
+        self.assertEqual(
+            syncall.IndexDiff.compare_file(
+                self.dirB._index['dir/file1'],
+                self.dirA._index['dir/file1']
+            ),
+            syncall.index.SAME_CONTENT
+        )
+
+    def test_same_content_update(self):
+        self.set_index(self.dirA, {
+            'dir/file1': {
+                'last_update': 10,
+                'last_update_location': 'A',
+                'hash': b'1',
+                'size': 10,
+                'sync_log': {
+                    'A': 10,
+                    'B': 5
+                }
+            }
+        })
+        self.set_index(self.dirB, {
+            'dir/file1': {
+                'last_update': 5,
+                'last_update_location': 'B',
+                'hash': b'1',
+                'size': 10,
+                'sync_log': {
+                    'B': 5
+                }
+            }
+        })
+
+        self.assertEqual(
+            syncall.IndexDiff.compare_file(
+                self.dirA._index['dir/file1'],
+                self.dirB._index['dir/file1']
+            ),
+            syncall.index.SAME_CONTENT
+        )
+
+        # Different hash algorithms can't be compared
+        self.dirB._index['dir/file1']['hash_algorithm'] = 'sha256'
+
+        self.assertEqual(
+            syncall.IndexDiff.compare_file(
+                self.dirA._index['dir/file1'],
+                self.dirB._index['dir/file1']
+            ),
+            syncall.index.NEEDS_UPDATE
+        )
+
+    def test_merge_sync_logs(self):
+        self.assertEqual(
+            syncall.index.merge_sync_logs(
+                {'A': 5, 'B': 10},
+                {'B': 7, 'C': 3}
+            ),
+            {'A': 5, 'B': 10, 'C': 3}
+        )
@@ -0,0 +1,85 @@
+import unittest
+import pickle
+import msgpack
+
+from syncall.index_entry import IndexEntry, SyncLog, msgpack_default
+
+
+def create_data():
+    return {
+        'last_update': 5.5,
+        'last_update_location': 'uuid1',
+        'hash': b'hash',
+        'hash_algorithm': 'md5',
+        'sync_log': {'uuid1': 5.5, 'uuid2': 3},
+        'size': 10,
+        'inode': 20,
+        'mtime_ns': 30
+    }
+
+
+class IndexEntryTests(unittest.TestCase):
+    def test_dict_interface(self):
+        entry = IndexEntry(create_data())
+
+        self.assertEqual(entry, create_data())
+        self.assertEqual(create_data(), entry)
+        self.assertEqual(len(entry), 8)
+        self.assertEqual(entry['last_update_location'], 'uuid1')
+        self.assertIsInstance(entry['sync_log'], SyncLog)
+        self.assertNotIn('deleted', entry)
+        self.assertIsNone(entry.get('deleted'))
+
+        entry['deleted'] = True
+        del entry['size']
+
+        self.assertIn('deleted', entry)
+        self.assertNotIn('size', entry)
+        with self.assertRaises(KeyError):
+            entry['size']
+        with self.assertRaises(KeyError):
+            del entry['size']
+
+        self.assertFalse(IndexEntry())
+
+    def test_sync_log(self):
+        entry = IndexEntry(create_data())
+        sync_log = entry['sync_log']
+
+        sync_log['uuid2'] = 6
+        sync_log['uuid3'] = 7
+        del sync_log['uuid1']
+
+        self.assertEqual(entry['sync_log'], {'uuid2': 6, 'uuid3': 7})
+        self.assertNotIn('uuid1', entry['sync_log'])
+        self.assertNotIn('uuid_unknown', entry['sync_log'])
+
+        new_entry = IndexEntry()
+        new_entry.setdefault('sync_log', dict())['uuid1'] = 1
+
+        self.assertEqual(new_entry['sync_log'], {'uuid1': 1})
+
+    def test_unknown_keys(self):
+        entry = IndexEntry({'test': 'test'})
+
+        self.assertEqual(entry, {'test': 'test'})
+        self.assertEqual(entry['test'], 'test')
+
+    def test_copy(self):
+        entry = IndexEntry(create_data())
+        copy = IndexEntry(entry)
+
+        copy['sync_log']['uuid1'] = 10
+        copy['hash'] = b'changed'
+
+        self.assertEqual(entry, create_data())
+        self.assertIs(IndexEntry.compact(entry), entry)
+
+    def test_serialization(self):
+        entry = IndexEntry(create_data())
+
+        self.assertEqual(
+            msgpack.unpackb(msgpack.packb(entry, default=msgpack_default)),
+            create_data()
+        )
+        self.assertEqual(pickle.loads(pickle.dumps(entry)), entry)
@@ -0,0 +1,473 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import msgpack
+
+from syncall.index_store import JournalIndexStore, SQLiteIndexStore, \
+    MappedSnapshot, OverlayIndex
+
+
+class JournalIndexStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, '.syncall_index')
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_store(self, **kwargs):
+        store = JournalIndexStore(self.path, self.lock, **kwargs)
+        store.load()
+
+        return store
+
+    def test_first_save_writes_snapshot(self):
+        store = self.create_store()
+        store['file1'] = {'last_update': 1, 'hash': b'1'}
+        store.save()
+
+        self.assertTrue(os.path.isfile(self.path))
+        self.assertFalse(os.path.isfile(store.journal_path))
+
+        self.assertEqual(
+            dict(self.create_store()),
+            {'file1': {'last_update': 1, 'hash': b'1'}}
+        )
+
+    def test_save_appends_changes_to_journal(self):
+        store = self.create_store()
+        store['file1'] = {'last_update': 1}
+        store['file2'] = {'last_update': 2}
+        store.save()
+
+        snapshot_size = os.path.getsize(self.path)
+
+        store['file2'] = {'last_update': 3}
+        del store['file1']
+        store.save()
+
+        self.assertEqual(os.path.getsize(self.path), snapshot_size)
+        self.assertTrue(os.path.isfile(store.journal_path))
+
+        journal_size = os.path.getsize(store.journal_path)
+        store.save()
+        self.assertEqual(os.path.getsize(store.journal_path), journal_size)
+
+        self.assertEqual(
+            dict(self.create_store()),
+            {'file2': {'last_update': 3}}
+        )
+
+    def test_torn_journal_record(self):
+        store = self.create_store()
+        store['file1'] = {'last_update': 1}
+        store.save()
+
+        store['file1'] = {'last_update': 2}
+        store.save()
+        journal_size = os.path.getsize(store.journal_path)
+
+        store['file1'] = {'last_update': 3}
+        store.save()
+
+        # Crash while writing the last record
+        with open(store.journal_path, 'r+b') as journal:
+            journal.truncate(os.path.getsize(store.journal_path) - 3)
+
+        store = self.create_store()
+
+        self.assertEqual(store['file1'], {'last_update': 2})
+        self.assertEqual(os.path.getsize(store.journal_path), journal_size)
+
+    def test_corrupt_journal_record(self):
+        store = self.create_store()
+        store['file1'] = {'last_update': 1}
+        store.save()
+
+        store['file1'] = {'last_update': 2}
+        store.save()
+
+        with open(store.journal_path, 'r+b') as journal:
+            journal.seek(-1, os.SEEK_END)
+            journal.write(b'\xff')
+
+        self.assertEqual(self.create_store()['file1'], {'last_update': 1})
+
+    def test_load_legacy_index(self):
+        with open(self.path, 'wb') as index_file:
+            index_file.write(msgpack.packb({
+                'file1': {'last_update': 1, 'hash': b'\xff'}
+            }))
+
+        store = self.create_store()
+
+        self.assertEqual(
+            dict(store),
+            {'file1': {'last_update': 1, 'hash': b'\xff'}}
+        )
+
+        store['file2'] = {'last_update': 2}
+        store.save()
+
+        self.assertEqual(set(self.create_store()), {'file1', 'file2'})
+
+    def test_compaction(self):
+        store = self.create_store(background_compaction=False)
+        store.MIN_COMPACTION_SIZE = 0
+
+        store['file1'] = {'last_update': 1}
+        store.save()
+
+        store['file1'] = {'last_update': 2}
+        store['file2'] = {'last_update': 3}
+        store.save()
+
+        self.assertTrue(os.path.isfile(store.journal_path))
+
+        store['file2'] = {'last_update': 4}
+        store.save()
+
+        self.assertEqual(os.path.getsize(store.journal_path), 0)
+        self.assertEqual(dict(self.create_store()), {
+            'file1': {'last_update': 2},
+            'file2': {'last_update': 4}
+        })
+
+    def test_snapshot(self):
+        store = self.create_store(background_compaction=False)
+        store.MIN_COMPACTION_SIZE = 0
+
+        store['file1'] = {'last_update': 1}
+        store['file2'] = {'last_update': 2}
+        store.save()
+        store['file3'] = {'last_update': 3}
+
+        snapshot = store.snapshot()
+
+        store['file1'] = {'last_update': 4}
+        del store['file2']
+        store.save()
+        store.save()
+
+        self.assertEqual(dict(snapshot.items()), {
+            'file1': {'last_update': 1},
+            'file2': {'last_update': 2},
+            'file3': {'last_update': 3}
+        })
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(dict(store.items()), {
+            'file1': {'last_update': 4},
+            'file3': {'last_update': 3}
+        })
+
+    def test_background_compaction(self):
+        store = self.create_store()
+        store.MIN_COMPACTION_SIZE = 0
+
+        store['file1'] = {'last_update': 1}
+        store.save()
+
+        with self.lock:
+            for i in range(2, 6):
+                store['file{}'.format(i)] = {'last_update': i}
+
+            store['file1'] = {'last_update': 5}
+            store.save()
+
+        store.wait_for_compaction()
+
+        self.assertEqual(os.path.getsize(store.journal_path), 0)
+        self.assertEqual(
+            self.create_store()['file1'],
+            {'last_update': 5}
+        )
+
+    def test_compaction_keeps_unsaved_entries(self):
+        store = self.create_store()
+        store['file1'] = {'last_update': 1}
+        store.save()
+
+        store['file2'] = {'last_update': 2}
+        store.compact()
+
+        self.assertEqual(store['file2'], {'last_update': 2})
+        store.save()
+
+        self.assertEqual(dict(self.create_store()), {
+            'file1': {'last_update': 1},
+            'file2': {'last_update': 2}
+        })
+
+    def test_replay_skips_compacted_records(self):
+        store = self.create_store()
+        store['file1'] = {'last_update': 1}
+        store.save()
+
+        store['file1'] = {'last_update': 2}
+        store.save()
+
+        with open(store.journal_path, 'rb') as journal:
+            journal_data = journal.read()
+
+        store.compact()
+        store['file2'] = {'last_update': 3}
+        store.save()
+
+        # Crash after writing the snapshot but before truncating
+        # the journal
+        with open(store.journal_path, 'rb') as journal:
+            journal_data += journal.read()
+
+        with open(store.journal_path, 'wb') as journal:
+            journal.write(journal_data)
+
+        store = self.create_store()
+        store['file1'] = {'last_update': 4}
+        store.save()
+
+        self.assertEqual(dict(self.create_store()), {
+            'file1': {'last_update': 4},
+            'file2': {'last_update': 3}
+        })
+
+    def test_lazy_loading(self):
+        store = self.create_store()
+
+        for file_name in ('b', 'a/c', 'a/b', 'a0', 'a'):
+            store[file_name] = {'last_update': 1, 'name': file_name}
+
+        store.save()
+
+        store = self.create_store()
+
+        self.assertIsNotNone(store._snapshot)
+        self.assertEqual(store._data, {})
+        self.assertEqual(len(store), 5)
+        self.assertEqual(store['a/b'], {'last_update': 1, 'name': 'a/b'})
+        self.assertNotIn('a/d', store)
+
+        store['a/d'] = {'last_update': 2}
+        store['a/a'] = {'last_update': 2}
+        del store['a/b']
+
+        self.assertEqual(len(store), 6)
+        self.assertEqual(list(store), ['a', 'a/a', 'a/c', 'a/d', 'a0', 'b'])
+        self.assertEqual(
+            [file_name for file_name, data in store.prefix_items('a')],
+            ['a', 'a/a', 'a/c', 'a/d']
+        )
+
+        with self.assertRaises(KeyError):
+            store['a/b']
+
+        store.save()
+
+        self.assertEqual(dict(self.create_store()), dict(store))
+
+
+class MappedSnapshotTests(unittest.TestCase):
+    def test_pack_and_lookup(self):
+        records = [
+            ('a', msgpack.packb({'last_update': 1})),
+            ('b/c', msgpack.packb({'last_update': 2})),
+            ('\u00e4', msgpack.packb({'last_update': 3}))
+        ]
+
+        with tempfile.TemporaryFile() as file:
+            file.write(MappedSnapshot.pack(7, records))
+            file.flush()
+
+            snapshot = MappedSnapshot(file)
+
+            self.assertEqual(snapshot.seq, 7)
+            self.assertEqual(len(snapshot), 3)
+            self.assertEqual(list(snapshot.records()), records)
+            self.assertEqual(snapshot.get('b/c'), records[1][1])
+            self.assertEqual(snapshot.get('\u00e4'), records[2][1])
+            self.assertIsNone(snapshot.get('b'))
+            self.assertEqual(snapshot.bisect('b'), 1)
+
+    def test_unknown_format(self):
+        with tempfile.TemporaryFile() as file:
+            file.write(b'SYNCALLI' + b'\xff' * 20)
+            file.flush()
+
+            with self.assertRaises(ValueError):
+                MappedSnapshot(file)
+
+
+class OverlayIndexTests(unittest.TestCase):
+    def test_changes_kept_out_of_base(self):
+        base = {
+            'file1': {'last_update': 1},
+            'file2': {'last_update': 2}
+        }
+        index = OverlayIndex(base)
+
+        index['file1'] = {'last_update': 3}
+        index['file3'] = {'last_update': 4}
+        del index['file2']
+
+        with self.assertRaises(KeyError):
+            del index['file2']
+
+        self.assertNotIn('file2', index)
+        self.assertIsNone(index.get('file2'))
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index, {
+            'file1': {'last_update': 3},
+            'file3': {'last_update': 4}
+        })
+        self.assertEqual(base, {
+            'file1': {'last_update': 1},
+            'file2': {'last_update': 2}
+        })
+
+        index['file2'] = {'last_update': 5}
+        self.assertEqual(len(index), 3)
+        self.assertEqual(set(index), {'file1', 'file2', 'file3'})
+
+
+class SQLiteIndexStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, '.syncall_index')
+        self.lock = threading.Lock()
+
+        self.store = self.create_store()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def create_store(self):
+        store = SQLiteIndexStore(self.path, self.lock)
+        store.load()
+
+        return store
+
+    def test_get_set_delete(self):
+        self.store['file1'] = {'last_update': 1, 'hash': b'\xff'}
+        self.store['file2'] = {'last_update': 2.5, 'sync_log': {'a': 2}}
+
+        self.assertEqual(len(self.store), 2)
+        self.assertIn('file1', self.store)
+        self.assertNotIn('file3', self.store)
+        self.assertIsNone(self.store.get('file3'))
+        self.assertEqual(self.store['file1'], {
+            'last_update': 1,
+            'hash': b'\xff'
+        })
+
+        del self.store['file1']
+
+        self.assertNotIn('file1', self.store)
+        self.assertEqual(dict(self.store), {
+            'file2': {'last_update': 2.5, 'sync_log': {'a': 2}}
+        })
+
+        with self.assertRaises(KeyError):
+            del self.store['file1']
+
+    def test_save(self):
+        self.store['file1'] = {'last_update': 1}
+        self.store.save()
+        self.store['file2'] = {'last_update': 2}
+        self.store.close()
+
+        self.store = self.create_store()
+
+        self.assertEqual(dict(self.store), {'file1': {'last_update': 1}})
+
+    def test_change_while_iterating(self):
+        self.store.BATCH_SIZE = 2
+
+        for i in range(5):
+            self.store['file{}'.format(i)] = {'last_update': i}
+
+        for file_name, file_data in self.store.items():
+            file_data['last_update'] += 10
+            self.store[file_name] = file_data
+
+        self.assertEqual(
+            [file_data['last_update'] for file_data in self.store.values()],
+            [10, 11, 12, 13, 14]
+        )
+
+    def test_snapshot(self):
+        self.store['file1'] = {'last_update': 1}
+        self.store['file2'] = {'last_update': 2}
+
+        snapshot = self.store.snapshot()
+
+        self.store['file1'] = {'last_update': 3}
+        del self.store['file2']
+        self.store.save()
+
+        self.assertEqual(dict(snapshot.items()), {
+            'file1': {'last_update': 1},
+            'file2': {'last_update': 2}
+        })
+        self.assertEqual(dict(self.store.items()), {
+            'file1': {'last_update': 3}
+        })
+
+        snapshot.close()
+
+    def test_snapshot_connection_reused(self):
+        self.store['file1'] = {'last_update': 1}
+
+        with self.store.snapshot() as snapshot:
+            connection = snapshot._connection
+            self.assertEqual(dict(snapshot), {'file1': {'last_update': 1}})
+
+        self.assertIsNone(snapshot._connection)
+        self.store['file1'] = {'last_update': 2}
+
+        # The read transaction was ended, the new state is seen
+        with self.store.snapshot() as snapshot:
+            self.assertIs(snapshot._connection, connection)
+            self.assertEqual(dict(snapshot), {'file1': {'last_update': 2}})
+
+    def test_prefix_items(self):
+        for file_name in ('a', 'a/b', 'a/c/d', 'a0', 'a.txt', 'b'):
+            self.store[file_name] = {'last_update': 1}
+
+        self.assertEqual(
+            [file_name for file_name, data in self.store.prefix_items('a')],
+            ['a', 'a/b', 'a/c/d']
+        )
+        self.assertEqual(
+            [file_name for file_name, data in self.store.prefix_items('a/c')],
+            ['a/c/d']
+        )
+
+    def test_dir_items(self):
+        self.store.BATCH_SIZE = 2
+
+        for file_name in ('a', 'a/b', 'a/c/d', 'a/c/e', 'a/f', 'a0', 'b',
+                          'b/g'):
+            self.store[file_name] = {'last_update': 1}
+
+        self.assertEqual(
+            [file_name for file_name, data in self.store.dir_items('a')],
+            ['a/b', 'a/f']
+        )
+        self.assertEqual(
+            [file_name for file_name, data in self.store.dir_items('')],
+            ['a', 'a0', 'b']
+        )
+        self.assertEqual(list(self.store.dir_items('missing')), [])
+
+    def test_updated_since(self):
+        self.store['file1'] = {'last_update': 1}
+        self.store['file2'] = {'last_update': 2.5}
+        self.store['file3'] = {'last_update': 3}
+
+        self.assertEqual(
+            set(self.store.updated_since(2)),
+            {'file2', 'file3'}
+        )
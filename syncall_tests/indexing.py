@@ -1,12 +1,17 @@
 import unittest
+import hashlib
 import os
 import time
 
-from unittest.mock import Mock, patch
+from io import BytesIO
+from unittest.mock import Mock, MagicMock, patch
 
 import bintools
 import syncall
 
+from syncall.chunking import chunk_id
+from syncall.delta import PythonDeltaEngine
+
 
 class DirectoryIndexTests(unittest.TestCase):
     TEST_DIR = os.path.dirname(os.path.realpath(__file__)) + '/test_files'
@@ -36,11 +41,23 @@ class DirectoryIndexTests(unittest.TestCase):
         except:
             pass
 
+        for suffix in ('.journal', '.sqlite', '.sqlite-wal', '.sqlite-shm',
+                       '.checksums', '.checksums-wal', '.checksums-shm'):
+            try:
+                os.remove(self.TEST_DIR + '/.syncall_index' + suffix)
+            except:
+                pass
+
         try:
             os.remove(self.TEST_DIR + '/animals/added_file.txt')
         except:
             pass
 
+        try:
+            os.remove(self.TEST_DIR + '/.syncallignore')
+        except:
+            pass
+
     @patch("os.mkdir")
     def test_create_temp_dir(self, mkdir):
         directory = syncall.Directory(
@@ -79,6 +96,7 @@ class DirectoryIndexTests(unittest.TestCase):
     @patch("pyrsync2.blockchecksums")
     @patch("builtins.open")
     def test_get_block_checksums(self, open, blockchecksums):
+        self.directory.delta_engine = PythonDeltaEngine()
         blockchecksums.return_value = [1, 2, 3]
         hashes = self.directory.get_block_checksums('test', 1024)
 
@@ -102,6 +120,79 @@ class DirectoryIndexTests(unittest.TestCase):
 
         self.assertEqual(hashes, [1, 2, 3])
 
+    @patch("builtins.open")
+    def test_read_chunk(self, open):
+        self.assertIsNone(self.directory.read_chunk(chunk_id(b'1234')))
+
+        self.directory.chunk_index = Mock()
+        self.directory.chunk_index.find_chunk.return_value = [
+            ('test', 2, 4)
+        ]
+        open.return_value = BytesIO(b'001234')
+
+        self.assertEqual(
+            self.directory.read_chunk(chunk_id(b'1234')),
+            b'1234'
+        )
+        open.assert_called_with(self.directory.get_file_path('test'), 'rb')
+
+        # Changed since it was indexed
+        open.return_value = BytesIO(b'004321')
+
+        self.assertIsNone(self.directory.read_chunk(chunk_id(b'1234')))
+
+    @patch("builtins.open")
+    def test_read_block(self, open):
+        self.directory.checksum_cache = Mock()
+        self.directory.checksum_cache.find_block.return_value = [
+            ('other', 4), ('test', 2)
+        ]
+        open.side_effect = [BytesIO(b'00004321'), BytesIO(b'001234')]
+
+        self.assertEqual(
+            self.directory.read_block(hashlib.md5(b'1234').digest(), 4),
+            b'1234'
+        )
+        self.directory.checksum_cache.find_block.assert_called_once_with(
+            hashlib.md5(b'1234').digest(),
+            4
+        )
+
+    def test_index_updated_invalidates_changed_content(self):
+        self.directory.checksum_cache = Mock()
+        self.directory.chunk_index = Mock()
+        self.directory._index = {
+            'file1': {'last_update': 1, 'hash': b'1', 'size': 1},
+            'file2': {'last_update': 1, 'hash': b'2', 'size': 1}
+        }
+
+        with self.directory.fs_access_lock:
+            self.directory._put_index_unsafe('file1', {
+                'last_update': 2, 'hash': b'1', 'size': 1,
+                'sync_log': {'uuid': 2}
+            })
+            self.directory._put_index_unsafe('file2', {
+                'last_update': 2, 'hash': b'3', 'size': 1
+            })
+
+        # Detected without building the whole-index hash index
+        self.assertIsNone(self.directory._hash_index)
+
+        self.directory.index_updated.notify({'file1', 'file2'})
+
+        self.directory.checksum_cache.invalidate.assert_called_once_with(
+            {'file2'}
+        )
+        self.directory.chunk_index.invalidate.assert_called_once_with(
+            {'file2'}
+        )
+
+        self.directory.index_updated.notify({'file1'})
+        self.assertEqual(
+            self.directory.checksum_cache.invalidate.call_count,
+            1
+        )
+
     def test_get_index(self):
         self.directory._index = {
             'file': {
@@ -163,11 +254,34 @@ class DirectoryIndexTests(unittest.TestCase):
                 file_data['last_update']
             )
 
+    def test_load_index_journal(self):
+        directory = syncall.Directory('uuid', self.TEST_DIR)
+        directory.update_index(save_index=True)
+
+        index_size = os.path.getsize(self.TEST_DIR + '/.syncall_index')
+
+        with open(self.TEST_DIR + '/animals/added_file.txt', 'w') as file:
+            file.write('added')
+
+        directory.update_paths(['animals/added_file.txt'])
+
+        self.assertEqual(
+            os.path.getsize(self.TEST_DIR + '/.syncall_index'),
+            index_size
+        )
+
+        directory = syncall.Directory('uuid', self.TEST_DIR)
+
+        self.assertEqual(
+            directory._index['animals/added_file.txt']['hash'],
+            bintools.hash_file(self.TEST_DIR + '/animals/added_file.txt')
+        )
+        self.assertEqual(len(directory._index), len(self.TEST_FILES) + 1)
+
     def test_same_file(self):
         self.directory.update_index(save_index=True)
 
         readme_file = self.TEST_DIR + '/README.txt'
-        readme_file_data = self.directory._index['README.txt']
         old_last_update = self.directory._index['README.txt']['last_update']
 
         # Make sure modification times are different
@@ -179,6 +293,8 @@ class DirectoryIndexTests(unittest.TestCase):
         self.directory.uuid = 'uuid_new'
         self.directory.update_index(save_index=False)
 
+        readme_file_data = self.directory._index['README.txt']
+
         # File shouldn't be detected as changed if hashes are the same
         self.assertEqual(readme_file_data['last_update'], old_last_update)
         self.assertEqual(readme_file_data['last_update_location'], 'uuid')
@@ -196,6 +312,7 @@ class DirectoryIndexTests(unittest.TestCase):
         old_last_update = self.directory._index['README.txt']['last_update']
 
         readme_file_data['deleted'] = True
+        self.directory._index['README.txt'] = readme_file_data
 
         # Make sure modification times are different
         time.sleep(1)
@@ -206,6 +323,8 @@ class DirectoryIndexTests(unittest.TestCase):
         self.directory.uuid = 'uuid_new'
         self.directory.update_index(save_index=False)
 
+        readme_file_data = self.directory._index['README.txt']
+
         self.assertGreater(readme_file_data['last_update'], old_last_update)
         self.assertEqual(readme_file_data['last_update_location'], 'uuid_new')
         self.assertIn('uuid', readme_file_data['sync_log'])
@@ -214,6 +333,191 @@ class DirectoryIndexTests(unittest.TestCase):
             readme_file_data['last_update']
         )
 
+    def test_fingerprint(self):
+        self.directory.update_index(save_index=False)
+
+        for path in self.TEST_FILES:
+            stat = os.stat(self.TEST_DIR + '/' + path)
+            file_data = self.directory._index[path]
+
+            self.assertEqual(file_data['size'], stat.st_size)
+            self.assertEqual(file_data['inode'], stat.st_ino)
+            self.assertEqual(file_data['mtime_ns'], stat.st_mtime_ns)
+
+    @patch('bintools.hash_file')
+    def test_touched_file_hashed_once(self, hash_file):
+        hash_file.return_value = b'hash'
+        readme_file = self.TEST_DIR + '/README.txt'
+
+        self.directory.update_index(save_index=False)
+        hash_file.reset_mock()
+
+        stat = os.stat(readme_file)
+        os.utime(readme_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10))
+
+        self.directory.update_index(save_index=False)
+        hash_file.assert_called_once_with(readme_file, 'md5')
+
+        hash_file.reset_mock()
+        self.directory.update_index(save_index=False)
+        self.assertFalse(hash_file.called)
+
+    def test_same_second_modification(self):
+        added_file = self.TEST_DIR + '/animals/added_file.txt'
+
+        with open(added_file, 'w') as file:
+            file.write("version 1")
+
+        self.directory.update_index(save_index=False)
+        old_hash = self.directory._index['animals/added_file.txt']['hash']
+        stat = os.stat(added_file)
+
+        with open(added_file, 'w') as file:
+            file.write("version 2 with a different size")
+
+        # Keep the mtime in the same second as the last update
+        os.utime(added_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        self.directory.update_index(save_index=False)
+
+        self.assertNotEqual(
+            self.directory._index['animals/added_file.txt']['hash'],
+            old_hash
+        )
+
+    @patch('bintools.hash_file')
+    def test_legacy_index_migration(self, hash_file):
+        readme_file = self.TEST_DIR + '/README.txt'
+        self.directory._index['README.txt'] = {
+            'last_update': int(os.path.getmtime(readme_file)),
+            'last_update_location': 'uuid',
+            'hash': b'hash',
+            'sync_log': {'uuid': int(os.path.getmtime(readme_file))}
+        }
+        self.directory.index_updated = Mock()
+
+        with patch('syncall.scanner.scan_tree') as scan_tree:
+            scan_tree.return_value = [
+                ('README.txt', readme_file, os.stat(readme_file))
+            ]
+            self.directory.update_index(save_index=False)
+
+        self.assertFalse(hash_file.called)
+        self.assertFalse(self.directory.index_updated.notify.called)
+        self.assertEqual(
+            self.directory._index['README.txt']['mtime_ns'],
+            os.stat(readme_file).st_mtime_ns
+        )
+
+    def test_hash_algorithm(self):
+        directory = syncall.Directory(
+            'uuid',
+            self.TEST_DIR,
+            load_index=False,
+            hash_algorithm='blake2b'
+        )
+        directory.update_index(save_index=False)
+
+        for path in self.TEST_FILES:
+            file_data = directory._index[path]
+
+            self.assertEqual(file_data['hash_algorithm'], 'blake2b')
+            self.assertEqual(
+                file_data['hash'],
+                bintools.hash_file(self.TEST_DIR + '/' + path, 'blake2b')
+            )
+
+        self.assertEqual(directory.get_hash_algorithms(), ['blake2b', 'md5'])
+
+        with self.assertRaises(ValueError):
+            syncall.Directory('uuid', self.TEST_DIR, load_index=False,
+                              hash_algorithm='unknown')
+
+    def test_legacy_hashes(self):
+        readme_file = self.TEST_DIR + '/README.txt'
+
+        directory = syncall.Directory(
+            'uuid',
+            self.TEST_DIR,
+            load_index=False,
+            hash_algorithm='blake2b'
+        )
+        directory.update_index(save_index=False)
+
+        file_data = directory.get_index('README.txt')
+        self.assertEqual(
+            file_data['hashes'],
+            {'md5': bintools.hash_file(readme_file, 'md5')}
+        )
+
+        # Entries indexed without them get them on the next scan
+        file_data = syncall.index.copy_entry(file_data)
+        del file_data['hashes']
+        directory._index['README.txt'] = file_data
+
+        directory.update_index(save_index=False)
+        self.assertEqual(
+            directory.get_index('README.txt')['hashes'],
+            {'md5': bintools.hash_file(readme_file, 'md5')}
+        )
+
+        # Nothing to convert for md5 entries
+        self.directory.update_index(save_index=False)
+        self.assertNotIn('hashes', self.directory.get_index('README.txt'))
+
+        # Or without legacy peers
+        directory = syncall.Directory(
+            'uuid',
+            self.TEST_DIR,
+            load_index=False,
+            hash_algorithm='blake2b',
+            legacy_hashes=False
+        )
+        directory.update_index(save_index=False)
+        self.assertNotIn('hashes', directory.get_index('README.txt'))
+
+    def test_hash_algorithm_change(self):
+        readme_file = self.TEST_DIR + '/README.txt'
+
+        self.directory.update_index(save_index=False)
+        old_file_data = dict(self.directory._index['README.txt'])
+        self.assertEqual(old_file_data['hash_algorithm'], 'md5')
+
+        self.directory.hash_algorithm = 'blake2b'
+        self.directory.index_updated = Mock()
+
+        # Touched but not modified: compared using the entry's algorithm
+        stat = os.stat(readme_file)
+        os.utime(readme_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10))
+
+        self.directory.update_index(save_index=False)
+
+        file_data = self.directory._index['README.txt']
+        self.assertEqual(file_data['hash'], old_file_data['hash'])
+        self.assertEqual(file_data['hash_algorithm'], 'md5')
+        self.assertFalse(self.directory.index_updated.notify.called)
+
+    def test_modified_file_new_hash_algorithm(self):
+        added_file = self.TEST_DIR + '/animals/added_file.txt'
+
+        with open(added_file, 'w') as file:
+            file.write("version 1")
+
+        self.directory.update_index(save_index=False)
+        self.directory.hash_algorithm = 'blake2b'
+
+        with open(added_file, 'w') as file:
+            file.write("version 2 with a different size")
+
+        self.directory.update_index(save_index=False)
+
+        file_data = self.directory._index['animals/added_file.txt']
+        self.assertEqual(file_data['hash_algorithm'], 'blake2b')
+        self.assertEqual(
+            file_data['hash'],
+            bintools.hash_file(added_file, 'blake2b')
+        )
+
     def test_modified_file(self):
         added_file = self.TEST_DIR + '/animals/added_file.txt'
         readme_file = self.TEST_DIR + '/animals/README.txt'
@@ -240,6 +544,10 @@ class DirectoryIndexTests(unittest.TestCase):
         self.directory.uuid = 'uuid_new'
         self.directory.update_index(save_index=False)
 
+        # The entries are replaced, not changed in place
+        self.assertEqual(readme_file_data['last_update_location'], 'uuid')
+        readme_file_data = self.directory._index['animals/README.txt']
+
         self.assertEqual(readme_file_data['last_update_location'], 'uuid_new')
         self.assertGreater(readme_file_data['last_update'], old_last_update)
         self.assertIn('uuid_new', readme_file_data['sync_log'])
@@ -250,9 +558,57 @@ class DirectoryIndexTests(unittest.TestCase):
 
         self.assertIn('animals/added_file.txt', self.directory._index)
 
-    @patch('os.walk')
-    def test_deleted_file(self, walk):
-        walk.return_value = []
+    def write_file(self, file_path, content):
+        with open(file_path, 'w') as file:
+            file.write(content)
+
+    def test_update_without_index_lock(self):
+        readme_file = self.TEST_DIR + '/animals/README.txt'
+
+        self.directory.update_index(save_index=False)
+
+        with open(readme_file) as file:
+            readme_content = file.read()
+        with open(readme_file, 'w') as file:
+            file.write("changed during the update")
+        self.addCleanup(self.write_file, readme_file, readme_content)
+
+        transferred_data = {
+            'last_update': 1,
+            'last_update_location': 'remote',
+            'hash': b'',
+            'sync_log': {'remote': 1}
+        }
+        hash_file = bintools.hash_file
+
+        def hash_during_transfer(file_path, algorithm):
+            # The index isn't locked while the files are hashed
+            lock = self.directory.fs_access_lock
+            self.assertTrue(lock.acquire(blocking=False))
+
+            self.directory._put_index_unsafe(
+                'animals/README.txt',
+                transferred_data
+            )
+            lock.release()
+
+            return hash_file(file_path, algorithm)
+
+        with patch('bintools.hash_file',
+                   side_effect=hash_during_transfer) as hash_mock:
+            self.directory.update_index(save_index=False)
+
+        self.assertTrue(hash_mock.called)
+
+        # The entry changed during the update is kept
+        self.assertEqual(
+            self.directory._index['animals/README.txt'],
+            transferred_data
+        )
+
+    @patch('syncall.scanner.scan_tree')
+    def test_deleted_file(self, scan_tree):
+        scan_tree.return_value = []
 
         self.directory._index['animals/README.txt'] = {
             'last_update': 123,
@@ -279,10 +635,218 @@ class DirectoryIndexTests(unittest.TestCase):
             readme_file_data['last_update']
         )
 
+    def test_update_paths(self):
+        added_file = self.TEST_DIR + '/animals/added_file.txt'
+
+        self.directory.update_index(save_index=False)
+        self.directory.index_updated = Mock()
+
+        with open(added_file, 'w') as file:
+            file.write("added file content")
+
+        changes = self.directory.update_paths(
+            ['animals/added_file.txt', 'README.txt'],
+            save_index=False
+        )
+
+        self.assertEqual(changes, {'animals/added_file.txt'})
+        self.assertIn('animals/added_file.txt', self.directory._index)
+        self.directory.index_updated.notify.assert_called_once_with(
+            {'animals/added_file.txt'}
+        )
+
+    def test_update_paths_detects_rename(self):
+        self.directory.update_index(save_index=False)
+
+        with open(self.TEST_DIR + '/animals/README.txt', 'rb') as file:
+            content = file.read()
+        with open(self.TEST_DIR + '/animals/added_file.txt', 'wb') as file:
+            file.write(content)
+
+        isfile = os.path.isfile
+
+        def renamed_isfile(path):
+            return isfile(path) and not path.endswith('animals/README.txt')
+
+        with patch('os.path.isfile', side_effect=renamed_isfile):
+            self.directory.update_paths(
+                ['animals/README.txt', 'animals/added_file.txt'],
+                save_index=False
+            )
+
+        self.assertEqual(
+            self.directory.get_rename_source('animals/added_file.txt'),
+            'animals/README.txt'
+        )
+        self.assertIsNone(self.directory.get_rename_source('README.txt'))
+        self.assertEqual(
+            self.directory.find_files(
+                self.directory._index['animals/added_file.txt']
+            ),
+            {'animals/added_file.txt'}
+        )
+
+        # The renamed file is changed
+        with open(self.TEST_DIR + '/animals/added_file.txt', 'ab') as file:
+            file.write(b'changed')
+
+        self.directory.update_paths(['animals/added_file.txt'],
+                                    save_index=False)
+
+        self.assertIsNone(
+            self.directory.get_rename_source('animals/added_file.txt')
+        )
+
+    def test_find_local_copy(self):
+        self.directory.update_index(save_index=False)
+        file_data = self.directory.get_index('animals/README.txt')
+
+        self.assertEqual(
+            self.directory.find_local_copy(file_data),
+            'animals/README.txt'
+        )
+
+        # The file changed after it was indexed
+        path = self.TEST_DIR + '/animals/README.txt'
+        atime_ns = os.stat(path).st_atime_ns
+        os.utime(path, ns=(atime_ns, file_data['mtime_ns'] + 10 ** 9))
+
+        try:
+            self.assertIsNone(self.directory.find_local_copy(file_data))
+        finally:
+            os.utime(path, ns=(atime_ns, file_data['mtime_ns']))
+
+        self.assertIsNone(self.directory.find_local_copy({
+            'hash': b'unknown',
+            'size': 1
+        }))
+
+    def test_update_paths_deleted_directory(self):
+        self.directory.update_index(save_index=False)
+        self.directory.uuid = 'uuid_new'
+
+        with patch('os.path.isfile', return_value=False), \
+                patch('os.path.isdir', return_value=False):
+            changes = self.directory.update_paths(
+                ['animals'],
+                save_index=False
+            )
+
+        self.assertEqual(changes, {
+            'animals/README.txt',
+            'animals/cat.jpg',
+            'animals/dogs/dog.jpg'
+        })
+
+        for path in changes:
+            file_data = self.directory._index[path]
+
+            self.assertTrue(file_data['deleted'])
+            self.assertEqual(file_data['last_update_location'], 'uuid_new')
+
+        self.assertNotIn('deleted', self.directory._index['README.txt'])
+
+    def test_ignore_file(self):
+        self.directory.update_index(save_index=False)
+
+        with open(self.TEST_DIR + '/.syncallignore', 'w') as ignore_file:
+            ignore_file.write('dogs/\n*.jpg\n!cat.jpg\n')
+
+        with patch('syncall.scanner.os.scandir', wraps=os.scandir) as scandir:
+            self.directory.update_index(save_index=False)
+
+        scanned = {
+            os.path.basename(call[0][0]) for call in scandir.call_args_list
+        }
+        self.assertNotIn('dogs', scanned)
+
+        self.assertIn('.syncallignore', self.directory._index)
+        self.assertNotIn('deleted', self.directory._index['animals/cat.jpg'])
+
+        # Files indexed before they were ignored are marked as deleted,
+        # but kept
+        self.assertTrue(
+            self.directory._index['animals/dogs/dog.jpg']['deleted']
+        )
+        self.assertTrue(
+            os.path.isfile(self.TEST_DIR + '/animals/dogs/dog.jpg')
+        )
+
+        self.assertTrue(self.directory.is_ignored('animals/dogs', True))
+        self.assertTrue(self.directory.is_ignored('image.jpg'))
+        self.assertFalse(self.directory.is_ignored('animals/cat.jpg'))
+
+    def test_sqlite_index_backend(self):
+        directory = syncall.Directory(
+            'uuid',
+            self.TEST_DIR,
+            index_backend='sqlite'
+        )
+        directory.update_index(save_index=True)
+
+        with patch('os.path.isfile', return_value=False), \
+                patch('os.path.isdir', return_value=False):
+            directory.update_paths(['animals/dogs'])
+
+        # The snapshots of the updates were closed
+        self.assertEqual(len(directory.get_index()._idle_connections), 1)
+
+        index = dict(directory.get_index())
+        directory.get_index().close()
+
+        directory = syncall.Directory(
+            'uuid',
+            self.TEST_DIR,
+            index_backend='sqlite'
+        )
+
+        self.assertEqual(dict(directory.get_index()), index)
+        self.assertEqual(set(index), set(self.TEST_FILES))
+        self.assertTrue(index['animals/dogs/dog.jpg']['deleted'])
+        self.assertNotIn('deleted', index['animals/cat.jpg'])
+
+        directory.get_index().close()
+
+    def test_unsupported_index_backend(self):
+        with self.assertRaises(ValueError):
+            syncall.Directory(
+                'uuid',
+                self.TEST_DIR,
+                load_index=False,
+                index_backend='unknown'
+            )
+
+    def test_update_paths_ignored(self):
+        self.directory.index_updated = Mock()
+
+        changes = self.directory.update_paths(['.syncall_index'])
+
+        self.assertEqual(changes, set())
+        self.assertFalse(self.directory.index_updated.notify.called)
+
+    def test_update_paths_newly_ignored(self):
+        self.directory.update_index(save_index=False)
+        self.directory.index_updated = Mock()
+
+        with open(self.TEST_DIR + '/.syncallignore', 'w') as ignore_file:
+            ignore_file.write('dogs/\n')
+
+        changes = self.directory.update_paths(['animals/dogs'])
+
+        self.assertEqual(changes, {'animals/dogs/dog.jpg'})
+        self.assertTrue(
+            self.directory._index['animals/dogs/dog.jpg']['deleted']
+        )
+        self.assertNotIn('deleted', self.directory._index['animals/cat.jpg'])
+        self.directory.index_updated.notify.assert_called_once_with(changes)
+
     def test_finalize_transfer_to_remote(self):
         transfer = Mock()
         transfer.type = syncall.transfers.FileTransfer.TO_REMOTE
         transfer.file_name = 'file1'
+        transfer.rename_from = None
+        transfer.metadata_only = False
+        transfer.verified_hash = None
         transfer.get_remote_uuid.return_value = 'uuid2'
         transfer.timestamp = 1250
 
@@ -321,6 +885,9 @@ class DirectoryIndexTests(unittest.TestCase):
         transfer = Mock()
         transfer.type = syncall.transfers.FileTransfer.FROM_REMOTE
         transfer.file_name = 'file1'
+        transfer.rename_from = None
+        transfer.metadata_only = False
+        transfer.verified_hash = None
         transfer.messanger.my_uuid = 'uuid2'
         transfer.timestamp = 1250
         transfer.get_temp_path.return_value = '/temp/file1'
@@ -365,6 +932,9 @@ class DirectoryIndexTests(unittest.TestCase):
         transfer = Mock()
         transfer.type = syncall.transfers.FileTransfer.FROM_REMOTE
         transfer.file_name = 'file1'
+        transfer.rename_from = None
+        transfer.metadata_only = False
+        transfer.verified_hash = None
         transfer.messanger.my_uuid = 'uuid2'
         transfer.timestamp = 1250
         transfer.get_temp_path.return_value = '/temp/file1'
@@ -407,11 +977,293 @@ class DirectoryIndexTests(unittest.TestCase):
         )
         self.assertTrue(self.directory.save_index.called)
 
+    def rename_transfer(self):
+        """
+        Return a transfer of file2, which is renamed from the indexed
+        animals/added_file.txt.
+        """
+        file_path = self.TEST_DIR + '/animals/added_file.txt'
+        with open(file_path, 'wb') as file:
+            file.write(b'renamed')
+
+        self.directory._index['animals/added_file.txt'] = dict(
+            syncall.scanner.get_fingerprint(os.stat(file_path)),
+            hash=b'1',
+            last_update=1200,
+            sync_log={'uuid1': 1200}
+        )
+
+        transfer = Mock()
+        transfer.type = syncall.transfers.FileTransfer.FROM_REMOTE
+        transfer.file_name = 'file2'
+        transfer.rename_from = 'animals/added_file.txt'
+        transfer.metadata_only = False
+        transfer.verified_hash = None
+        transfer.messanger.my_uuid = 'uuid2'
+        transfer.timestamp = 1250
+        transfer.remote_file_data = {
+            'last_update': 1234,
+            'hash': b'1',
+            'size': 7,
+            'sync_log': {'uuid1': 1234}
+        }
+        transfer.rename_data = {
+            'last_update': 1234,
+            'deleted': True,
+            'sync_log': {'uuid1': 1234}
+        }
+
+        self.directory.save_index = Mock()
+        self.directory.index_updated = Mock()
+
+        return transfer
+
+    @patch('os.makedirs')
+    @patch('os.rename')
+    @patch('shutil.move')
+    @patch('syncall.index.IndexDiff.compare_file')
+    def test_finalize_transfer_from_remote_rename(self, compare_file, move,
+                                                  rename, makedirs):
+        transfer = self.rename_transfer()
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+
+        self.directory.finalize_transfer(transfer)
+
+        self.assertFalse(move.called)
+        rename.assert_called_once_with(
+            self.directory.get_file_path('animals/added_file.txt'),
+            self.directory.get_file_path('file2')
+        )
+        self.assertEqual(self.directory._index['file2']['sync_log'], {
+            'uuid1': 1234,
+            'uuid2': 1250
+        })
+        old_data = self.directory._index['animals/added_file.txt']
+        self.assertTrue(old_data['deleted'])
+        self.assertEqual(old_data['sync_log'], {
+            'uuid1': 1234,
+            'uuid2': 1250
+        })
+        self.directory.index_updated.notify.assert_called_once_with(
+            {'animals/added_file.txt', 'file2'}
+        )
+
+    @patch('os.makedirs')
+    @patch('os.rename')
+    @patch('shutil.move')
+    @patch('syncall.index.IndexDiff.compare_file')
+    def test_finalize_transfer_from_remote_rename_changed(self, compare_file,
+                                                          move, rename,
+                                                          makedirs):
+        transfer = self.rename_transfer()
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+
+        # The file is changed after the rename was accepted
+        with open(self.TEST_DIR + '/animals/added_file.txt', 'ab') as file:
+            file.write(b' and changed')
+
+        self.directory.finalize_transfer(transfer)
+
+        self.assertFalse(rename.called)
+        self.assertFalse(move.called)
+        self.assertNotIn('file2', self.directory._index)
+        self.assertNotIn(
+            'deleted',
+            self.directory._index['animals/added_file.txt']
+        )
+        self.assertFalse(self.directory.index_updated.notify.called)
+
+    def finalize_received_file(self):
+        temp_path = self.TEST_DIR + '/animals/added_file.txt.temp'
+        with open(temp_path, 'wb') as file:
+            file.write(b'received')
+
+        transfer = Mock()
+        transfer.type = syncall.transfers.FileTransfer.FROM_REMOTE
+        transfer.file_name = 'animals/added_file.txt'
+        transfer.rename_from = None
+        transfer.metadata_only = False
+        transfer.verified_hash = hashlib.md5(b'received').digest()
+        transfer.messanger.my_uuid = 'uuid'
+        transfer.timestamp = 1250
+        transfer.get_temp_path.return_value = temp_path
+        transfer.remote_file_data = {
+            'last_update': 1234,
+            'last_update_location': 'uuid1',
+            'hash': hashlib.md5(b'received').digest(),
+            'hash_algorithm': 'md5',
+            'size': 8,
+            'inode': 1,
+            'mtime_ns': 1234 * 10 ** 9,
+            'sync_log': {'uuid1': 1234}
+        }
+
+        self.directory.save_index = Mock()
+        self.directory.finalize_transfer(transfer)
+
+        return self.directory.get_index('animals/added_file.txt')
+
+    def test_finalize_transfer_from_remote_fingerprint(self):
+        self.directory.update_index(save_index=False)
+
+        file_data = self.finalize_received_file()
+        stat = os.stat(self.TEST_DIR + '/animals/added_file.txt')
+
+        self.assertTrue(syncall.scanner.fingerprint_matches(file_data, stat))
+        self.assertNotEqual(stat.st_mtime_ns, 1234 * 10 ** 9)
+        self.assertEqual(file_data['hash'], hashlib.md5(b'received').digest())
+
+        # The received file isn't hashed again
+        with patch('bintools.hash_file') as hash_file:
+            self.directory.update_index(save_index=False)
+
+        self.assertFalse(hash_file.called)
+
+    def test_finalize_transfer_from_remote_preserve_mtime(self):
+        self.directory.preserve_mtime = True
+
+        file_data = self.finalize_received_file()
+        stat = os.stat(self.TEST_DIR + '/animals/added_file.txt')
+
+        self.assertEqual(stat.st_mtime_ns, 1234 * 10 ** 9)
+        self.assertTrue(syncall.scanner.fingerprint_matches(file_data, stat))
+
+    def test_finalize_transfer_metadata_only_to_remote(self):
+        transfer = Mock()
+        transfer.type = syncall.transfers.FileTransfer.TO_REMOTE
+        transfer.file_name = 'file1'
+        transfer.rename_from = None
+        transfer.metadata_only = True
+        transfer.sync_log = {'uuid1': 1200, 'uuid2': 1100}
+        transfer.get_remote_uuid.return_value = 'uuid2'
+        transfer.timestamp = 1250
+
+        self.directory.save_index = Mock()
+        self.directory.index_updated = Mock()
+        self.directory._index['file1'] = {
+            'last_update': 1234,
+            'sync_log': {
+                'my_uuid': 1234,
+                'uuid1': 1000
+            }
+        }
+
+        self.directory.finalize_transfer(transfer)
+
+        self.assertEqual(self.directory._index['file1']['sync_log'], {
+            'my_uuid': 1234,
+            'uuid1': 1200,
+            'uuid2': 1250
+        })
+
+    @patch('shutil.move')
+    @patch('syncall.index.IndexDiff.compare_file')
+    def test_finalize_transfer_metadata_only_from_remote(self, compare_file,
+                                                         move):
+        transfer = Mock()
+        transfer.type = syncall.transfers.FileTransfer.FROM_REMOTE
+        transfer.file_name = 'file1'
+        transfer.rename_from = None
+        transfer.metadata_only = True
+        transfer.messanger.my_uuid = 'my_uuid'
+        transfer.timestamp = 1250
+        transfer.remote_file_data = {
+            'last_update': 1300,
+            'last_update_location': 'uuid2',
+            'sync_log': {
+                'uuid1': 1200,
+                'uuid2': 1300
+            }
+        }
+
+        compare_file.return_value = syncall.index.SAME_CONTENT
+
+        self.directory.save_index = Mock()
+        self.directory.index_updated = Mock()
+        self.directory._index['file1'] = {
+            'last_update': 1234,
+            'last_update_location': 'my_uuid',
+            'inode': 5,
+            'sync_log': {
+                'my_uuid': 1234,
+                'uuid1': 1000
+            }
+        }
+
+        self.directory.finalize_transfer(transfer)
+
+        # The remote entry with the local fingerprint
+        self.assertFalse(move.called)
+        self.assertEqual(self.directory._index['file1'], {
+            'last_update': 1300,
+            'last_update_location': 'uuid2',
+            'inode': 5,
+            'sync_log': {
+                'my_uuid': 1250,
+                'uuid1': 1200,
+                'uuid2': 1300
+            }
+        })
+        self.directory.index_updated.notify.assert_called_once_with(
+            {'file1'}
+        )
+
+    @patch('logging.Logger')
+    def test_metadata_only_sync_merkle_roots(self, Logger):
+        sender = syncall.Directory('A', 'dummy_dir', load_index=False)
+        receiver = syncall.Directory('B', 'dummy_dir', load_index=False)
+
+        for directory in (sender, receiver):
+            directory.save_index = Mock()
+            directory._index['file1'] = {
+                'last_update': 10 if directory is sender else 5,
+                'last_update_location': directory.uuid,
+                'hash': b'1',
+                'size': 10,
+                'sync_log': {directory.uuid: 10 if directory is sender else 5}
+            }
+
+        messanger = MagicMock()
+        messanger.my_uuid = 'B'
+        messanger.remote_uuid = 'A'
+        messanger.address = ('127.0.0.1', 0)
+
+        receiving = syncall.transfers.FileTransfer(receiver, messanger)
+        receiving.transfer_completed += receiver.finalize_transfer
+        receiving._FileTransfer__accept_file(
+            'file1',
+            sender.get_index('file1')
+        )
+        done_data = messanger.send.call_args[0][0]
+
+        sending = Mock()
+        sending.type = syncall.transfers.FileTransfer.TO_REMOTE
+        sending.file_name = 'file1'
+        sending.rename_from = None
+        sending.metadata_only = True
+        sending.sync_log = done_data['sync_log']
+        sending.timestamp = done_data['time']
+        sending.get_remote_uuid.return_value = 'B'
+        sender.finalize_transfer(sending)
+
+        self.assertTrue(receiving.metadata_only)
+        self.assertEqual(sender.get_merkle_root(), receiver.get_merkle_root())
+        self.assertEqual(
+            syncall.IndexDiff.compare_file(
+                sender.get_index('file1'),
+                receiver.get_index('file1')
+            ),
+            syncall.index.NOT_MODIFIED
+        )
+
     @patch('syncall.index.IndexDiff.compare_file')
     def test_finalize_transfer_from_remote_old(self, compare_file):
         transfer = Mock()
         transfer.type = syncall.transfers.FileTransfer.FROM_REMOTE
         transfer.file_name = 'file1'
+        transfer.rename_from = None
+        transfer.metadata_only = False
+        transfer.verified_hash = None
 
         compare_file.return_value = syncall.index.CONFLICT
 
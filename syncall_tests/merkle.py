@@ -0,0 +1,458 @@
+import unittest
+import os
+import collections
+import tempfile
+import threading
+import msgpack
+
+from unittest.mock import Mock, patch
+
+import bintools
+import syncall
+
+from events import Event
+from syncall.merkle import MerkleTree, IndexMerkleTree, MerkleWalk, \
+    hash_entry
+from syncall.index_store import SQLiteIndexStore
+from syncall.index_entry import msgpack_default
+
+
+def create_entry(last_update, location='uuid1', content=b'content'):
+    return {
+        'last_update': last_update,
+        'last_update_location': location,
+        'hash': bintools.new_hash('md5').digest() + content,
+        'sync_log': {location: last_update}
+    }
+
+
+class MerkleTreeTests(unittest.TestCase):
+    def test_hash_entry(self):
+        entry = create_entry(5)
+
+        self.assertEqual(hash_entry(entry), hash_entry(dict(
+            entry,
+            last_update=5.0,
+            size=10,
+            inode=20,
+            mtime_ns=30
+        )))
+        self.assertNotEqual(hash_entry(entry), hash_entry(create_entry(6)))
+        self.assertNotEqual(
+            hash_entry(entry),
+            hash_entry(dict(entry, deleted=True))
+        )
+        self.assertNotEqual(
+            hash_entry(entry),
+            hash_entry(dict(entry, sync_log={'uuid1': 5, 'uuid2': 6}))
+        )
+
+    def test_root_hash(self):
+        index = {
+            'a': create_entry(1),
+            'dir/b': create_entry(2),
+            'dir/sub/c': create_entry(3)
+        }
+
+        tree = MerkleTree.build(index.items())
+        same_tree = MerkleTree.build(reversed(list(index.items())))
+
+        self.assertEqual(tree.get_hash(), same_tree.get_hash())
+        self.assertEqual(tree.get_hash('dir'), same_tree.get_hash('dir'))
+        self.assertIsNone(tree.get_hash('missing'))
+
+        root = tree.get_hash()
+        sub_hash = tree.get_hash('dir/sub')
+
+        tree.update('dir/b', create_entry(4))
+
+        self.assertNotEqual(tree.get_hash(), root)
+        self.assertEqual(tree.get_hash('dir/sub'), sub_hash)
+
+        tree.update('dir/b', create_entry(2))
+        self.assertEqual(tree.get_hash(), root)
+
+    def test_remove(self):
+        tree = MerkleTree.build([('a', create_entry(1))])
+        root = tree.get_hash()
+
+        tree.update('dir/sub/c', create_entry(3))
+        self.assertEqual(set(tree.get_children('')), {'a', 'dir'})
+
+        tree.update('dir/sub/c', None)
+        tree.update('not/existing', None)
+
+        self.assertEqual(tree.get_hash(), root)
+        self.assertEqual(set(tree.nodes), {''})
+
+    def test_get_children(self):
+        tree = MerkleTree.build([
+            ('a', create_entry(1)),
+            ('dir/b', create_entry(2))
+        ])
+
+        self.assertEqual(tree.get_children(''), {
+            'a': [False, hash_entry(create_entry(1))],
+            'dir': [True, tree.get_hash('dir')]
+        })
+        self.assertEqual(tree.get_children('missing'), {})
+
+    def test_snapshot(self):
+        tree = MerkleTree.build([
+            ('a', create_entry(1)),
+            ('dir/b', create_entry(2)),
+            ('other/c', create_entry(3))
+        ])
+        root = tree.get_hash()
+        children = tree.get_children('')
+
+        snapshot = tree.snapshot()
+
+        tree.update('dir/b', create_entry(4))
+        tree.update('other/c', None)
+        tree.update('new/d', create_entry(5))
+
+        self.assertEqual(snapshot.get_hash(), root)
+        self.assertEqual(snapshot.get_children(''), children)
+        self.assertEqual(
+            set(snapshot.file_names('')),
+            {'a', 'dir/b', 'other/c'}
+        )
+        self.assertEqual(set(tree.file_names('')), {'a', 'dir/b', 'new/d'})
+        self.assertEqual(tree.get_hash(), MerkleTree.build([
+            ('a', create_entry(1)),
+            ('dir/b', create_entry(4)),
+            ('new/d', create_entry(5))
+        ]).get_hash())
+
+
+class IndexMerkleTreeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = SQLiteIndexStore(
+            os.path.join(self.temp_dir.name, '.syncall_index'),
+            threading.Lock()
+        )
+        self.store.load()
+
+    def tearDown(self):
+        self.store.close()
+        self.temp_dir.cleanup()
+
+    def put(self, tree, file_name, file_data):
+        if file_data is None:
+            del self.store[file_name]
+        else:
+            self.store[file_name] = file_data
+
+        tree.update(file_name, file_data)
+
+    def test_same_hashes(self):
+        index = {
+            'a': create_entry(1),
+            'dir/b': create_entry(2),
+            'dir/sub/c': create_entry(3),
+            'dir.txt': create_entry(4)
+        }
+
+        for file_name, file_data in index.items():
+            self.store[file_name] = file_data
+
+        tree = IndexMerkleTree.build(self.store)
+        memory_tree = MerkleTree.build(index.items())
+
+        self.assertEqual(tree.get_hash(), memory_tree.get_hash())
+        self.assertEqual(tree.get_children(''), memory_tree.get_children(''))
+        self.assertEqual(
+            tree.get_children('dir'),
+            memory_tree.get_children('dir')
+        )
+        self.assertEqual(set(tree.file_names('dir')), {'dir/b', 'dir/sub/c'})
+        self.assertEqual(set(tree.file_names('')), set(index))
+
+        self.put(tree, 'dir/sub/c', create_entry(5))
+        memory_tree.update('dir/sub/c', create_entry(5))
+        self.assertEqual(tree.get_hash(), memory_tree.get_hash())
+
+        self.put(tree, 'new/d', create_entry(6))
+        memory_tree.update('new/d', create_entry(6))
+        self.assertEqual(tree.get_hash(), memory_tree.get_hash())
+
+        self.put(tree, 'new/d', None)
+        memory_tree.update('new/d', None)
+        self.assertEqual(tree.get_hash(), memory_tree.get_hash())
+        self.assertNotIn('new', tree.nodes)
+
+    def test_snapshot(self):
+        self.store['a'] = create_entry(1)
+        self.store['dir/b'] = create_entry(2)
+
+        tree = IndexMerkleTree.build(self.store)
+        root = tree.get_hash()
+
+        index = self.store.snapshot()
+        snapshot = tree.snapshot(index)
+
+        self.put(tree, 'dir/b', create_entry(3))
+        self.store.save()
+
+        self.assertNotEqual(tree.get_hash(), root)
+        self.assertEqual(snapshot.get_hash(), root)
+        self.assertEqual(
+            snapshot.get_children('dir'),
+            {'b': [False, hash_entry(create_entry(2))]}
+        )
+
+        index.close()
+
+
+class MerkleWalkTests(unittest.TestCase):
+    def test_nodes_received(self):
+        local = MerkleTree.build([
+            ('same', create_entry(1)),
+            ('changed', create_entry(1)),
+            ('local_only', create_entry(1)),
+            ('local_dir/a', create_entry(1)),
+            ('dir/a', create_entry(1))
+        ])
+        remote = MerkleTree.build([
+            ('same', create_entry(1)),
+            ('changed', create_entry(2)),
+            ('remote_only', create_entry(2)),
+            ('dir/a', create_entry(2))
+        ])
+
+        local_index = {
+            'same': create_entry(1),
+            'changed': create_entry(1),
+            'local_only': create_entry(1),
+            'local_dir/a': create_entry(1),
+            'dir/a': create_entry(1)
+        }
+        walk = MerkleWalk(1, local_index, local.snapshot())
+
+        dirs, files = walk.nodes_received(
+            {'': remote.get_children('')},
+            {}
+        )
+
+        self.assertEqual(dirs, ['dir'])
+        self.assertEqual(set(files), {'changed', 'remote_only'})
+        self.assertEqual(set(walk.index), {'same', 'changed', 'dir/a'})
+        self.assertEqual(len(local_index), 5)
+        self.assertEqual(
+            walk.changed,
+            {'changed', 'remote_only', 'local_only', 'local_dir/a'}
+        )
+
+
+class PairedMessanger:
+    """ Messanger passing packets to another one through a queue """
+
+    def __init__(self, my_uuid, remote_uuid):
+        self.address = ('127.0.0.1', 0)
+        self.my_uuid = my_uuid
+        self.remote_uuid = remote_uuid
+
+        self.disconnected = Event()
+        self.packet_received = Event()
+
+        self.remote = None
+        self.queue = collections.deque()
+        self.sent_bytes = 0
+        self.sent_types = []
+
+    def start_receiving(self):
+        pass
+
+    def send(self, data):
+        packet = msgpack.packb(data, default=msgpack_default)
+
+        self.sent_bytes += len(packet)
+        self.sent_types.append(data['type'])
+        self.remote.queue.append(bintools.decode_object(
+            msgpack.unpackb(packet),
+            except_keys=('hash', 'binary_data', 'checksums')
+        ))
+
+    @staticmethod
+    def connect(messanger1, messanger2):
+        messanger1.remote = messanger2
+        messanger2.remote = messanger1
+
+    @staticmethod
+    def deliver_all(*messangers):
+        while any(messanger.queue for messanger in messangers):
+            for messanger in messangers:
+                while messanger.queue:
+                    messanger.packet_received.notify(messanger.queue.popleft())
+
+
+class MerkleExchangeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dirs = []
+
+    def tearDown(self):
+        for temp_dir in self.temp_dirs:
+            temp_dir.cleanup()
+
+    def create_remote(self, uuid, remote_uuid, index,
+                      index_backend='journal'):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dirs.append(temp_dir)
+
+        directory = syncall.Directory(uuid, temp_dir.name,
+                                      index_backend=index_backend)
+        directory.transfer_manager = Mock()
+
+        for file_name, file_data in index.items():
+            directory._index[file_name] = file_data
+
+        return syncall.RemoteStore(
+            PairedMessanger(uuid, remote_uuid),
+            directory
+        )
+
+    def exchange(self, index1, index2, index_backend='journal'):
+        remote1 = self.create_remote('uuid1', 'uuid2', index1, index_backend)
+        remote2 = self.create_remote('uuid2', 'uuid1', index2)
+
+        PairedMessanger.connect(remote1.messanger, remote2.messanger)
+
+        remote1.start_receiving()
+        remote2.start_receiving()
+        PairedMessanger.deliver_all(remote1.messanger, remote2.messanger)
+
+        return (remote1, remote2)
+
+    def test_same_index(self):
+        index = {
+            'a': create_entry(1),
+            'dir/b': create_entry(2)
+        }
+
+        remote1, remote2 = self.exchange(index, index)
+
+        self.assertEqual(remote1.remote_index, index)
+        self.assertEqual(remote2.remote_index, index)
+        self.assertNotIn(
+            syncall.remote_store.MSG_MERKLE_REQUEST,
+            remote1.messanger.sent_types
+        )
+
+    def test_different_index(self):
+        index1 = {
+            'a': create_entry(1),
+            'dir/b': create_entry(2),
+            'dir/sub/c': create_entry(3),
+            'only1/d': create_entry(4)
+        }
+        index2 = {
+            'a': create_entry(1),
+            'dir/b': dict(
+                create_entry(5, 'uuid2', b'changed'),
+                sync_log={'uuid1': 2, 'uuid2': 5}
+            ),
+            'dir/sub/c': create_entry(3),
+            'only2': create_entry(6, 'uuid2')
+        }
+
+        remote1, remote2 = self.exchange(index1, index2)
+
+        self.assertEqual(remote1.remote_index, index2)
+        self.assertEqual(remote2.remote_index, index1)
+
+        remote1.directory.transfer_manager.sync_files.assert_any_call(
+            remote1,
+            {'only1/d'}
+        )
+        remote2.directory.transfer_manager.sync_files.assert_any_call(
+            remote2,
+            {'dir/b', 'only2'}
+        )
+
+    def test_different_index_sqlite(self):
+        index1 = {
+            'a': create_entry(1),
+            'dir/b': create_entry(2),
+            'dir/sub/c': create_entry(3)
+        }
+        index2 = dict(index1, **{'dir/sub/c': dict(
+            create_entry(4, 'uuid2', b'changed'),
+            sync_log={'uuid1': 3, 'uuid2': 4}
+        )})
+
+        with patch.object(syncall.Directory, 'diff') as diff:
+            remote1, remote2 = self.exchange(index1, index2, 'sqlite')
+
+        self.assertEqual(remote1.remote_index, index2)
+        self.assertEqual(remote2.remote_index, index1)
+
+        # Only the files the walks found to differ were compared
+        self.assertFalse(diff.called)
+        remote2.directory.transfer_manager.sync_files.assert_any_call(
+            remote2,
+            {'dir/sub/c'}
+        )
+
+        # The remote index is based on a snapshot of the local one
+        store = remote1.directory._index
+        self.assertEqual(store._idle_connections, [])
+
+        remote1.messanger.disconnected.notify(False)
+        self.assertIsNone(remote1.remote_index)
+        self.assertEqual(len(store._idle_connections), 1)
+
+        store.close()
+
+    def test_updated_index(self):
+        index = {
+            'a': create_entry(1),
+            'dir/b': create_entry(2)
+        }
+
+        remote1, remote2 = self.exchange(index, index)
+
+        remote1.directory._put_index_unsafe('dir/b', create_entry(3))
+        remote1.directory.last_update += 1
+
+        remote1.send_index(request=False)
+        PairedMessanger.deliver_all(remote1.messanger, remote2.messanger)
+
+        self.assertEqual(
+            remote2.remote_index,
+            dict(index, **{'dir/b': create_entry(3)})
+        )
+
+    def test_index_changed_during_walk(self):
+        index1 = {
+            'a': create_entry(1),
+            'dir/b': create_entry(2)
+        }
+        index2 = {
+            'a': create_entry(1),
+            'dir/b': create_entry(4)
+        }
+
+        remote1 = self.create_remote('uuid1', 'uuid2', index1)
+        remote2 = self.create_remote('uuid2', 'uuid1', index2)
+        PairedMessanger.connect(remote1.messanger, remote2.messanger)
+
+        remote1.start_receiving()
+        remote2.start_receiving()
+
+        # Deliver the hellos and roots, which start the walks
+        for i in range(2):
+            PairedMessanger.deliver_all(remote1.messanger)
+            PairedMessanger.deliver_all(remote2.messanger)
+
+        self.assertIsNotNone(remote1.merkle_walk)
+
+        # The local entry changed to the remote's one after the walk
+        # started, it must not be taken from the index before the change
+        remote1.directory._put_index_unsafe('dir/b', create_entry(4))
+
+        PairedMessanger.deliver_all(remote1.messanger, remote2.messanger)
+
+        self.assertIsNone(remote1.merkle_walk)
+        self.assertEqual(remote1.remote_index, index2)
@@ -1,7 +1,10 @@
 import unittest
 import msgpack
+import socket
+import tempfile
 import uuid
 
+from io import BytesIO
 from unittest.mock import Mock, MagicMock, patch
 
 import syncall
@@ -182,12 +185,12 @@ class MessangerTests(unittest.TestCase):
 
         self.messanger.send(packet)
 
-        self.messanger.socket.send.assert_called_with(
+        self.messanger.socket.sendall.assert_called_with(
             msgpack.packb(packet)
         )
 
     def test_send_error(self):
-        self.messanger.socket.send.side_effect = Exception("test")
+        self.messanger.socket.sendall.side_effect = Exception("test")
         self.messanger.disconnect = Mock()
 
         self.messanger.send({'test': 'test'})
@@ -195,6 +198,112 @@ class MessangerTests(unittest.TestCase):
         self.assertTrue(self.messanger.disconnect.called)
         self.assertTrue(self.messanger.logger.error.called)
 
+    def test_raw_data_received(self):
+        raw_file = BytesIO()
+
+        def packet_received_handler(data):
+            if data['type'] == 'raw':
+                self.messanger.receive_raw(raw_file, data['size'])
+
+        self.messanger.packet_received += packet_received_handler
+
+        stream = msgpack.packb({'type': 'raw', 'size': 10}) + \
+            b'0123456789' + msgpack.packb({'type': 'done'})
+
+        self.messanger.socket.recv.side_effect = [
+            stream[:3],
+            stream[3:20],
+            stream[20:22],
+            stream[22:],
+            b''
+        ]
+
+        self.messanger.start_receiving()
+        self.messanger.join()
+
+        self.assertEqual(raw_file.getvalue(), b'0123456789')
+        self.assertEqual(self.packet_received_calls, [
+            {'type': 'raw', 'size': 10},
+            {'type': 'done'}
+        ])
+
+    def test_raw_data_write_error(self):
+        raw_file = Mock()
+        raw_file.write.side_effect = OSError()
+
+        def packet_received_handler(data):
+            if data['type'] == 'raw':
+                self.messanger.receive_raw(raw_file, data['size'])
+
+        self.messanger.packet_received += packet_received_handler
+        self.messanger.disconnect = Mock()
+
+        self.messanger.socket.recv.side_effect = [
+            msgpack.packb({'type': 'raw', 'size': 10}) + b'0123456789',
+            b''
+        ]
+
+        self.messanger.start_receiving()
+        self.messanger.join()
+
+        self.assertTrue(self.messanger.disconnect.called)
+
+    def test_send_file(self):
+        sender_socket, receiver_socket = socket.socketpair()
+        self.addCleanup(sender_socket.close)
+
+        sender = syncall.Messanger(
+            sender_socket,
+            ('127.0.0.1', 1234),
+            'my_uuid',
+            'remote_uuid'
+        )
+        receiver = syncall.Messanger(
+            receiver_socket,
+            ('127.0.0.1', 1234),
+            'remote_uuid',
+            'my_uuid'
+        )
+
+        raw_file = BytesIO()
+        packets = []
+
+        def packet_received_handler(data):
+            packets.append(data)
+
+            if data['type'] == 'raw':
+                receiver.receive_raw(raw_file, data['size'])
+            elif data['type'] == 'done':
+                receiver.disconnect()
+
+        receiver.packet_received += packet_received_handler
+        receiver.start_receiving()
+
+        contents = bytes(range(256)) * 1000
+
+        with tempfile.TemporaryFile() as file:
+            file.write(contents)
+            file.flush()
+
+            sender.send({'type': 'raw', 'size': len(contents)})
+            self.assertEqual(
+                sender.send_file(file, len(contents)),
+                len(contents)
+            )
+            sender.send({'type': 'done'})
+
+        receiver.join()
+
+        self.assertEqual(raw_file.getvalue(), contents)
+        self.assertEqual(packets[-1], {'type': 'done'})
+
+    def test_send_file_error(self):
+        self.messanger.socket.sendfile.side_effect = OSError()
+        self.messanger.disconnect = Mock()
+
+        self.assertEqual(self.messanger.send_file(Mock(), 10), 0)
+        self.assertTrue(self.messanger.disconnect.called)
+
     def test_disconnect(self):
         self.messanger.socket.shutdown = Mock()
 
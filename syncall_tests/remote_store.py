@@ -4,6 +4,8 @@ from unittest.mock import Mock, MagicMock, patch
 
 import syncall
 
+from syncall.index_store import OverlayIndex
+
 
 class RemoteStoreTests(unittest.TestCase):
 
@@ -14,7 +16,10 @@ class RemoteStoreTests(unittest.TestCase):
             MagicMock()
         )
         self.remote.uuid = 'uuid'
-        self.remote.directory.diff = MagicMock()
+        self.remote.directory.diff = MagicMock(
+            return_value=(set(), set(), set())
+        )
+        self.remote.directory.get_index_entries.return_value = dict()
 
     def tearDown(self):
         del self.remote
@@ -54,26 +59,54 @@ class RemoteStoreTests(unittest.TestCase):
 
     def test_start_receiving(self):
         self.remote.directory.get_last_update.return_value = 5
-        self.remote.directory.get_index.return_value = {
-            'index': 'test'
-        }
+        self.remote.directory.get_index_snapshot.return_value = \
+            OverlayIndex({
+                'file1': {'last_update': 1}
+            })
+
+        self.remote.directory.get_hash_algorithms.return_value = [
+            'blake2b', 'md5'
+        ]
 
         self.remote.start_receiving()
 
         self.assertTrue(self.remote.messanger.start_receiving.called)
+        self.remote.messanger.send.assert_called_once_with({
+            'type': syncall.remote_store.MSG_HELLO,
+            'hash_algorithms': ['blake2b', 'md5'],
+            'capabilities': ['merkle']
+        })
+
+    def test_index_sent_to_remote_without_hello(self):
+        self.remote.directory.get_last_update.return_value = 5
+        self.remote.directory.get_index_snapshot.return_value = \
+            OverlayIndex({
+                'file1': {'last_update': 1}
+            })
+
+        self.remote._packet_received({
+            'type': syncall.remote_store.MSG_INDEX,
+            'index': {}
+        })
+        self.remote._packet_received({
+            'type': syncall.remote_store.MSG_INDEX,
+            'index': {}
+        })
+
         self.remote.messanger.send.assert_called_once_with({
             'type': syncall.remote_store.MSG_INDEX,
             'index': {
-                'index': 'test'
+                'file1': {'last_update': 1}
             }
         })
 
     def test_send_index(self):
         self.remote.my_index_last_updated = 5
         self.remote.directory.get_last_update.return_value = 5
-        self.remote.directory.get_index.return_value = {
-            'index': 'test'
-        }
+        self.remote.directory.get_index_snapshot.return_value = \
+            OverlayIndex({
+                'file1': {'last_update': 1}
+            })
 
         self.remote.send_index()
         self.remote.messanger.send.assert_called_once_with({
@@ -86,7 +119,7 @@ class RemoteStoreTests(unittest.TestCase):
         self.remote.messanger.send.assert_any_call({
             'type': syncall.remote_store.MSG_INDEX,
             'index': {
-                'index': 'test'
+                'file1': {'last_update': 1}
             }
         })
         self.remote.messanger.send.assert_any_call({
@@ -95,7 +128,7 @@ class RemoteStoreTests(unittest.TestCase):
 
     def test_send_index_delta(self):
         self.remote.directory.get_last_update.return_value = 5
-        self.remote.directory.get_index.return_value = {
+        self.remote.directory.get_index_entries.return_value = {
             'file1': {'test1': 'test1'},
             'file2': {'test2': 'test2'},
             'file3': {'test3': 'test3'}
@@ -166,13 +199,9 @@ class RemoteStoreTests(unittest.TestCase):
 
         self.remote._packet_received(packet)
 
-        directory.transfer_manager.sync_files.assert_any_call(
-            self.remote,
-            {'file1'}
-        )
-        directory.transfer_manager.sync_files.assert_any_call(
+        directory.transfer_manager.sync_files.assert_called_once_with(
             self.remote,
-            {'file2'}
+            {'file1', 'file2'}
         )
         self.assertEqual(self.remote.remote_index, packet['index'])
 
@@ -220,10 +249,49 @@ class RemoteStoreTests(unittest.TestCase):
                 'test4': 54321
             }
         })
-        self.remote.directory.diff.assert_called_once_with(
-            self.remote.remote_index
+        self.assertFalse(self.remote.directory.diff.called)
+        self.remote.directory.get_index_entries.assert_called_once_with(
+            {'file1', 'file2'}
         )
 
+    def test_sync_state_updated(self):
+        directory = self.remote.directory
+        local_entry = {
+            'last_update': 2,
+            'last_update_location': 'uuid1',
+            'sync_log': {'uuid1': 2}
+        }
+        remote_entry = {
+            'last_update': 1,
+            'last_update_location': 'uuid1',
+            'sync_log': {'uuid1': 1}
+        }
+
+        self.remote.remote_index = dict()
+        directory.get_index_entries.return_value = {'file1': local_entry}
+        self.remote._packet_received({
+            'type': syncall.remote_store.MSG_INDEX_DELTA,
+            'index': {'file1': remote_entry}
+        })
+
+        self.assertEqual(self.remote.sync_state.needs_update, {'file1'})
+        directory.transfer_manager.sync_files.assert_called_once_with(
+            self.remote,
+            {'file1'}
+        )
+
+        self.remote._RemoteStore__transfer_finalized(
+            ('uuid', 'file1', dict(local_entry, sync_log={'uuid1': 2}))
+        )
+        self.assertEqual(self.remote.sync_state.needs_update, set())
+
+        self.assertFalse(directory.diff.called)
+        self.assertTrue(self.remote.verify_sync_state())
+
+        directory.diff.return_value = ({'file2'}, set(), set())
+        self.assertFalse(self.remote.verify_sync_state())
+        self.assertEqual(self.remote.sync_state.needs_update, {'file2'})
+
     def test_packet_request_index(self):
         self.remote.send_index = Mock()
 
@@ -233,6 +301,111 @@ class RemoteStoreTests(unittest.TestCase):
 
         self.remote.send_index.assert_called_once_with(request=False)
 
+    def test_packet_hello(self):
+        self.remote.directory.get_hash_algorithms.return_value = [
+            'blake2b', 'md5'
+        ]
+        self.assertEqual(self.remote.hash_algorithm, 'md5')
+
+        self.remote._packet_received({
+            'type': syncall.remote_store.MSG_HELLO,
+            'hash_algorithms': ['sha1', 'blake2b', 'md5']
+        })
+
+        self.assertEqual(self.remote.hash_algorithm, 'blake2b')
+        self.assertFalse(self.remote.supports('merkle'))
+
+        # The index is sent after the remote's hello
+        self.remote.messanger.send.assert_called_once_with({
+            'type': syncall.remote_store.MSG_INDEX,
+            'index': {}
+        })
+
+    def test_packet_hello_merkle(self):
+        self.remote.directory.get_hash_algorithms.return_value = ['md5']
+        self.remote.directory.get_merkle_root.return_value = 'root'
+
+        self.remote._packet_received({
+            'type': syncall.remote_store.MSG_HELLO,
+            'hash_algorithms': ['md5'],
+            'capabilities': ['merkle', 'unknown']
+        })
+
+        self.assertTrue(self.remote.supports('merkle'))
+        self.remote.messanger.send.assert_called_once_with({
+            'type': syncall.remote_store.MSG_MERKLE_ROOT,
+            'root': 'root'
+        })
+
+    def test_packet_hello_no_common_algorithm(self):
+        self.remote.directory.get_hash_algorithms.return_value = [
+            'blake2b', 'md5'
+        ]
+
+        self.remote._packet_received({
+            'type': syncall.remote_store.MSG_HELLO,
+            'hash_algorithms': ['sha1']
+        })
+
+        self.assertEqual(self.remote.hash_algorithm, 'md5')
+
+    def test_entries_for_remote_without_hello(self):
+        self.remote.directory.get_last_update.return_value = 5
+        self.remote.directory.get_index_snapshot.return_value = \
+            OverlayIndex({
+                'file1': {'hash': b'1', 'size': 1},
+                'file2': {
+                    'hash': b'2',
+                    'size': 1,
+                    'hash_algorithm': 'blake2b',
+                    'hashes': {'md5': b'3'}
+                }
+            })
+
+        self.remote.send_index(request=False)
+
+        # The remote supports only md5
+        self.remote.messanger.send.assert_called_once_with({
+            'type': syncall.remote_store.MSG_INDEX,
+            'index': {
+                'file1': {'hash': b'1', 'size': 1},
+                'file2': {'hash': b'3', 'size': 1, 'hash_algorithm': 'md5'}
+            }
+        })
+
+    def test_entries_for_remote_supported(self):
+        self.remote.directory.get_hash_algorithms.return_value = [
+            'md5', 'blake2b'
+        ]
+        self.remote._packet_received({
+            'type': syncall.remote_store.MSG_HELLO,
+            'hash_algorithms': ['blake2b', 'md5']
+        })
+
+        file_data = {'hash': b'2', 'size': 1, 'hash_algorithm': 'blake2b'}
+
+        self.assertIs(self.remote.get_entry_for_remote(file_data), file_data)
+
+        # The local hashes aren't sent
+        self.assertEqual(
+            self.remote.get_entry_for_remote(
+                dict(file_data, hashes={'md5': b'3'})
+            ),
+            file_data
+        )
+
+    def test_negotiated_algorithm_deterministic(self):
+        self.remote.directory.get_hash_algorithms.return_value = [
+            'md5', 'blake2b'
+        ]
+        self.remote._packet_received({
+            'type': syncall.remote_store.MSG_HELLO,
+            'hash_algorithms': ['blake2b', 'md5']
+        })
+
+        # Whatever the preferences of the peers
+        self.assertEqual(self.remote.hash_algorithm, 'blake2b')
+
     def test_packet_index_no_change(self):
         self.remote._RemoteStore__remote_index_updated = Mock()
 
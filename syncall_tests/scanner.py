@@ -0,0 +1,75 @@
+import unittest
+import os
+
+from unittest.mock import Mock
+
+from syncall import scanner
+
+
+class ScannerTests(unittest.TestCase):
+    TEST_DIR = os.path.dirname(os.path.realpath(__file__)) + '/test_files'
+
+    def test_scan_tree(self):
+        files = {
+            relative_path: (path, stat)
+            for relative_path, path, stat in scanner.scan_tree(self.TEST_DIR)
+        }
+
+        self.assertEqual(set(files), {
+            'README.txt',
+            'animals/README.txt',
+            'animals/cat.jpg',
+            'animals/dogs/dog.jpg'
+        })
+
+        for relative_path, (path, stat) in files.items():
+            self.assertEqual(path, self.TEST_DIR + '/' + relative_path)
+            self.assertEqual(stat.st_size, os.path.getsize(path))
+
+    def test_scan_tree_relative_top(self):
+        files = [
+            relative_path for relative_path, path, stat
+            in scanner.scan_tree(self.TEST_DIR + '/animals/dogs', None, 'x')
+        ]
+
+        self.assertEqual(files, ['x/dog.jpg'])
+
+    def test_scan_tree_ignored(self):
+        is_ignored = Mock(
+            side_effect=lambda path, is_dir: path == 'animals' and is_dir
+        )
+
+        files = [
+            relative_path for relative_path, path, stat
+            in scanner.scan_tree(self.TEST_DIR, is_ignored)
+        ]
+
+        self.assertEqual(files, ['README.txt'])
+        is_ignored.assert_any_call('animals', True)
+
+    def test_scan_missing_tree(self):
+        self.assertEqual(list(scanner.scan_tree(self.TEST_DIR + '/none')), [])
+
+    def test_fingerprint(self):
+        stat = os.stat(self.TEST_DIR + '/README.txt')
+        file_data = {'last_update': 1}
+
+        self.assertFalse(scanner.has_fingerprint(file_data))
+        self.assertFalse(scanner.fingerprint_matches(file_data, stat))
+
+        file_data.update(scanner.get_fingerprint(stat))
+
+        self.assertTrue(scanner.has_fingerprint(file_data))
+        self.assertTrue(scanner.fingerprint_matches(file_data, stat))
+        self.assertEqual(file_data['size'], stat.st_size)
+        self.assertEqual(file_data['inode'], stat.st_ino)
+        self.assertEqual(file_data['mtime_ns'], stat.st_mtime_ns)
+
+        file_data['mtime_ns'] += 1
+        self.assertFalse(scanner.fingerprint_matches(file_data, stat))
+
+    def test_mtime_seconds(self):
+        stat = Mock()
+        stat.st_mtime_ns = 1234567891234
+
+        self.assertEqual(scanner.mtime_seconds(stat), 1234)
@@ -0,0 +1,58 @@
+import unittest
+
+from syncall.sync_state import SyncState
+
+
+def create_entry(last_update, location='uuid1', sync_log=None, **kwargs):
+    return dict(
+        last_update=last_update,
+        last_update_location=location,
+        sync_log=sync_log or {location: last_update},
+        **kwargs
+    )
+
+
+class SyncStateTests(unittest.TestCase):
+    def setUp(self):
+        self.state = SyncState()
+
+    def test_rebuild(self):
+        self.state.rebuild(({'file1'}, {'file2'}, {'file3'}))
+
+        self.assertEqual(self.state.get_needs_update(), {'file1', 'file2'})
+        self.assertEqual(self.state.get_conflicts(), {'file3'})
+        self.assertTrue(self.state.verify(({'file1', 'file2'}, set(),
+                                           {'file3'})))
+        self.assertFalse(self.state.verify(({'file1'}, set(), {'file3'})))
+
+        self.state.clear()
+        self.assertTrue(self.state.verify((set(), set(), set())))
+
+    def test_update_files(self):
+        local = {
+            'new': create_entry(1),
+            'newer': create_entry(2),
+            'same': create_entry(1),
+            'conflict': create_entry(2),
+            'deleted': create_entry(1, deleted=True)
+        }
+        remote = {
+            'newer': create_entry(1),
+            'same': create_entry(1),
+            'conflict': create_entry(3, 'uuid2')
+        }
+
+        self.state.rebuild(({'same', 'missing'}, set(), set()))
+        self.state.update_files(
+            set(local) | {'missing'},
+            local,
+            remote
+        )
+
+        self.assertEqual(self.state.get_needs_update(), {'new', 'newer'})
+        self.assertEqual(self.state.get_conflicts(), {'conflict'})
+
+        remote['newer'] = create_entry(2)
+        self.state.update_files({'newer'}, local, remote)
+
+        self.assertEqual(self.state.get_needs_update(), {'new'})
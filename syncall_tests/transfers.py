@@ -1,8 +1,17 @@
+import hashlib
+import os
+import tempfile
+
+from io import BytesIO
 from unittest import TestCase
 from unittest.mock import Mock, MagicMock, patch
 
 import syncall
 
+from syncall.block_size import DEDUP_BLOCK_SIZE
+from syncall.chunking import chunk_id
+from syncall.delta import PythonDeltaEngine
+
 
 class TransferDictTests(TestCase):
     def setUp(self):
@@ -232,6 +241,39 @@ class TransferManagerTests(TestCase):
         self.manager.transfers.remove.assert_called_with(transfer)
         self.assertTrue(self.manager.sync_file.called)
 
+    def test_transfer_completed_records_delta(self):
+        transfer = Mock()
+        transfer.type = syncall.transfers.FileTransfer.TO_REMOTE
+        transfer.file_name = 'file1'
+        transfer.get_literal_ratio.return_value = 0.75
+        self.manager.transfers = Mock()
+        self.manager._TransferManager__get_queued = Mock(return_value=None)
+
+        self.manager._TransferManager__transfer_completed(transfer)
+
+        self.assertEqual(self.manager.delta_history.get('file1'), 0.75)
+
+    def test_get_block_size(self):
+        self.manager.directory.get_index.return_value = {
+            'size': 2 ** 30
+        }
+
+        self.assertEqual(
+            self.manager._TransferManager__get_block_size('file1'),
+            32768
+        )
+
+        self.manager.delta_history.add('file1', 0.75)
+        self.assertEqual(
+            self.manager._TransferManager__get_block_size('file1'),
+            131072
+        )
+
+        self.manager.directory.get_index.return_value = {}
+        self.assertIsNone(
+            self.manager._TransferManager__get_block_size('file1')
+        )
+
     def test_transfer_failed_handler(self):
         transfer = Mock()
         self.manager.transfers = Mock()
@@ -258,6 +300,19 @@ class TransferManagerTests(TestCase):
         for file in file_list:
             self.manager.sync_file.assert_any_call(remote, file)
 
+    def test_sync_files_renamed(self):
+        remote = Mock()
+        self.manager.directory.get_rename_source.side_effect = {
+            'new': 'old'
+        }.get
+
+        self.manager.sync_file = Mock()
+        self.manager.sync_files(remote, {'new', 'old', 'file'})
+
+        self.assertEqual(self.manager.sync_file.call_count, 2)
+        self.manager.sync_file.assert_any_call(remote, 'new')
+        self.manager.sync_file.assert_any_call(remote, 'file')
+
     def test_stop_transfers(self):
         self.manager.transfers = Mock()
         self.manager.transfers.get_all.return_value = [
@@ -414,6 +469,9 @@ class FileTransferSendTests(TestCase):
         directory.get_index.return_value = {
             'last_update': 123
         }
+        directory.delta_engine = PythonDeltaEngine()
+        directory.chunk_index = None
+        directory.get_rename_source.return_value = None
 
         messanger = MagicMock()
         messanger.remote_uuid = 'remote_uuid'
@@ -446,10 +504,65 @@ class FileTransferSendTests(TestCase):
             'name': 'file1',
             'data': {
                 'last_update': 123
-            }
+            },
+            'block_size': syncall.DEFAULT_BLOCK_SIZE,
+            'raw_stream': True,
+            'dedup': True
         })
         self.assertTrue(self.transfer.has_started())
 
+    def test_start_remote_store(self):
+        self.transfer.remote_store = Mock()
+        self.transfer.remote_store.get_entry_for_remote.return_value = {
+            'last_update': 123,
+            'hash': b'1'
+        }
+
+        self.transfer.start()
+
+        self.transfer.remote_store.get_entry_for_remote \
+            .assert_called_once_with({'last_update': 123})
+        self.assertEqual(
+            self.transfer.messanger.send.call_args[0][0]['data'],
+            {'last_update': 123, 'hash': b'1'}
+        )
+
+    def test_start_rename(self):
+        self.transfer.directory.get_rename_source.return_value = 'file0'
+        self.transfer.directory.get_index.return_value = {'deleted': True}
+
+        self.transfer.start()
+
+        init_data = self.transfer.messanger.send.call_args[0][0]
+        self.assertEqual(init_data['rename_from'], 'file0')
+        self.assertEqual(init_data['rename_data'], {'deleted': True})
+
+    def test_packet_received_init_accept_rename(self):
+        self.transfer.directory.get_rename_source.return_value = 'file0'
+        self.transfer.start()
+        self.transfer.messanger.send.reset_mock()
+        self.transfer._FileTransfer__transfer_file = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_INIT_ACCEPT,
+            'rename': True
+        })
+
+        self.assertFalse(self.transfer._FileTransfer__transfer_file.called)
+        self.assertEqual(self.transfer.rename_from, 'file0')
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_DONE
+        })
+
+    def test_start_chunking(self):
+        self.transfer.directory.chunk_index = Mock()
+
+        self.transfer.start()
+
+        self.assertTrue(
+            self.transfer.messanger.send.call_args[0][0]['chunking']
+        )
+
     def test_transfer_file(self):
         self.transfer.run = Mock()
         self.transfer._FileTransfer__transfer_file(
@@ -471,6 +584,7 @@ class FileTransferSendTests(TestCase):
             1, 2, 3, 4, 5, b'sdfjksdf', 7, 6, b'1234'
         ]
         rsyncdelta.return_value = delta
+        self.transfer.remote_checksums = [(1234, b'12345')]
 
         self.transfer.run()
 
@@ -484,10 +598,164 @@ class FileTransferSendTests(TestCase):
             'type': self.transfer.MSG_DONE
         })
 
+        self.assertEqual(self.transfer.matched_blocks, 7)
+        self.assertEqual(self.transfer.literal_bytes, 12)
+        self.assertAlmostEqual(
+            self.transfer.get_literal_ratio(),
+            12 / (12 + 7 * syncall.DEFAULT_BLOCK_SIZE)
+        )
+
+    @patch('pyrsync2.rsyncdelta')
+    @patch('builtins.open')
+    def test_run_without_checksums(self, open, rsyncdelta):
+        open.return_value = BytesIO(b'1234567890')
+        self.transfer.remote_checksums = []
+        self.transfer.block_size = 4
+
+        self.transfer.run()
+
+        self.assertFalse(rsyncdelta.called)
+        for block in (b'1234', b'5678', b'90'):
+            self.transfer.messanger.send.assert_any_call({
+                'type': self.transfer.MSG_BLOCK_DATA,
+                'binary_data': block
+            })
+
+        self.transfer.messanger.send.assert_called_with({
+            'type': self.transfer.MSG_DONE
+        })
+        self.assertIsNone(self.transfer.get_literal_ratio())
+
+    @patch('pyrsync2.rsyncdelta')
+    @patch('builtins.open')
+    def test_run_raw_stream(self, open, rsyncdelta):
+        file = tempfile.TemporaryFile()
+        self.addCleanup(file.close)
+        file.write(b'1234567890')
+        file.flush()
+
+        open.return_value = file
+        self.transfer.raw_stream = True
+        self.transfer.messanger.send_file.return_value = 10
+
+        self.transfer.run()
+
+        self.assertFalse(rsyncdelta.called)
+        self.transfer.messanger.send.assert_any_call({
+            'type': self.transfer.MSG_RAW_DATA,
+            'size': 10
+        })
+        self.transfer.messanger.send_file.assert_called_once_with(file, 10)
+        self.transfer.messanger.send.assert_called_with({
+            'type': self.transfer.MSG_DONE
+        })
+        self.assertEqual(self.transfer.literal_bytes, 10)
+
+    @patch('builtins.open')
+    def test_run_raw_stream_incomplete(self, open):
+        file = tempfile.TemporaryFile()
+        self.addCleanup(file.close)
+        file.write(b'1234567890')
+        file.flush()
+
+        open.return_value = file
+        self.transfer.raw_stream = True
+        self.transfer.messanger.send_file.return_value = 4
+        self.transfer.shutdown = Mock()
+
+        self.transfer.run()
+
+        self.assertTrue(self.transfer.shutdown.called)
+
+    @patch('builtins.open')
+    def test_run_chunking(self, open):
+        open.return_value = BytesIO(b'aaaabbbcc')
+        self.transfer.directory.get_file_chunks.return_value = [
+            (b'1', 4), (b'2', 3), (b'3', 2)
+        ]
+        self.transfer.chunking = True
+        self.transfer.requested_chunks = [1, 2]
+        self.transfer._FileTransfer__chunks_requested.set()
+
+        self.transfer.run()
+
+        self.transfer.messanger.send.assert_any_call({
+            'type': self.transfer.MSG_CHUNK_LIST,
+            'chunks': [[b'1', 4], [b'2', 3], [b'3', 2]]
+        })
+        self.transfer.messanger.send.assert_any_call({
+            'type': self.transfer.MSG_CHUNK_DATA,
+            'index': 1,
+            'binary_data': b'bbb'
+        })
+        self.transfer.messanger.send.assert_any_call({
+            'type': self.transfer.MSG_CHUNK_DATA,
+            'index': 2,
+            'binary_data': b'cc'
+        })
+        self.transfer.messanger.send.assert_called_with({
+            'type': self.transfer.MSG_DONE
+        })
+
+        self.assertEqual(self.transfer.matched_blocks, 1)
+        self.assertEqual(self.transfer.literal_bytes, 5)
+        self.assertEqual(self.transfer.deduplicated_bytes, 4)
+        self.assertAlmostEqual(self.transfer.get_dedup_ratio(), 4 / 9)
+
+    @patch('builtins.open')
+    def test_run_dedup(self, open):
+        file = tempfile.TemporaryFile()
+        self.addCleanup(file.close)
+        file.write(b'aaaabbbbcc')
+        file.flush()
+
+        open.return_value = file
+        self.transfer.directory.get_block_checksums.return_value = [
+            (1, b'1'), (2, b'2'), (3, b'3')
+        ]
+        self.transfer.block_size = 4
+        self.transfer.dedup = True
+        self.transfer.requested_chunks = [2]
+        self.transfer._FileTransfer__chunks_requested.set()
+
+        self.transfer.run()
+
+        self.transfer.directory.get_block_checksums.assert_called_once_with(
+            'file1',
+            4
+        )
+        self.transfer.messanger.send.assert_any_call({
+            'type': self.transfer.MSG_CHUNK_LIST,
+            'chunks': [[b'1', 4], [b'2', 4], [b'3', 2]]
+        })
+        self.transfer.messanger.send.assert_any_call({
+            'type': self.transfer.MSG_CHUNK_DATA,
+            'index': 2,
+            'binary_data': b'cc'
+        })
+        self.assertEqual(self.transfer.deduplicated_bytes, 8)
+
+    @patch('builtins.open')
+    def test_run_chunking_stopped(self, open):
+        open.return_value = BytesIO(b'aaaa')
+        self.transfer.directory.get_file_chunks.return_value = [(b'1', 4)]
+        self.transfer.chunking = True
+
+        # Disconnected before the chunks were requested
+        self.transfer._FileTransfer__disconnected(None)
+        self.transfer.run()
+
+        self.assertEqual(self.transfer.messanger.send.call_count, 1)
+        self.assertEqual(
+            self.transfer.messanger.send.call_args[0][0]['type'],
+            self.transfer.MSG_CHUNK_LIST
+        )
+
     @patch('pyrsync2.rsyncdelta')
     @patch('builtins.open')
     def test_run_error(self, open, rsyncdelta):
         rsyncdelta.side_effect = OSError()
+        self.transfer.remote_checksums = [(1234, b'12345')]
         self.transfer.shutdown = Mock()
 
         self.transfer.run()
@@ -505,7 +773,57 @@ class FileTransferSendTests(TestCase):
 
         self.transfer._FileTransfer__transfer_file.assert_called_once_with(
             [(1234, b'12345'), (1234, b'12345')],
-            128
+            128,
+            False,
+            False,
+            False
+        )
+
+    def test_packet_received_init_accept_raw_stream(self):
+        self.transfer._FileTransfer__transfer_file = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_INIT_ACCEPT,
+            'checksums': [],
+            'block_size': 1024,
+            'raw_stream': True
+        })
+
+        self.transfer._FileTransfer__transfer_file.assert_called_once_with(
+            [],
+            1024,
+            True,
+            False,
+            False
+        )
+
+    def test_packet_received_init_accept_chunking(self):
+        self.transfer._FileTransfer__transfer_file = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_INIT_ACCEPT,
+            'checksums': [],
+            'block_size': 1024,
+            'chunking': True
+        })
+
+        self.transfer._FileTransfer__transfer_file.assert_called_once_with(
+            [],
+            1024,
+            False,
+            True,
+            False
+        )
+
+    def test_packet_received_chunk_request(self):
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_CHUNK_REQUEST,
+            'indexes': [0, 2]
+        })
+
+        self.assertEqual(self.transfer.requested_chunks, [0, 2])
+        self.assertTrue(
+            self.transfer._FileTransfer__chunks_requested.is_set()
         )
 
     def test_packet_received_init_accept_delete(self):
@@ -535,6 +853,21 @@ class FileTransferSendTests(TestCase):
         self.transfer.transfer_completed.notify.assert_called_once_with(
             self.transfer
         )
+        self.assertFalse(self.transfer.metadata_only)
+
+    def test_packet_received_done_accept_metadata_only(self):
+        self.transfer.transfer_completed = Mock()
+        self.transfer.terminate = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_DONE_ACCEPT,
+            'time': 128,
+            'sync_log': {'uuid1': 128}
+        })
+
+        self.assertTrue(self.transfer.metadata_only)
+        self.assertEqual(self.transfer.sync_log, {'uuid1': 128})
+        self.assertTrue(self.transfer.transfer_completed.notify.called)
 
 
 class FileTransferReceiveTests(TestCase):
@@ -546,6 +879,7 @@ class FileTransferReceiveTests(TestCase):
         directory.get_index.return_value = {
             'last_update': 123
         }
+        directory.find_local_copy.return_value = None
 
         messanger = MagicMock()
         messanger.remote_uuid = 'remote_uuid'
@@ -569,12 +903,14 @@ class FileTransferReceiveTests(TestCase):
 
         self.assertTrue(self.transfer.shutdown.called)
 
+    @patch('os.path.getsize')
     @patch('os.path.exists')
     @patch('builtins.open')
     @patch('syncall.IndexDiff.compare_file')
-    def test_accept_file(self, compare_file, open, exists):
+    def test_accept_file(self, compare_file, open, exists, getsize):
         compare_file.return_value = syncall.index.NEEDS_UPDATE
-        exists.return_value = False
+        exists.return_value = True
+        getsize.return_value = 2 ** 20
         self.transfer.directory.get_index.return_value = {
             'last_update': 100
         }
@@ -584,7 +920,6 @@ class FileTransferReceiveTests(TestCase):
             (1234, b'12345')
         ]
         self.transfer.transfer_started = Mock()
-        self.transfer.block_size = 123
 
         self.transfer._FileTransfer__accept_file('file1', {
             'last_update': 123
@@ -605,18 +940,500 @@ class FileTransferReceiveTests(TestCase):
 
         self.transfer.messanger.send.assert_called_once_with({
             'type': self.transfer.MSG_INIT_ACCEPT,
-            'block_size': self.transfer.block_size,
+            'block_size': 1024,
             'checksums': [
                 (1234, b'12345'),
                 (1234, b'12345')
             ]
         })
+        self.transfer.directory.get_block_checksums.assert_called_once_with(
+            'file1',
+            1024
+        )
+
+    @patch('os.path.getsize')
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_proposed_block_size(self, compare_file, open,
+                                             exists, getsize):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        exists.return_value = True
+        getsize.return_value = 2 ** 20
+        self.transfer.directory.get_block_checksums.return_value = []
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123
+        }, 8192)
+        self.assertEqual(self.transfer.block_size, 8192)
+
+        # Not a valid block size
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123
+        }, 3)
+        self.assertEqual(self.transfer.block_size, 1024)
+
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_without_basis(self, compare_file, open, exists):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        exists.return_value = False
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123
+        })
+
+        self.assertFalse(self.transfer.directory.get_block_checksums.called)
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_INIT_ACCEPT,
+            'block_size': 1024,
+            'checksums': []
+        })
+
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_raw_stream(self, compare_file, open, exists):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        exists.return_value = False
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123
+        }, None, True)
+
+        self.assertTrue(self.transfer.raw_stream)
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_INIT_ACCEPT,
+            'block_size': 1024,
+            'checksums': [],
+            'raw_stream': True
+        })
+
+    @patch('os.path.getsize')
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_raw_stream_with_basis(self, compare_file, open,
+                                               exists, getsize):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        exists.return_value = True
+        getsize.return_value = 2 ** 20
+        self.transfer.directory.get_block_checksums.return_value = []
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123
+        }, None, True)
+
+        self.assertFalse(self.transfer.raw_stream)
+
+    @patch('os.path.getsize')
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_chunking(self, compare_file, open, exists,
+                                  getsize):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        exists.return_value = True
+        getsize.return_value = 2 ** 20
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123
+        }, None, True, True)
+
+        self.assertTrue(self.transfer.chunking)
+        self.assertFalse(self.transfer.directory.get_block_checksums.called)
+        self.transfer.directory.get_file_chunks.assert_called_once_with(
+            'file1'
+        )
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_INIT_ACCEPT,
+            'block_size': 1024,
+            'checksums': [],
+            'chunking': True
+        })
 
+    @patch('os.path.getsize')
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_chunking_not_supported(self, compare_file, open,
+                                                exists, getsize):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
         exists.return_value = True
+        getsize.return_value = 2 ** 20
+        self.transfer.directory.chunk_index = None
+        self.transfer.directory.get_block_checksums.return_value = []
+
         self.transfer._FileTransfer__accept_file('file1', {
             'last_update': 123
+        }, None, True, True)
+
+        self.assertFalse(self.transfer.chunking)
+        self.assertTrue(self.transfer.directory.get_block_checksums.called)
+
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_dedup(self, compare_file, open, exists):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        exists.return_value = False
+        self.transfer.directory.checksum_cache.has_blocks.return_value = True
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123,
+            'size': 2 ** 20
+        }, None, True, False, True)
+
+        self.assertTrue(self.transfer.dedup)
+        self.assertFalse(self.transfer.raw_stream)
+        self.transfer.directory.checksum_cache.has_blocks \
+            .assert_called_once_with(DEDUP_BLOCK_SIZE)
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_INIT_ACCEPT,
+            'block_size': DEDUP_BLOCK_SIZE,
+            'checksums': [],
+            'dedup': True
         })
 
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_dedup_without_blocks(self, compare_file, open,
+                                              exists):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        exists.return_value = False
+        self.transfer.directory.checksum_cache.has_blocks.return_value = False
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123,
+            'size': 2 ** 20
+        }, None, True, False, True)
+
+        self.assertFalse(self.transfer.dedup)
+        self.assertTrue(self.transfer.raw_stream)
+
+    def test_block_list_from_unrelated_file(self):
+        block = bytes(range(256)) * (DEDUP_BLOCK_SIZE // 256)
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            with open(os.path.join(dir_path, 'unrelated'), 'wb') as file:
+                file.write(b'x' * DEDUP_BLOCK_SIZE + block)
+
+            # The file was never the basis of a transfer, its blocks are
+            # indexed by warming the checksum cache after the scan
+            directory = syncall.Directory('uuid', dir_path,
+                                          warm_checksum_cache=True)
+            directory.update_index()
+            directory.wait_for_checksums()
+
+            self.transfer.directory = directory
+            self.transfer._FileTransfer__transfer_started = True
+            self.transfer._FileTransfer__temp_file_handle = BytesIO()
+            self.transfer.dedup = True
+
+            self.transfer._FileTransfer__packet_received({
+                'type': self.transfer.MSG_CHUNK_LIST,
+                'chunks': [
+                    [hashlib.md5(b'new').digest(), 3],
+                    [hashlib.md5(block).digest(), DEDUP_BLOCK_SIZE]
+                ]
+            })
+
+            directory.checksum_cache.close()
+
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_CHUNK_REQUEST,
+            'indexes': [0]
+        })
+        self.assertEqual(
+            self.transfer._FileTransfer__temp_file_handle.getvalue()[3:],
+            block
+        )
+
+    def test_packet_received_block_list(self):
+        blocks = {
+            hashlib.md5(b'aaaa').digest(): b'aaaa'
+        }
+
+        self.transfer._FileTransfer__transfer_started = True
+        self.transfer._FileTransfer__temp_file_handle = BytesIO()
+        self.transfer.dedup = True
+        self.transfer.directory.read_block.side_effect = \
+            lambda strong, length: blocks.get(strong)
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_CHUNK_LIST,
+            'chunks': [
+                [hashlib.md5(b'aaaa').digest(), 4],
+                [hashlib.md5(b'bb').digest(), 2]
+            ]
+        })
+
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_CHUNK_REQUEST,
+            'indexes': [1]
+        })
+        self.assertAlmostEqual(self.transfer.get_dedup_ratio(), 4 / 6)
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_CHUNK_DATA,
+            'index': 1,
+            'binary_data': b'bb'
+        })
+
+        self.assertEqual(
+            self.transfer._FileTransfer__temp_file_handle.getvalue(),
+            b'aaaabb'
+        )
+
+    def start_chunking(self, chunks, local_chunks):
+        self.transfer._FileTransfer__transfer_started = True
+        self.transfer._FileTransfer__temp_file_handle = BytesIO()
+        self.transfer.chunking = True
+        self.transfer.directory.read_chunk.side_effect = local_chunks.get
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_CHUNK_LIST,
+            'chunks': [
+                [chunk_id(chunk), len(chunk)]
+                for chunk in chunks
+            ]
+        })
+
+    def test_packet_received_chunk_list(self):
+        chunks = [b'aaaa', b'bbb', b'cc']
+        self.start_chunking(chunks, {
+            chunk_id(b'aaaa'): b'aaaa',
+            chunk_id(b'cc'): b'cc'
+        })
+
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_CHUNK_REQUEST,
+            'indexes': [1]
+        })
+        self.assertEqual(self.transfer.missing_chunks, {1})
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_CHUNK_DATA,
+            'index': 1,
+            'binary_data': b'bbb'
+        })
+
+        self.assertEqual(self.transfer.missing_chunks, set())
+        self.assertEqual(
+            self.transfer._FileTransfer__temp_file_handle.getvalue(),
+            b'aaaabbbcc'
+        )
+
+    def test_packet_received_invalid_chunk(self):
+        self.start_chunking([b'aaaa', b'bbb'], {})
+        self.transfer.shutdown = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_CHUNK_DATA,
+            'index': 1,
+            'binary_data': b'ccc'
+        })
+
+        self.assertTrue(self.transfer.shutdown.called)
+
+    def test_packet_received_done_with_missing_chunks(self):
+        self.start_chunking([b'aaaa', b'bbb'], {})
+        self.transfer.shutdown = Mock()
+        self.transfer._FileTransfer__complete_transfer = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_DONE
+        })
+
+        self.assertTrue(self.transfer.shutdown.called)
+        self.assertFalse(
+            self.transfer._FileTransfer__complete_transfer.called
+        )
+
+    def test_packet_received_chunks_not_expected(self):
+        self.transfer._FileTransfer__transfer_started = True
+        self.transfer.terminate = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_CHUNK_LIST,
+            'chunks': []
+        })
+
+        self.assertTrue(self.transfer.terminate.called)
+
+    def accept_rename(self, local_data, deleted=True):
+        file_data = {
+            'last_update': 123,
+            'hash': b'1',
+            'size': 10
+        }
+        self.transfer.directory.get_index.return_value = local_data
+        self.transfer.directory.get_block_checksums.return_value = []
+
+        self.transfer._FileTransfer__accept_file(
+            'file2',
+            file_data,
+            rename_from='file1',
+            rename_data={'deleted': deleted}
+        )
+
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_rename(self, compare_file):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        self.transfer.directory.is_file_unchanged.return_value = True
+
+        self.accept_rename({'hash': b'1', 'size': 10})
+
+        self.assertEqual(self.transfer.rename_from, 'file1')
+        self.assertEqual(self.transfer.rename_data, {'deleted': True})
+        self.assertFalse(self.transfer.directory.get_temp_path.called)
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_INIT_ACCEPT,
+            'rename': True
+        })
+
+    @patch('os.path.getsize')
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('os.path.isfile')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_rename_changed(self, compare_file, isfile, open,
+                                        exists, getsize):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        isfile.return_value = True
+        exists.return_value = False
+
+        # The local copy of the old file is different
+        self.accept_rename({'hash': b'2', 'size': 10})
+
+        self.assertIsNone(self.transfer.rename_from)
+        self.assertTrue(self.transfer.directory.get_temp_path.called)
+        self.assertNotIn(
+            'rename',
+            self.transfer.messanger.send.call_args[0][0]
+        )
+
+    @patch('os.path.getsize')
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_rename_file_changed(self, compare_file, open,
+                                             exists, getsize):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        exists.return_value = False
+        # The old file was changed since it was indexed
+        self.transfer.directory.is_file_unchanged.return_value = False
+
+        self.accept_rename({'hash': b'1', 'size': 10})
+
+        self.transfer.directory.is_file_unchanged.assert_called_once_with(
+            'file1'
+        )
+        self.assertIsNone(self.transfer.rename_from)
+        self.assertTrue(self.transfer.directory.get_temp_path.called)
+
+    @patch('syncall.transfers.clone_file')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_clone(self, compare_file, clone_file):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        clone_file.return_value = 'reflink'
+        directory = self.transfer.directory
+        directory.find_local_copy.return_value = 'file2'
+
+        file_data = {'last_update': 123, 'hash': b'1', 'size': 10}
+        self.transfer._FileTransfer__accept_file('file1', file_data)
+
+        directory.find_local_copy.assert_called_once_with(file_data)
+        clone_file.assert_called_once_with(
+            directory.get_file_path.return_value,
+            directory.get_temp_path.return_value
+        )
+        directory.get_file_path.assert_called_once_with('file2')
+        self.assertEqual(self.transfer.clone_from, 'file2')
+        self.assertFalse(directory.get_block_checksums.called)
+        self.assertEqual(
+            self.transfer.messanger.send.call_args[0][0]['type'],
+            self.transfer.MSG_DONE_ACCEPT
+        )
+        self.assertEqual(self.transfer.messanger.send.call_count, 1)
+
+    @patch('os.path.getsize')
+    @patch('os.path.exists')
+    @patch('builtins.open')
+    @patch('syncall.transfers.clone_file')
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_clone_failed(self, compare_file, clone_file, open,
+                                      exists, getsize):
+        compare_file.return_value = syncall.index.NEEDS_UPDATE
+        clone_file.side_effect = OSError()
+        exists.return_value = False
+        directory = self.transfer.directory
+        directory.find_local_copy.return_value = 'file2'
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 123,
+            'hash': b'1',
+            'size': 10
+        })
+
+        self.assertIsNone(self.transfer.clone_from)
+        self.assertEqual(
+            self.transfer.messanger.send.call_args[0][0]['type'],
+            self.transfer.MSG_INIT_ACCEPT
+        )
+
+    @patch('syncall.IndexDiff.compare_file')
+    def test_accept_file_same_content(self, compare_file):
+        compare_file.return_value = syncall.index.SAME_CONTENT
+        directory = self.transfer.directory
+        directory.get_index.return_value = {
+            'last_update': 123,
+            'sync_log': {'uuid1': 123, 'uuid2': 10}
+        }
+
+        self.transfer._FileTransfer__accept_file('file1', {
+            'last_update': 200,
+            'sync_log': {'uuid2': 200}
+        })
+
+        self.assertTrue(self.transfer.metadata_only)
+        self.assertFalse(directory.get_temp_path.called)
+        self.assertFalse(directory.get_block_checksums.called)
+
+        sent = self.transfer.messanger.send.call_args[0][0]
+        self.assertEqual(self.transfer.messanger.send.call_count, 1)
+        self.assertEqual(sent['type'], self.transfer.MSG_DONE_ACCEPT)
+        self.assertEqual(sent['sync_log'], {'uuid1': 123, 'uuid2': 200})
+
+    def test_packet_received_raw_data(self):
+        self.transfer._FileTransfer__transfer_started = True
+        self.transfer._FileTransfer__temp_file_handle = Mock()
+        self.transfer.raw_stream = True
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_RAW_DATA,
+            'size': 10
+        })
+
+        self.transfer.messanger.receive_raw.assert_called_once_with(
+            self.transfer._FileTransfer__temp_file_handle,
+            10
+        )
+
+    def test_packet_received_raw_data_not_expected(self):
+        self.transfer._FileTransfer__transfer_started = True
+        self.transfer.terminate = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_RAW_DATA,
+            'size': 10
+        })
+
+        self.assertTrue(self.transfer.terminate.called)
+        self.assertFalse(self.transfer.messanger.receive_raw.called)
+
     @patch('os.path.exists')
     @patch('builtins.open')
     @patch('syncall.IndexDiff.compare_file')
@@ -658,7 +1475,34 @@ class FileTransferReceiveTests(TestCase):
 
         self.transfer._FileTransfer__accept_file.assert_called_once_with(
             'file1',
-            {'test': 'test'}
+            {'test': 'test'},
+            None,
+            False,
+            False,
+            False,
+            None,
+            None
+        )
+
+    def test_packet_received_init_block_size(self):
+        self.transfer._FileTransfer__accept_file = Mock()
+
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_INIT,
+            'name': 'file1',
+            'data': {'test': 'test'},
+            'block_size': 8192
+        })
+
+        self.transfer._FileTransfer__accept_file.assert_called_once_with(
+            'file1',
+            {'test': 'test'},
+            8192,
+            False,
+            False,
+            False,
+            None,
+            None
         )
 
     def test_packet_received_cancel(self):
@@ -694,6 +1538,42 @@ class FileTransferReceiveTests(TestCase):
 
         self.assertTrue(self.transfer._FileTransfer__complete_transfer.called)
 
+    def receive_verified(self, data, file_hash):
+        self.transfer.remote_file_data = {
+            'hash': file_hash,
+            'hash_algorithm': 'md5',
+            'size': len(data)
+        }
+        self.transfer._FileTransfer__temp_file_handle = \
+            syncall.hashing.HashingWriter(BytesIO(), 'md5')
+        self.transfer._FileTransfer__complete_transfer = Mock()
+        self.transfer.shutdown = Mock()
+
+        self.transfer._FileTransfer__temp_file_handle.write(data)
+        self.transfer._FileTransfer__packet_received({
+            'type': self.transfer.MSG_DONE
+        })
+
+    def test_packet_received_done_verified(self):
+        self.receive_verified(b'1234', hashlib.md5(b'1234').digest())
+
+        self.assertTrue(self.transfer._FileTransfer__complete_transfer.called)
+        self.assertEqual(
+            self.transfer.verified_hash,
+            hashlib.md5(b'1234').digest()
+        )
+
+    def test_packet_received_done_hash_mismatch(self):
+        self.receive_verified(b'1234', hashlib.md5(b'4321').digest())
+
+        self.assertFalse(
+            self.transfer._FileTransfer__complete_transfer.called
+        )
+        self.assertTrue(self.transfer.shutdown.called)
+        self.assertIsNone(self.transfer.verified_hash)
+        self.transfer.directory.checksum_cache.invalidate \
+            .assert_called_once_with([self.transfer.file_name])
+
     @patch('pyrsync2.patchstream_block')
     def test_data_received_handler(self, patchstream_block):
         self.transfer._FileTransfer__file_handle = Mock()
@@ -744,6 +1624,21 @@ class FileTransferReceiveTests(TestCase):
             'time': self.transfer.timestamp
         })
 
+    @patch('syncall.transfers.datetime')
+    def test_complete_transfer_rename(self, datetime):
+        datetime.now.return_value.timestamp.return_value = 1234
+        self.transfer.remote_file_data = dict()
+        self.transfer.rename_from = 'file1'
+        self.transfer.transfer_completed = Mock()
+
+        self.transfer._FileTransfer__complete_transfer()
+
+        self.assertTrue(self.transfer.transfer_completed.notify.called)
+        self.transfer.messanger.send.assert_called_once_with({
+            'type': self.transfer.MSG_DONE_ACCEPT,
+            'time': 1234
+        })
+
     def test_disconnect_handler_failed(self):
         self.transfer._FileTransfer__release_resources = Mock()
         self.transfer.transfer_failed = Mock()
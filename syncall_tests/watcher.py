@@ -0,0 +1,158 @@
+import unittest
+import os
+import tempfile
+import time
+
+from unittest.mock import Mock, patch
+
+import inotify
+import syncall
+
+
+@unittest.skipUnless(inotify.is_supported(), "inotify is not supported")
+class DirectoryWatcherTests(unittest.TestCase):
+
+    @patch('logging.Logger')
+    def setUp(self, Logger):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.temp_dir.name, 'dir'))
+        os.mkdir(os.path.join(self.temp_dir.name, '.syncall_temp'))
+
+        self.directory = syncall.Directory(
+            'uuid',
+            self.temp_dir.name,
+            load_index=False
+        )
+        self.directory.update_paths = Mock()
+        self.directory.update_index = Mock()
+
+        self.watcher = syncall.DirectoryWatcher(
+            self.directory,
+            delay=1,
+            max_delay=5
+        )
+
+    def tearDown(self):
+        self.watcher.inotify.close()
+        self.temp_dir.cleanup()
+
+    def process_events(self):
+        for event in self.watcher.inotify.read_events(1):
+            self.watcher.process_event(*event)
+
+    def test_watch_tree(self):
+        self.watcher.watch_tree('')
+
+        self.assertEqual(set(self.watcher.watched_dirs), {'', 'dir'})
+
+    def test_debounce(self):
+        self.watcher.queue_path('dir/file', now=10)
+        self.watcher.queue_path('dir/file', now=10.5)
+        self.watcher.queue_path('file2', now=10.5)
+
+        self.watcher.flush(now=11)
+        self.assertFalse(self.directory.update_paths.called)
+
+        self.watcher.flush(now=11.5)
+        self.directory.update_paths.assert_called_once_with(
+            {'dir/file', 'file2'}
+        )
+        self.assertEqual(self.watcher.pending, dict())
+
+    def test_debounce_max_delay(self):
+        for now in range(10, 16):
+            self.watcher.queue_path('file', now=now)
+
+        self.watcher.flush(now=15)
+
+        self.directory.update_paths.assert_called_once_with({'file'})
+
+    def test_overflow_rescan(self):
+        self.watcher.queue_path('file', now=10)
+        self.watcher.process_event(-1, inotify.IN_Q_OVERFLOW, 0, '')
+
+        self.watcher.flush(now=20)
+
+        self.assertTrue(self.directory.update_index.called)
+        self.assertFalse(self.directory.update_paths.called)
+
+    def test_file_events(self):
+        self.watcher.watch_tree('')
+
+        for i in range(5):
+            with open(os.path.join(self.temp_dir.name, 'dir/file'), 'a') \
+                    as file:
+                file.write('change {}'.format(i))
+
+        self.process_events()
+
+        self.assertEqual(set(self.watcher.pending), {'dir/file'})
+
+    def test_ignored_events(self):
+        self.watcher.watch_tree('')
+
+        with open(os.path.join(self.temp_dir.name, '.syncall_index'), 'w'):
+            pass
+        with open(os.path.join(self.temp_dir.name, '.syncall_temp/f'), 'w'):
+            pass
+
+        self.process_events()
+
+        self.assertEqual(self.watcher.pending, dict())
+
+    def test_new_directory(self):
+        self.watcher.watch_tree('')
+
+        os.mkdir(os.path.join(self.temp_dir.name, 'dir/sub'))
+        self.process_events()
+
+        self.assertIn('dir/sub', self.watcher.watched_dirs)
+        self.assertIn('dir/sub', self.watcher.pending)
+
+    def test_moved_directory(self):
+        self.watcher.watch_tree('')
+
+        os.rename(
+            os.path.join(self.temp_dir.name, 'dir'),
+            os.path.join(self.temp_dir.name, 'moved')
+        )
+        self.process_events()
+
+        self.assertNotIn('dir', self.watcher.watched_dirs)
+        self.assertIn('moved', self.watcher.watched_dirs)
+        self.assertIn('dir', self.watcher.pending)
+        self.assertIn('moved', self.watcher.pending)
+
+    def test_run(self):
+        self.watcher.delay = 0.1
+
+        self.watcher.start()
+        time.sleep(0.2)
+
+        with open(os.path.join(self.temp_dir.name, 'dir/file'), 'w') as file:
+            file.write('test')
+
+        time.sleep(0.5)
+        self.watcher.shutdown()
+        self.watcher.join()
+
+        self.directory.update_paths.assert_called_once_with({'dir/file'})
+
+    def test_run_recovers_from_errors(self):
+        self.watcher.delay = 0.1
+        self.watcher.POLL_INTERVAL = 0.1
+        self.directory.update_paths.side_effect = FileNotFoundError()
+
+        self.watcher.start()
+        time.sleep(0.2)
+
+        with open(os.path.join(self.temp_dir.name, 'dir/file'), 'w') as file:
+            file.write('test')
+
+        time.sleep(0.5)
+        self.watcher.shutdown()
+        self.watcher.join()
+
+        # The failed update is followed by a rescan
+        self.assertTrue(self.directory.update_paths.called)
+        self.assertTrue(self.directory.update_index.called)